@@ -1,81 +1,17 @@
 from .tokenizer import *
-from typing import *
-import struct
+from .encoding import *
+from .object import ObjectWriter
 
 
-class Assembler(Tokenizer):
-
-    class LabelUse:
-
-        def __init__(self, name: str, pos: int):
-            self.pos = pos
-            self.name = name
+class Assembler(Tokenizer, ObjectWriter):
 
     def __init__(self, code, filename='<unknown>'):
         super(Assembler, self).__init__(code, filename)
-
-        self._lbl_uses = []  # type: List[Assembler.LabelUse]
-        self._lbls = {}  # type: Dict[str, int]
-        self._words = []
-        self._pos = 0
-
-        self._externs = []
-        self._globals = {}
-
-        self._global_relocations = []
-        self._local_relocations = []
+        ObjectWriter.__init__(self)
 
         self.next_token()
         self.got_errors = False
 
-    ####################################################################################################################
-    # Labels
-    ####################################################################################################################
-
-    def _mark_label(self, name: str):
-        self._lbls[name] = self._pos
-
-    def _use_label(self, name: str):
-        self._lbl_uses.append(Assembler.LabelUse(name, self._pos))
-
-    def fix_labels(self):
-        orig = self._pos
-        unknown = []
-        for lbl in self._lbl_uses:
-            if lbl.name in self._lbls:
-                self._pos = lbl.pos
-                self._words[self._pos] += self._lbls[lbl.name]
-                self._local_relocations.append(lbl.pos)
-            else:
-                unknown.append(lbl)
-        self._pos = orig
-
-        for lbl in unknown:
-            if lbl.name not in self._externs:
-                self.report_error(f'undefined symbol `{lbl.name}` referenced')
-            else:
-                self._global_relocations.append((lbl.name, lbl.pos))
-
-        for glob in self._globals:
-            if glob not in self._lbls:
-                self.report_error(f'global defined for undefined symbol `{glob}`')
-            else:
-                self._globals[glob] = self._lbls[glob]
-
-    def get_object(self):
-        return self.get_words(), self._global_relocations, self._local_relocations, self._globals
-
-    ####################################################################################################################
-    # Assembling
-    ####################################################################################################################
-
-    def _emit_word(self, word):
-        self._words.append(word & 0xFFFF)
-        self._pos += 1
-
-    def get_words(self):
-        return self._words
-
     ####################################################################################################################
     # Error reporting
     ####################################################################################################################
@@ -132,6 +68,11 @@ class Assembler(Tokenizer):
                 val = self.token.value
                 self.next_token()
                 return val
+            elif self.is_token(IdentToken):
+                # A label, resolved like any other label use
+                val = self.token.value
+                self.next_token()
+                return val
             else:
                 assert False
         elif self.match_token('-'):
@@ -145,221 +86,115 @@ class Assembler(Tokenizer):
         else:
             return 0
 
+    def _parse_label_offset(self, name):
+        """
+        A label can have a constant added to it, `label + 1`, the label is
+        resolved like any other and the constant added to its address
+        """
+        if self.is_token('+') or self.is_token('-'):
+            pos = self.token.pos
+            off = self._parse_addition()
+            if isinstance(off, str):
+                # Only a register can have a label added to it
+                self.report_error(f'can not add the label `{off}` to the label `{name}`', pos)
+                return name
+            if off != 0:
+                return name, off
+        return name
+
     def _parse_operand(self, a: bool):
         if not a and self.match_keyword('PUSH'):
-            return 0x18, None
+            return PUSH_POP, None
         elif a and self.match_keyword('POP'):
-            return 0x18, None
+            return PUSH_POP, None
         elif self.match_keyword('PEEK'):
-            return 0x19, None
+            return PEEK, None
         elif self.match_keyword('PICK'):
             if self.is_token(IntToken):
                 val = self.token.value
                 self.next_token()
-                return 0x1A, val
+                return PICK, val
             else:
-                return 0x1A, 0
-        elif self.match_keyword('A'):
-            return 0, None
-        elif self.match_keyword('B'):
-            return 1, None
-        elif self.match_keyword('C'):
-            return 2, None
-        elif self.match_keyword('X'):
-            return 3, None
-        elif self.match_keyword('Y'):
-            return 4, None
-        elif self.match_keyword('Z'):
-            return 5, None
-        elif self.match_keyword('I'):
-            return 6, None
-        elif self.match_keyword('J'):
-            return 7, None
+                return PICK, 0
+        elif self.is_token(KeywordToken) and self.token.value in REGISTER_TABLE:
+            reg = REGISTER_TABLE[self.token.value]
+            self.next_token()
+            return reg, None
         elif self.match_keyword('SP'):
-            return 0x1B, None
+            return SP, None
         elif self.match_keyword('PC'):
-            return 0x1C, None
+            return PC, None
         elif self.match_keyword('EX'):
-            return 0x1D, None
+            return EX, None
         elif self.match_token('['):
-            # UGLY CODE AHEAD
             # Parse the first part
-            if self.match_keyword('A'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x08, None
-                else:
-                    return 0x10, off
-            elif self.match_keyword('B'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x09, None
-                else:
-                    return 0x11, off
-            elif self.match_keyword('C'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x0A, None
-                else:
-                    return 0x12, off
-            elif self.match_keyword('X'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x0B, None
-                else:
-                    return 0x13, off
-            elif self.match_keyword('Y'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x0C, None
-                else:
-                    return 0x14, off
-            elif self.match_keyword('Z'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x0D, None
-                else:
-                    return 0x15, off
-            elif self.match_keyword('I'):
-                off = self._parse_addition()
-                self.expect_token(']')
-                if off == 0:
-                    return 0x0E, None
-                else:
-                    return 0x16, off
-            elif self.match_keyword('J'):
+            if self.is_token(KeywordToken) and self.token.value in REGISTER_TABLE:
+                reg = REGISTER_TABLE[self.token.value]
+                self.next_token()
                 off = self._parse_addition()
                 self.expect_token(']')
                 if off == 0:
-                    return 0x0F, None
+                    return DEREF + reg, None
                 else:
-                    return 0x17, off
+                    return DEREF_OFFSET + reg, off
             elif self.match_keyword('SP'):
                 off = self._parse_addition()
                 self.expect_token(']')
                 if off == 0:
-                    return 0x19, None
+                    return PEEK, None
                 else:
-                    return 0x1A, off
+                    return PICK, off
             elif self.is_token(IntToken):
                 val = self.token.value
                 self.next_token()
                 self.expect_token(']')
-                return 0x1E, val
+                return DEREF_NEXT, val
             elif self.is_token(IdentToken):
                 val = self.token.value
                 self.next_token()
+                val = self._parse_label_offset(val)
                 self.expect_token(']')
-                return 0x1E, val
+                return DEREF_NEXT, val
             else:
                 assert False
-        elif self.is_token(IntToken):
-            val = self.token.value
+        elif self.is_token(IntToken) or self.is_token('-'):
+            negative = self.match_token('-')
+            if not self.is_token(IntToken):
+                self.report_fatal_error('expected a number')
+            val = -self.token.value if negative else self.token.value
             self.next_token()
-            # TODO this
-            if a and -1 <= val <= 30:
-                return 0x20 + (val + 1), None
-            else:
-                return 0x1F, val
+            return literal(val, a)
         elif self.is_token(IdentToken):
             val = self.token.value
             self.next_token()
-            return 0x1F, val
+            return NEXT, self._parse_label_offset(val)
         else:
             self.report_fatal_error('jwjwdwaduuihwadiuawd')
 
-    INST_TABLE = {
-        'SET': 0x01,
-        'ADD': 0x02,
-        'SUB': 0x03,
-        'MUL': 0x04,
-        'MLI': 0x05,
-        'DIV': 0x06,
-        'DVI': 0x07,
-        'MOD': 0x08,
-        'MDI': 0x09,
-        'AND': 0x0A,
-        'BOR': 0x0B,
-        'XOR': 0x0C,
-        'SHR': 0x0D,
-        'ASR': 0x0E,
-        'SHL': 0x0F,
-        'IFB': 0x10,
-        'IFC': 0x11,
-        'IFE': 0x12,
-        'IFN': 0x13,
-        'IFG': 0x14,
-        'IFA': 0x15,
-        'IFL': 0x16,
-        'IFU': 0x17,
-
-        'ADX': 0x1A,
-        'SBX': 0x1B,
-
-        'STI': 0x1E,
-        'STD': 0x1F
-    }
-
-    SPECIAL_INST_TABLE = {
-        'JSR': 0x01,
-
-        'INT': 0x08,
-        'IAG': 0x09,
-        'IAS': 0x0A,
-        'RFI': 0x0B,
-        'IAQ': 0x0C,
-
-        'HWN': 0x10,
-        'HWQ': 0x11,
-        'HWI': 0x12,
-    }
-
     def _parse_instruction(self):
         tok = self.token
         self.expect_token(KeywordToken)
         keyword = tok.value
         pos = tok.value
-        if keyword in Assembler.INST_TABLE:
-            opcode = Assembler.INST_TABLE[keyword]
+        if keyword in INST_TABLE:
             b, extra1 = self._parse_operand(False)
             self.expect_token(',')
             a, extra2 = self._parse_operand(True)
 
-            value = opcode | b << 5 | a << 10
-            self._emit_word(value)
+            self._emit_word(encode(keyword, b, a))
 
             if extra1 is not None:
-                if isinstance(extra1, str):
-                    self._use_label(extra1)
-                    self._emit_word(0)
-                else:
-                    self._emit_word(extra1)
+                self._emit_extra(extra1)
 
             if extra2 is not None:
-                if isinstance(extra2, str):
-                    self._use_label(extra2)
-                    self._emit_word(0)
-                else:
-                    self._emit_word(extra2)
+                self._emit_extra(extra2)
 
-        elif keyword in Assembler.SPECIAL_INST_TABLE:
-            opcode = Assembler.SPECIAL_INST_TABLE[keyword]
+        elif keyword in SPECIAL_INST_TABLE:
             a, extra = self._parse_operand(True)
 
-            value = 0 | opcode << 5 | a << 10
-            self._emit_word(value)
+            self._emit_word(encode(keyword, 0, a))
             if extra is not None:
-                if isinstance(extra, str):
-                    self._use_label(extra)
-                    self._emit_word(0)
-                else:
-                    self._emit_word(extra)
+                self._emit_extra(extra)
 
         else:
             self.report_fatal_error(f'expected an instruction', pos)
@@ -374,12 +209,15 @@ class Assembler(Tokenizer):
                     name, pos = self.expect_ident()
                     self._externs.append(name)
                 elif self.match_keyword('dw'):
-                    if self.is_token(IntToken):
-                        val = self.token.value
+                    if self.is_token(IntToken) or self.is_token('-'):
+                        negative = self.match_token('-')
+                        val = -self.token.value if negative else self.token.value
                         self.next_token()
                         self._emit_word(val)
                     elif self.is_token(IdentToken):
-                        assert False
+                        self._use_label(self.token.value)
+                        self.next_token()
+                        self._emit_word(0)
                     else:
                         self.report_error('invalid value for .dw')
             elif self.is_token(IdentToken):
@@ -0,0 +1,111 @@
+"""
+How DCPU16 instructions and their operands are encoded to words
+
+Used by the assembler for the text it parses and by the compiler for the
+instructions it generated, which it encodes without writing them out as text.
+"""
+
+INST_TABLE = {
+    'SET': 0x01,
+    'ADD': 0x02,
+    'SUB': 0x03,
+    'MUL': 0x04,
+    'MLI': 0x05,
+    'DIV': 0x06,
+    'DVI': 0x07,
+    'MOD': 0x08,
+    'MDI': 0x09,
+    'AND': 0x0A,
+    'BOR': 0x0B,
+    'XOR': 0x0C,
+    'SHR': 0x0D,
+    'ASR': 0x0E,
+    'SHL': 0x0F,
+    'IFB': 0x10,
+    'IFC': 0x11,
+    'IFE': 0x12,
+    'IFN': 0x13,
+    'IFG': 0x14,
+    'IFA': 0x15,
+    'IFL': 0x16,
+    'IFU': 0x17,
+
+    'ADX': 0x1A,
+    'SBX': 0x1B,
+
+    'STI': 0x1E,
+    'STD': 0x1F
+}
+
+SPECIAL_INST_TABLE = {
+    'JSR': 0x01,
+
+    'INT': 0x08,
+    'IAG': 0x09,
+    'IAS': 0x0A,
+    'RFI': 0x0B,
+    'IAQ': 0x0C,
+
+    'HWN': 0x10,
+    'HWQ': 0x11,
+    'HWI': 0x12,
+}
+
+# The general purpose registers, the value of the register itself, [register]
+# is 0x08 more and [register + next word] is 0x10 more
+REGISTER_TABLE = {
+    'A': 0,
+    'B': 1,
+    'C': 2,
+    'X': 3,
+    'Y': 4,
+    'Z': 5,
+    'I': 6,
+    'J': 7,
+}
+
+DEREF = 0x08
+DEREF_OFFSET = 0x10
+
+# PUSH in the b operand and POP in the a operand
+PUSH_POP = 0x18
+
+# [SP] and [SP + next word]
+PEEK = 0x19
+PICK = 0x1A
+
+SP = 0x1B
+PC = 0x1C
+EX = 0x1D
+
+# [next word] and next word
+DEREF_NEXT = 0x1E
+NEXT = 0x1F
+
+# -1 to 30 in the a operand
+LITERAL = 0x20
+
+
+def literal(val, a):
+    """
+    The operand value and the extra word of a number, a small number in the a operand
+    does not need the extra word
+    """
+    # 0xFFFF is the same word as -1
+    if val == 0xFFFF:
+        val = -1
+    if a and -1 <= val <= 30:
+        return LITERAL + (val + 1), None
+    else:
+        return NEXT, val
+
+
+def encode(inst, b, a):
+    """
+    The first word of an instruction from the values of its operands, b is not
+    used by the special instructions
+    """
+    if inst in INST_TABLE:
+        return INST_TABLE[inst] | b << 5 | a << 10
+    else:
+        return 0 | SPECIAL_INST_TABLE[inst] << 5 | a << 10
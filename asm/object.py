@@ -0,0 +1,95 @@
+from typing import *
+
+
+class ObjectWriter:
+    """
+    Builds an object out of words, the labels they use and the symbols they define
+
+    The object is the words, the global relocations (the extern symbol and the position
+    of the word its address is added to), the local relocations (positions of words which
+    have an address in this object) and the global symbols with their positions.
+    Subclasses report errors with report_error.
+    """
+
+    class LabelUse:
+
+        def __init__(self, name: str, pos: int):
+            self.pos = pos
+            self.name = name
+
+    def __init__(self):
+        self._lbl_uses = []  # type: List[ObjectWriter.LabelUse]
+        self._lbls = {}  # type: Dict[str, int]
+        self._words = []
+        self._pos = 0
+
+        self._externs = []
+        self._globals = {}
+
+        self._global_relocations = []
+        self._local_relocations = []
+
+    ####################################################################################################################
+    # Labels
+    ####################################################################################################################
+
+    def _mark_label(self, name: str):
+        self._lbls[name] = self._pos
+
+    def _use_label(self, name: str):
+        self._lbl_uses.append(ObjectWriter.LabelUse(name, self._pos))
+
+    def fix_labels(self):
+        orig = self._pos
+        unknown = []
+        for lbl in self._lbl_uses:
+            if lbl.name in self._lbls:
+                self._pos = lbl.pos
+                self._words[self._pos] += self._lbls[lbl.name]
+                self._local_relocations.append(lbl.pos)
+            else:
+                unknown.append(lbl)
+        self._pos = orig
+
+        for lbl in unknown:
+            if lbl.name not in self._externs:
+                self.report_error(f'undefined symbol `{lbl.name}` referenced')
+            else:
+                self._global_relocations.append((lbl.name, lbl.pos))
+
+        for glob in self._globals:
+            if glob not in self._lbls:
+                self.report_error(f'global defined for undefined symbol `{glob}`')
+            else:
+                self._globals[glob] = self._lbls[glob]
+
+    def get_object(self):
+        return self.get_words(), self._global_relocations, self._local_relocations, self._globals
+
+    ####################################################################################################################
+    # Words
+    ####################################################################################################################
+
+    def _emit_word(self, word):
+        self._words.append(word & 0xFFFF)
+        self._pos += 1
+
+    def _emit_extra(self, extra):
+        """
+        Emit the word after an instruction, a label (with a constant added to it
+        as a tuple) is resolved once all the labels are known
+        """
+        if isinstance(extra, tuple):
+            self._use_label(extra[0])
+            self._emit_word(extra[1])
+        elif isinstance(extra, str):
+            self._use_label(extra)
+            self._emit_word(0)
+        else:
+            self._emit_word(extra)
+
+    def get_words(self):
+        return self._words
+
+    def report_error(self, msg: str):
+        raise NotImplementedError()
@@ -1,4 +1,5 @@
 from enum import Enum, auto
+import re
 
 
 class Reg(Enum):
@@ -25,13 +26,24 @@ class Offset:
         self.offset = offset
 
     def __str__(self):
-        if self.offset < 0:
+        if isinstance(self.offset, str):
+            # The address of a label
+            return f'{self.a} + {self.offset}'
+        elif self.offset < 0:
             return f'{self.a} - {-self.offset}'
         elif self.offset == 0:
             return f'{self.a}'
         else:
             return f'{self.a} + {self.offset}'
 
+    def __eq__(self, other):
+        if self.offset == 0:
+            return self.a == other
+        return isinstance(other, Offset) and self.a == other.a and self.offset == other.offset
+
+    def __hash__(self):
+        return hash(self.a) if self.offset == 0 else hash((self.a, self.offset))
+
 
 class Deref:
 
@@ -41,45 +53,314 @@ class Deref:
     def __str__(self):
         return f'[{self.a}]'
 
+    def __eq__(self, other):
+        return isinstance(other, Deref) and self.a == other.a
+
+    def __hash__(self):
+        return hash(('[]', self.a))
+
 
 class Push:
 
     def __str__(self):
         return 'PUSH'
 
+    def __eq__(self, other):
+        return isinstance(other, Push)
+
+    def __hash__(self):
+        return hash('PUSH')
+
 
 class Pop:
 
     def __str__(self):
         return 'POP'
 
+    def __eq__(self, other):
+        return isinstance(other, Pop)
+
+    def __hash__(self):
+        return hash('POP')
+
+
+# Base cycle count of every instruction, not including the
+# extra cycle for every operand that reads the next word
+CYCLES = {
+    'SET': 1,
+    'ADD': 2,
+    'SUB': 2,
+    'MUL': 2,
+    'MLI': 2,
+    'DIV': 3,
+    'DVI': 3,
+    'MOD': 3,
+    'MDI': 3,
+    'AND': 1,
+    'BOR': 1,
+    'XOR': 1,
+    'SHR': 1,
+    'ASR': 1,
+    'SHL': 1,
+    'IFB': 2,
+    'IFC': 2,
+    'IFE': 2,
+    'IFN': 2,
+    'IFG': 2,
+    'IFA': 2,
+    'IFL': 2,
+    'IFU': 2,
+    'ADX': 3,
+    'SBX': 3,
+    'STI': 2,
+    'STD': 2,
+    'JSR': 3,
+    'INT': 4,
+    'IAG': 1,
+    'IAS': 1,
+    'RFI': 3,
+    'IAQ': 2,
+    'HWN': 2,
+    'HWQ': 4,
+    'HWI': 4,
+}
+
+
+def operand_words(op, a=True):
+    """
+    The amount of extra words (and cycles) an operand takes
+    """
+    if isinstance(op, int):
+        # Small literals are encoded in the a operand itself
+        return 0 if a and -1 <= op <= 30 else 1
+    elif isinstance(op, str):
+        return 1
+    elif isinstance(op, Offset):
+        return 0 if op.offset == 0 and isinstance(op.a, Reg) else 1
+    elif isinstance(op, Deref):
+        return operand_words(op.a, False)
+    else:
+        return 0
+
+
+def inst_cycles(inst, b=None, a=None):
+    """
+    Estimate the cycles an instruction takes
+    """
+    cycles = CYCLES[inst]
+    if a is not None:
+        cycles += operand_words(a)
+    if b is not None:
+        cycles += operand_words(b, False)
+    return cycles
+
+
+def inst_words(inst):
+    """
+    The amount of words an instruction takes
+    """
+    if len(inst.operands) == 2:
+        return 1 + operand_words(inst.operands[0], False) + operand_words(inst.operands[1])
+    return 1 + operand_words(inst.operands[0])
+
+
+REGISTERS = [Reg.A, Reg.B, Reg.C, Reg.X, Reg.Y, Reg.Z, Reg.I, Reg.J]
+
+# Registers a function we can't see may change
+CALLER_SAVED = {Reg.A, Reg.B, Reg.C}
+
+# The instructions which skip the next one when the test fails
+SKIPS = {'IFB', 'IFC', 'IFE', 'IFN', 'IFG', 'IFA', 'IFL', 'IFU'}
+
+# The lines which are not instructions, in place of the name of the instruction
+LABEL = ':'
+WORD = '.dw'
+STRING = '.ascii'
+GLOBAL = '.global'
+EXTERN = '.extern'
+BLANK = ''
+
+LOCAL_LABEL = re.compile(r'^_l\d+$')
+
+
+def canonical(op):
+    """
+    The operand with offsets of 0 left out, so the same operand is always made of the same parts
+    """
+    if isinstance(op, Offset) and op.offset == 0:
+        return canonical(op.a)
+    elif isinstance(op, Deref) and isinstance(op.a, Offset) and op.a.offset == 0:
+        return Deref(canonical(op.a.a))
+    return op
+
+
+def spilled_address(op):
+    """
+    The stack slot of an address which was spilled and is dereferenced, `[[slot]]` or
+    `[[slot] + offset]`, which is not an operand the DCPU16 has, or None
+    """
+    if isinstance(op, Deref):
+        addr = op.a.a if isinstance(op.a, Offset) else op.a
+        if isinstance(addr, Deref):
+            return addr
+    return None
+
+
+def operand_regs(op):
+    """
+    The registers an operand reads (or reads to get to the memory it points to)
+    """
+    if isinstance(op, Reg):
+        return {op}
+    elif isinstance(op, Deref):
+        return operand_regs(op.a)
+    elif isinstance(op, Offset):
+        return operand_regs(op.a) | operand_regs(op.offset)
+    return set()
+
+
+def operand_labels(op):
+    """
+    The labels an operand refers to
+    """
+    if isinstance(op, str):
+        return [op]
+    elif isinstance(op, Deref):
+        return operand_labels(op.a)
+    elif isinstance(op, Offset):
+        return operand_labels(op.a) + operand_labels(op.offset)
+    return []
+
+
+def rename_label(op, old, new):
+    """
+    The operand with the label old replaced by new
+    """
+    if op == old and isinstance(op, str):
+        return new
+    elif isinstance(op, Deref):
+        return Deref(rename_label(op.a, old, new))
+    elif isinstance(op, Offset):
+        return Offset(rename_label(op.a, old, new), rename_label(op.offset, old, new))
+    return op
+
+
+def is_stack_ref(op):
+    """
+    Does the operand point into the stack
+    """
+    return isinstance(op, Deref) and Reg.SP in operand_regs(op)
+
+
+def is_local_label(name):
+    return isinstance(name, str) and LOCAL_LABEL.match(name) is not None
+
+
+def table_label(operand):
+    """
+    The label of the table an operand reads a jump target from, or None
+    """
+    if isinstance(operand, Deref) and isinstance(operand.a, Offset) and isinstance(operand.a.a, Reg) and \
+            is_local_label(operand.a.offset):
+        return operand.a.offset
+    return None
+
+
+class Inst:
+    """
+    A single line of the generated code, op is the name of the instruction (or one of the
+    kinds of lines above) and operands are the operands in the order they are written,
+    the b operand first. Once made it is never changed, so the same one can be in more
+    than one place.
+    """
+
+    __slots__ = ('op', 'operands')
+
+    def __init__(self, op, *operands):
+        self.op = op
+        self.operands = operands
+
+    @property
+    def is_instruction(self):
+        return self.op in CYCLES
+
+    @property
+    def is_skip(self):
+        return self.op in SKIPS
+
+    @property
+    def is_data(self):
+        return self.op == WORD or self.op == STRING
+
+    @property
+    def label(self):
+        """
+        The name of the label this line marks, or None
+        """
+        return self.operands[0] if self.op == LABEL else None
+
+    def labels(self):
+        """
+        The labels this line refers to
+        """
+        if not self.is_instruction and self.op != WORD:
+            return []
+        return [name for op in self.operands for name in operand_labels(op)]
+
+    def renamed(self, old, new):
+        return Inst(self.op, *[rename_label(op, old, new) for op in self.operands])
+
+    def __eq__(self, other):
+        return isinstance(other, Inst) and self.op == other.op and self.operands == other.operands
+
+    def __hash__(self):
+        return hash((self.op, self.operands))
+
+    def __str__(self):
+        if self.op == LABEL:
+            return f'{self.operands[0]}:'
+        elif self.op == STRING:
+            return f'.ascii z{repr(self.operands[0])}'
+        elif self.op == BLANK:
+            return ''
+        return f'{self.op} ' + ', '.join([str(op) for op in self.operands])
+
+    def __repr__(self):
+        return f'Inst({str(self)!r})'
+
+
+def render(insts):
+    """
+    The text of the instructions, for -S
+    """
+    return '\n'.join([str(inst) for inst in insts])
+
 
 class Assembler:
 
     def __init__(self):
         self._insts = []
         self._lbl_id_gen = 0
-        self._pos = 0
 
     def put_instruction(self, inst):
-        if self._pos < len(self._insts):
-            self._insts[self._pos] = inst
-        else:
-            self._insts.append(inst)
-        self._pos += 1
+        self._insts.append(inst)
+
+    def put_instructions(self, insts):
+        self._insts.extend(insts)
 
     def get_pos(self) -> int:
-        return self._pos
+        return len(self._insts)
 
-    def set_pos(self, pos: int):
-        self._pos = pos
+    def take_instructions(self, pos):
+        """
+        Remove all the instructions from pos onwards and return them
+        """
+        insts = self._insts[pos:]
+        del self._insts[pos:]
+        return insts
 
     def get_instructions(self):
-        ret = []
-        for inst in self._insts:
-            if not inst.startswith(';;'):
-                ret.append(inst)
-        return ret
+        return list(self._insts)
 
     def make_label(self):
         id = self._lbl_id_gen
@@ -87,183 +368,233 @@ class Assembler:
         return f'_l{id}'
 
     def mark_label(self, lbl):
-        self.put_instruction(f'{lbl}:')
+        self.put_instruction(Inst(LABEL, lbl))
 
     def make_and_mark_label(self):
         lbl = self.make_label()
         self.mark_label(lbl)
         return lbl
 
+    def emit_blank(self):
+        self.put_instruction(Inst(BLANK))
+
+    def emit_global(self, name):
+        self.put_instruction(Inst(GLOBAL, name))
+
+    def emit_extern(self, name):
+        self.put_instruction(Inst(EXTERN, name))
+
     def emit_word(self, word):
         if isinstance(word, list):
-            word = ', '.join(word)
-        self.put_instruction(f'.dw {word}')
+            self.put_instruction(Inst(WORD, *word))
+        else:
+            self.put_instruction(Inst(WORD, word))
 
     def emit_string(self, str):
-        self.put_instruction(f'.ascii z{repr(str)}')
+        self.put_instruction(Inst(STRING, str))
+
+    def _swap(self, reg, slot):
+        self.put_instruction(Inst('XOR', reg, slot))
+        self.put_instruction(Inst('XOR', slot, reg))
+        self.put_instruction(Inst('XOR', reg, slot))
+
+    def _emit(self, op, *operands):
+        operands = [canonical(operand) for operand in operands]
+
+        slots = []
+        for operand in operands:
+            slot = spilled_address(operand)
+            if slot is not None and slot not in slots:
+                slots.append(slot)
+
+        if len(slots) == 0:
+            self.put_instruction(Inst(op, *operands))
+            return
+
+        # A scratch register with an address was spilled to the stack, it is swapped with a
+        # register none of the operands use for the instruction and swapped back after it,
+        # which is never done to a skip or to something behind one
+        assert op not in SKIPS and not (len(self._insts) > 0 and self._insts[-1].is_skip)
+        assert not any([operand in slots or isinstance(operand, Push) or isinstance(operand, Pop)
+                        for operand in operands])
+        used = set().union(*[operand_regs(operand) for operand in operands])
+        regs = [reg for reg in REGISTERS if reg not in used][:len(slots)]
+
+        def unspill(operand):
+            slot = spilled_address(operand)
+            if slot is None:
+                return operand
+            reg = regs[slots.index(slot)]
+            return Deref(Offset(reg, operand.a.offset)) if isinstance(operand.a, Offset) else Deref(reg)
+
+        for reg, slot in zip(regs, slots):
+            self._swap(reg, slot)
+        self.put_instruction(Inst(op, *[canonical(unspill(operand)) for operand in operands]))
+        for reg, slot in zip(regs[::-1], slots[::-1]):
+            self._swap(reg, slot)
 
     def emit_set(self, b, a):
-        if str(a) == str(b):
+        if a == b:
             pass
         else:
-            self.put_instruction(f'SET {b}, {a}')
+            self._emit('SET', b, a)
 
     def emit_add(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'ADD {b}, {a}')
+        self._emit('ADD', b, a)
 
     def emit_sub(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'SUB {b}, {a}')
+        self._emit('SUB', b, a)
 
     def emit_mul(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'MUL {b}, {a}')
+        self._emit('MUL', b, a)
 
     def emit_mli(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'MLI {b}, {a}')
+        self._emit('MLI', b, a)
 
     def emit_div(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'DIV {b}, {a}')
+        self._emit('DIV', b, a)
 
     def emit_dvi(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'DVI {b}, {a}')
+        self._emit('DVI', b, a)
 
     def emit_mod(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'MOD {b}, {a}')
+        self._emit('MOD', b, a)
 
     def emit_mdi(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'MDI {b}, {a}')
+        self._emit('MDI', b, a)
 
     def emit_and(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'AND {b}, {a}')
+        self._emit('AND', b, a)
 
     def emit_bor(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'BOR {b}, {a}')
+        self._emit('BOR', b, a)
 
     def emit_xor(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'XOR {b}, {a}')
+        self._emit('XOR', b, a)
 
     def emit_shr(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'SHR {b}, {a}')
+        self._emit('SHR', b, a)
 
     def emit_asr(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'ASR {b}, {a}')
+        self._emit('ASR', b, a)
 
     def emit_shl(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'SHL {b}, {a}')
+        self._emit('SHL', b, a)
 
     def emit_ifb(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFB {b}, {a}')
+        self._emit('IFB', b, a)
 
     def emit_ifc(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFC {b}, {a}')
+        self._emit('IFC', b, a)
 
     def emit_ife(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFE {b}, {a}')
+        self._emit('IFE', b, a)
 
     def emit_ifn(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFN {b}, {a}')
+        self._emit('IFN', b, a)
 
     def emit_ifg(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFG {b}, {a}')
+        self._emit('IFG', b, a)
 
     def emit_ifa(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFA {b}, {a}')
+        self._emit('IFA', b, a)
 
     def emit_ifl(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFL {b}, {a}')
+        self._emit('IFL', b, a)
 
     def emit_ifu(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'IFU {b}, {a}')
+        self._emit('IFU', b, a)
 
     def emit_adx(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'ADX {b}, {a}')
+        self._emit('ADX', b, a)
 
     def emit_sbx(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'SBX {b}, {a}')
+        self._emit('SBX', b, a)
 
     def emit_sti(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'STI {b}, {a}')
+        self._emit('STI', b, a)
 
     def emit_std(self, b, a):
         assert b is not None
         assert a is not None
-        self.put_instruction(f'STD {b}, {a}')
+        self._emit('STD', b, a)
 
     def emit_jsr(self, a):
         assert a is not None
-        self.put_instruction(f'JSR {a}')
+        self._emit('JSR', a)
 
     def emit_int(self, a):
         assert a is not None
-        self.put_instruction(f'INT {a}')
+        self._emit('INT', a)
 
     def emit_iag(self, a):
         assert a is not None
-        self.put_instruction(f'IAG {a}')
+        self._emit('IAG', a)
 
     def emit_ias(self, a):
-        self.put_instruction(f'IAS {a}')
+        self._emit('IAS', a)
 
     def emit_rfi(self, a):
-        self.put_instruction(f'RFI {a}')
+        self._emit('RFI', a)
 
     def emit_iaq(self, a):
-        self.put_instruction(f'IAQ {a}')
+        self._emit('IAQ', a)
 
     def emit_hwn(self, a):
-        self.put_instruction(f'HWN {a}')
+        self._emit('HWN', a)
 
     def emit_hwq(self, a):
-        self.put_instruction(f'HWQ {a}')
+        self._emit('HWQ', a)
 
     def emit_hwi(self, a):
-        self.put_instruction(f'HWI {a}')
+        self._emit('HWI', a)
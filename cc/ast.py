@@ -174,24 +174,36 @@ class ExprBinary(Expr):
         self.right = right
 
     def resolve_type(self, ast):
+        if self.op in ['==', '!=', '||', '&&', '<=', '>=', '<', '>', '!']:
+            # Logical operations always return an int (which is signed, like
+            # in C), no need to look at the operands (which might be statements,
+            # like for `if`)
+            return CInteger(16, True)
+
         ltyp = self.left.resolve_type(ast)
         rtyp = self.right.resolve_type(ast)
 
         if self.op in ['+', '-']:
             # just use the type of the left element unless the right is a pointer
-            # and then use the right
+            # and then use the right, or a bigger integer
             if isinstance(rtyp, CPointer):
                 return rtyp
+            elif isinstance(ltyp, CInteger) and isinstance(rtyp, CInteger) and rtyp.sizeof() > ltyp.sizeof():
+                return rtyp
             else:
                 return ltyp
-        elif self.op in ['==', '||', '&&', '<=', '>=', '<', '>', '!']:
-            # Logical operations always return an int
-            # TODO: Make it return a boolean instead
-            return CInteger(16, False)
-        elif self.op in ['|', '~', '&', '^', '<<', '>>', '*', '/', '%']:
-            # All these are arith operators and they return the larger value
+        elif self.op in ['<<', '>>']:
+            # The type of what is shifted
+            return ltyp
+        elif self.op in ['|', '~', '&', '^', '*', '/', '%']:
+            # All these are arith operators and they return the larger value,
+            # if both are the same size unsigned wins
             if ltyp.sizeof() > rtyp.sizeof():
                 return ltyp
+            elif ltyp.sizeof() < rtyp.sizeof():
+                return rtyp
+            elif isinstance(ltyp, CInteger) and not ltyp.signed:
+                return ltyp
             else:
                 return rtyp
         else:
@@ -223,16 +235,23 @@ class ExprCast(Expr):
     def is_constant(self, parser):
         return self.expr.is_constant(parser)
 
-    def __str__(self):
-        return f'(cast {self.expr} {self.typ})'
+    def __str__(self, ident=''):
+        return ident + f'(cast {self.expr} {self.typ})'
 
 
 class ExprLoop(Expr):
+    """
+    Runs the body as long as the condition holds, the step runs after every iteration
+    (continue goes to it as well), if post_test is set the body runs once before the
+    condition is tested the first time
+    """
 
-    def __init__(self, cond: Expr, body: Expr, pos=None):
+    def __init__(self, cond: Expr, body: Expr, pos=None, step: Expr = None, post_test=False):
         self.pos = pos
         self.cond = cond
         self.body = body
+        self.step = ExprNop() if step is None else step
+        self.post_test = post_test
 
     def is_pure(self, parser):
         return False
@@ -241,7 +260,10 @@ class ExprLoop(Expr):
         return False
 
     def __str__(self, ident=''):
-        return ident + f'(loop {self.cond} {self.body})'
+        name = 'do' if self.post_test else 'loop'
+        if isinstance(self.step, ExprNop):
+            return ident + f'({name} {self.cond} {self.body})'
+        return ident + f'({name} {self.cond} {self.body} {self.step})'
 
 
 class ExprBreak(Expr):
@@ -274,6 +296,45 @@ class ExprContinue(Expr):
         return ident + f'(continue)'
 
 
+class ExprSwitch(Expr):
+
+    def __init__(self, expr: Expr, body: Expr, pos=None):
+        self.pos = pos
+        self.expr = expr
+        self.body = body
+
+    def is_pure(self, parser):
+        return False
+
+    def is_constant(self, parser):
+        return False
+
+    def __str__(self, ident=''):
+        return ident + f'(switch {self.expr} {self.body})'
+
+
+class ExprCase(Expr):
+    """
+    Where a case (or the default if the value is None) of the switch around it starts,
+    the parser only puts them directly in the body of a switch
+    """
+
+    def __init__(self, value, pos=None):
+        self.pos = pos
+        self.value = value
+
+    def is_pure(self, parser):
+        return False
+
+    def is_constant(self, parser):
+        return False
+
+    def __str__(self, ident=''):
+        if self.value is None:
+            return ident + '(default)'
+        return ident + f'(case {self.value})'
+
+
 class ExprAddrof(Expr):
 
     def __init__(self, expr: ExprIdent, pos=None):
@@ -345,7 +406,7 @@ class ExprCall(Expr):
     def is_pure(self, parser):
         if isinstance(self.func, ExprIdent) and isinstance(self.func.ident, FunctionIdentifier):
             called_function = parser.func_list[self.func.ident.index]
-            return called_function.pure_known and called_function.pure and len([x for x in self.args if x.is_pure(parser)]) == 0
+            return called_function.pure_known and called_function.pure and all([x.is_pure(parser) for x in self.args])
         return False
 
     def is_constant(self, parser):
@@ -462,6 +523,9 @@ class Variable:
         self.storage = storage
         self.value = None
 
+        # Unused static variables are not emitted
+        self.used = True
+
 
 class Function:
 
@@ -478,6 +542,9 @@ class Function:
         self.pure = False
         self.pure_known = False
 
+        # Unused static functions are not emitted
+        self.used = True
+
     def __str__(self):
         return f'(func {self.name}\n {self.code.__str__(" ")})'
 
@@ -0,0 +1,93 @@
+"""
+Evaluation of constant expressions with the 16bit semantics of the DCPU16
+
+Values wrap around at 16 bits (32 bits for longs), and the operands and the
+result are treated as signed or unsigned like the C operator would treat them.
+Division by zero gives 0, just like DIV/DVI/MOD/MDI do on the hardware.
+"""
+import operator
+
+
+def to_unsigned(value, bits=16):
+    return value & ((1 << bits) - 1)
+
+
+def to_signed(value, bits=16):
+    value = to_unsigned(value, bits)
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def wrap(value, signed, bits=16):
+    """
+    Wrap a value to a signed or unsigned word (or a pair of them)
+    """
+    return to_signed(value, bits) if signed else to_unsigned(value, bits)
+
+
+def _div(a, b):
+    # Rounds towards zero, like C and DVI
+    if b == 0:
+        return 0
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def _mod(a, b):
+    # The sign follows the dividend, like C and MDI
+    if b == 0:
+        return 0
+    return a - _div(a, b) * b
+
+
+def _shl(a, b, bits=16):
+    return a << b if 0 <= b < bits else 0
+
+
+def _shr(a, b, bits=16):
+    if 0 <= b < bits:
+        return a >> b
+    # Shifting everything out of a signed value leaves the sign
+    return -1 if a < 0 else 0
+
+
+OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': _div,
+    '%': _mod,
+    '&': operator.and_,
+    '|': operator.or_,
+    '^': operator.xor,
+    '<<': _shl,
+    '>>': _shr,
+    '==': lambda a, b: int(a == b),
+    '!=': lambda a, b: int(a != b),
+    '<': lambda a, b: int(a < b),
+    '<=': lambda a, b: int(a <= b),
+    '>': lambda a, b: int(a > b),
+    '>=': lambda a, b: int(a >= b),
+    '&&': lambda a, b: int(a != 0 and b != 0),
+    '||': lambda a, b: int(a != 0 or b != 0),
+}
+
+# The opposite of every comparison
+NEGATED = {'==': '!=', '!=': '==', '<': '>=', '>=': '<', '>': '<=', '<=': '>'}
+
+# Every comparison with its operands swapped
+MIRRORED = {'==': '==', '!=': '!=', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+
+def evaluate(op, left, right, signed=True, bits=16):
+    """
+    Evaluate a binary operator on two constant words, signed says if the
+    operands are signed (which is only the case if both of them are), bits
+    is 32 when the operation is done on longs
+    """
+    convert = to_signed if signed else to_unsigned
+    left, right = convert(left, bits), convert(right, bits)
+    if op == '<<':
+        return convert(_shl(left, right, bits), bits)
+    elif op == '>>':
+        return convert(_shr(left, right, bits), bits)
+    return convert(OPERATORS[op](left, right), bits)
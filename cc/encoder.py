@@ -0,0 +1,114 @@
+"""
+Encoding the instructions the translator generated straight into an object
+
+The words, relocations and symbols are the same as the assembler makes from the
+text of the instructions, but nothing is written out and parsed back.
+"""
+from asm.encoding import *
+from asm.object import ObjectWriter
+
+from .assembler import Reg, Offset, Deref, Push, Pop, LABEL, WORD, STRING, GLOBAL, EXTERN
+
+# The registers which are not in the general purpose register table
+SPECIAL_REGISTERS = {
+    Reg.SP: SP,
+    Reg.PC: PC,
+    Reg.EX: EX,
+}
+
+
+class Encoder(ObjectWriter):
+
+    def __init__(self, insts, filename='<unknown>'):
+        super(Encoder, self).__init__()
+        self.filename = filename
+        self.got_errors = False
+
+        self._insts = insts
+
+    ####################################################################################################################
+    # Error reporting
+    ####################################################################################################################
+
+    BOLD = '\033[01m'
+    RESET = '\033[0m'
+    RED = '\033[31m'
+
+    def report_error(self, msg: str):
+        print(f'{Encoder.BOLD}{self.filename}:{Encoder.RESET} {Encoder.RED}{Encoder.BOLD}error:{Encoder.RESET} {msg}')
+        self.got_errors = True
+
+    ####################################################################################################################
+    # Encoding
+    ####################################################################################################################
+
+    def _register(self, reg):
+        if reg in SPECIAL_REGISTERS:
+            return SPECIAL_REGISTERS[reg]
+        return REGISTER_TABLE[reg.value]
+
+    def _encode_operand(self, op, a: bool):
+        """
+        The value of the operand and the word after the instruction it needs, if any
+        """
+        if isinstance(op, Push) or isinstance(op, Pop):
+            return PUSH_POP, None
+        elif isinstance(op, Reg):
+            return self._register(op), None
+        elif isinstance(op, int):
+            return literal(op, a)
+        elif isinstance(op, str):
+            return NEXT, op
+        elif isinstance(op, Offset):
+            # The address of a label with a constant added to it
+            return NEXT, (op.a, op.offset)
+        elif isinstance(op, Deref):
+            addr = op.a
+            if addr == Reg.SP:
+                return PEEK, None
+            elif isinstance(addr, Reg):
+                return DEREF + self._register(addr), None
+            elif isinstance(addr, Offset) and addr.a == Reg.SP:
+                return PICK, addr.offset
+            elif isinstance(addr, Offset) and isinstance(addr.a, Reg):
+                return DEREF_OFFSET + self._register(addr.a), addr.offset
+            elif isinstance(addr, Offset):
+                return DEREF_NEXT, (addr.a, addr.offset)
+            else:
+                return DEREF_NEXT, addr
+        else:
+            assert False, f'`{op}` ({type(op)})'
+
+    def _encode_instruction(self, inst):
+        if inst.op in INST_TABLE:
+            b, extra1 = self._encode_operand(inst.operands[0], False)
+            a, extra2 = self._encode_operand(inst.operands[1], True)
+        else:
+            b, extra1 = 0, None
+            a, extra2 = self._encode_operand(inst.operands[0], True)
+
+        self._emit_word(encode(inst.op, b, a))
+
+        if extra1 is not None:
+            self._emit_extra(extra1)
+
+        if extra2 is not None:
+            self._emit_extra(extra2)
+
+    def encode(self):
+        for inst in self._insts:
+            if inst.is_instruction:
+                self._encode_instruction(inst)
+            elif inst.op == LABEL:
+                self._mark_label(inst.operands[0])
+            elif inst.op == WORD:
+                for word in inst.operands:
+                    self._emit_extra(word)
+            elif inst.op == STRING:
+                for c in inst.operands[0]:
+                    self._emit_word(ord(c))
+                self._emit_word(0)
+            elif inst.op == GLOBAL:
+                self._globals[inst.operands[0]] = 0
+            elif inst.op == EXTERN:
+                self._externs.append(inst.operands[0])
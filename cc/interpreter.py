@@ -0,0 +1,388 @@
+"""
+Running calls to pure functions at compile time
+
+The function is run on its tree. Every local is a list of words, a word holds a number
+(unsigned, like in memory) or a pointer, and a pointer is the words of the object it
+points into with an offset in them. Only the locals of the functions being run and the
+globals nothing ever writes to can be read, anything else (or anything that would
+depend on where things are in memory) leaves the call for the runtime.
+"""
+from .ast import *
+from .constant import *
+
+
+# How many expressions running a single call may go through before it is left for the runtime
+STEP_LIMIT = 20000
+
+# How deep calls may nest while running a call
+CALL_DEPTH_LIMIT = 32
+
+
+class NotConstant(Exception):
+    pass
+
+
+class Jump(Exception):
+    """
+    A break, continue or return, it goes up to the loop, switch or call it leaves
+    """
+
+    def __init__(self, kind, value=None):
+        super(Jump, self).__init__()
+        self.kind = kind
+        self.value = value
+
+
+class Pointer:
+
+    def __init__(self, words, offset):
+        self.words = words
+        self.offset = offset
+
+    def __eq__(self, other):
+        return isinstance(other, Pointer) and other.words is self.words and other.offset == self.offset
+
+
+class Interpreter:
+    """
+    Runs pure functions on constant arguments, read_only has the indexes of the globals
+    whose value is known to be the one they are initialized with
+    """
+
+    def __init__(self, parser, read_only):
+        self.parser = parser
+        self.read_only = read_only
+        self.steps = 0
+        self.depth = 0
+        self._frame = None
+        self._globals = {}
+
+    def call(self, func, args):
+        """
+        The value the function returns for the arguments, or None if it is not known
+        """
+        try:
+            value = self._call(func, args)
+        except NotConstant:
+            return None
+
+        if isinstance(value, Pointer):
+            return None
+        return value
+
+    def _call(self, func, args):
+        if func.prototype or not func.pure or self.depth == CALL_DEPTH_LIMIT:
+            raise NotConstant()
+
+        frame, self._frame = self._frame, {}
+        saved = self.parser.func
+        self.parser.func = func
+        self.depth += 1
+        try:
+            for index, (typ, value) in enumerate(zip(func.type.param_types, args)):
+                self._store(Pointer(self._storage(ParameterIdentifier(None, index)), 0), typ, value)
+            self._run(func.code)
+            value = None
+        except Jump as jump:
+            if jump.kind != 'return':
+                raise NotConstant()
+            value = jump.value
+        finally:
+            self.depth -= 1
+            self.parser.func = saved
+            self._frame = frame
+
+        if isinstance(func.type.ret_type, CVoid):
+            return None
+        return self._convert(value, func.type.ret_type)
+
+    ####################################################################################################################
+    # Memory
+    ####################################################################################################################
+
+    def _storage(self, ident):
+        """
+        The words of a local (or of a global nothing writes to), made when first used
+        """
+        if isinstance(ident, GlobalIdentifier):
+            if ident.index not in self.read_only:
+                raise NotConstant()
+            if ident.index not in self._globals:
+                var = self.parser.global_vars[ident.index]
+                self._globals[ident.index] = self._initial_words(var.typ, var.value)
+            return self._globals[ident.index]
+
+        if isinstance(ident, VariableIdentifier):
+            var = self.parser.func.vars[ident.index]
+            if var.storage == StorageClass.STATIC:
+                raise NotConstant()
+            typ = var.typ
+        elif isinstance(ident, ParameterIdentifier):
+            typ = self.parser.func.type.param_types[ident.index]
+        else:
+            raise NotConstant()
+
+        key = type(ident).__name__, ident.index
+        if key not in self._frame:
+            # Nothing is known about a local before it is written
+            self._frame[key] = [None] * typ.sizeof()
+        return self._frame[key]
+
+    def _initial_words(self, typ, value):
+        words = [0] * typ.sizeof()
+        values = value if isinstance(value, list) else [value]
+        element = typ.type if isinstance(typ, CArray) else typ
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            if not isinstance(value, int) or not isinstance(element, CInteger):
+                raise NotConstant()
+            self._store(Pointer(words, i * element.sizeof()), element, value)
+        return words
+
+    def _load(self, pointer, typ):
+        if not isinstance(pointer, Pointer) or typ.volatile:
+            raise NotConstant()
+        if pointer.offset < 0 or pointer.offset + typ.sizeof() > len(pointer.words):
+            raise NotConstant()
+
+        words = pointer.words[pointer.offset:pointer.offset + typ.sizeof()]
+        if isinstance(typ, CPointer):
+            if words[0] is None:
+                raise NotConstant()
+            return words[0]
+        elif isinstance(typ, CInteger):
+            if any([not isinstance(word, int) for word in words]):
+                raise NotConstant()
+            # The low word comes first
+            value = 0
+            for word in reversed(words):
+                value = (value << 16) | word
+            return wrap(value, typ.signed, typ.bits)
+        raise NotConstant()
+
+    def _store(self, pointer, typ, value):
+        if not isinstance(pointer, Pointer) or typ.volatile:
+            raise NotConstant()
+        if pointer.offset < 0 or pointer.offset + typ.sizeof() > len(pointer.words):
+            raise NotConstant()
+
+        if isinstance(typ, CPointer):
+            pointer.words[pointer.offset] = value
+        elif isinstance(typ, CInteger) and isinstance(value, int):
+            for i in range(typ.sizeof()):
+                pointer.words[pointer.offset + i] = to_unsigned(value >> (16 * i))
+        else:
+            raise NotConstant()
+
+    def _convert(self, value, typ):
+        """
+        The value as the type, like assigning it does
+        """
+        if isinstance(typ, CInteger):
+            if not isinstance(value, int):
+                raise NotConstant()
+            return wrap(value, typ.signed, typ.bits)
+        elif isinstance(typ, CPointer):
+            if value is None:
+                raise NotConstant()
+            return value
+        raise NotConstant()
+
+    def _address(self, expr):
+        """
+        Where the object the expression names is
+        """
+        if isinstance(expr, ExprIdent):
+            return Pointer(self._storage(expr.ident), 0)
+        elif isinstance(expr, ExprDeref):
+            return self._run(expr.expr)
+        raise NotConstant()
+
+    ####################################################################################################################
+    # Running
+    ####################################################################################################################
+
+    def _truth(self, value):
+        if isinstance(value, Pointer):
+            return True
+        if not isinstance(value, int):
+            raise NotConstant()
+        return value != 0
+
+    def _binary(self, expr):
+        if expr.op in ['&&', '||']:
+            # Only run the right side when the left does not decide
+            if self._truth(self._run(expr.left)) == (expr.op == '||'):
+                return int(expr.op == '||')
+            return int(self._truth(self._run(expr.right)))
+
+        left = self._run(expr.left)
+        right = self._run(expr.right)
+        ltyp = expr.left.resolve_type(self.parser)
+        rtyp = expr.right.resolve_type(self.parser)
+
+        if isinstance(left, Pointer) or isinstance(right, Pointer):
+            return self._pointer_binary(expr.op, left, right)
+
+        if not isinstance(left, int) or not isinstance(right, int):
+            raise NotConstant()
+
+        # Pointers which are numbers are unsigned words
+        if not isinstance(ltyp, CInteger):
+            ltyp = CInteger(16, False)
+        if not isinstance(rtyp, CInteger):
+            rtyp = CInteger(16, False)
+
+        # The same conversions the constant folding does
+        if expr.op in ['<<', '>>']:
+            signed, bits = ltyp.signed, ltyp.bits
+        elif ltyp.bits == rtyp.bits:
+            signed, bits = ltyp.signed and rtyp.signed, ltyp.bits
+        else:
+            signed = ltyp.signed if ltyp.bits > rtyp.bits else rtyp.signed
+            bits = max(ltyp.bits, rtyp.bits)
+        value = evaluate(expr.op, left, right, signed, bits)
+
+        typ = expr.resolve_type(self.parser)
+        if isinstance(typ, CInteger):
+            return wrap(value, typ.signed, typ.bits)
+        return to_unsigned(value)
+
+    def _pointer_binary(self, op, left, right):
+        if isinstance(left, Pointer) and isinstance(right, int) and op in ['+', '-']:
+            return Pointer(left.words, left.offset + (right if op == '+' else -right))
+        elif isinstance(right, Pointer) and isinstance(left, int) and op == '+':
+            return Pointer(right.words, right.offset + left)
+        elif isinstance(left, Pointer) and isinstance(right, Pointer) and left.words is right.words:
+            if op == '-':
+                return to_signed(left.offset - right.offset)
+            elif op in NEGATED:
+                return evaluate(op, left.offset, right.offset, False)
+        elif op in ['==', '!=']:
+            # Two different objects, or an object and null, are never at the same place
+            if isinstance(left, Pointer) and isinstance(right, Pointer) or left == 0 or right == 0:
+                return int(op == '!=')
+        raise NotConstant()
+
+    def _switch(self, expr):
+        value = self._run(expr.expr)
+        if not isinstance(value, int):
+            raise NotConstant()
+
+        stmts = expr.body.exprs if isinstance(expr.body, ExprComma) else [expr.body]
+        start = None
+        for i, stmt in enumerate(stmts):
+            if isinstance(stmt, ExprCase):
+                if stmt.value == value:
+                    start = i
+                    break
+                elif stmt.value is None:
+                    start = i
+        if start is None:
+            return
+
+        try:
+            for stmt in stmts[start:]:
+                self._run(stmt)
+        except Jump as jump:
+            if jump.kind != 'break':
+                raise
+
+    def _loop(self, expr):
+        first = True
+        while expr.post_test and first or self._truth(self._run(expr.cond)):
+            first = False
+            try:
+                self._run(expr.body)
+            except Jump as jump:
+                if jump.kind == 'break':
+                    break
+                elif jump.kind != 'continue':
+                    raise
+            self._run(expr.step)
+
+    def _run(self, expr):
+        """
+        Run the expression, returns its value (None for statements)
+        """
+        self.steps += 1
+        if self.steps > STEP_LIMIT:
+            raise NotConstant()
+
+        if isinstance(expr, ExprNumber):
+            # Kept as it is written, a number too big for its type is used like the translator does
+            return expr.value
+
+        elif isinstance(expr, ExprIdent):
+            typ = expr.resolve_type(self.parser)
+            if isinstance(typ, CArray) or isinstance(typ, CStruct):
+                # Only their address can be used
+                return Pointer(self._storage(expr.ident), 0)
+            return self._load(Pointer(self._storage(expr.ident), 0), typ)
+
+        elif isinstance(expr, ExprAddrof):
+            return self._address(expr.expr)
+
+        elif isinstance(expr, ExprDeref):
+            return self._load(self._run(expr.expr), expr.resolve_type(self.parser))
+
+        elif isinstance(expr, ExprCast):
+            value = self._run(expr.expr)
+            if isinstance(expr.typ, CVoid):
+                return None
+            return self._convert(value, expr.typ)
+
+        elif isinstance(expr, ExprBinary):
+            return self._binary(expr)
+
+        elif isinstance(expr, ExprCopy):
+            typ = expr.destination.resolve_type(self.parser)
+            destination = self._address(expr.destination)
+            if isinstance(typ, CStruct) or isinstance(typ, CArray):
+                # The whole object is copied word by word
+                source = self._address(expr.source)
+                if not isinstance(destination, Pointer) or not isinstance(source, Pointer) or \
+                        source.offset < 0 or source.offset + typ.sizeof() > len(source.words) or \
+                        destination.offset < 0 or destination.offset + typ.sizeof() > len(destination.words):
+                    raise NotConstant()
+                words = source.words[source.offset:source.offset + typ.sizeof()]
+                destination.words[destination.offset:destination.offset + typ.sizeof()] = words
+                return None
+            value = self._convert(self._run(expr.source), typ)
+            self._store(destination, typ, value)
+            return value
+
+        elif isinstance(expr, ExprComma):
+            value = None
+            for e in expr.exprs:
+                value = self._run(e)
+            return value
+
+        elif isinstance(expr, ExprCall):
+            if not isinstance(expr.func, ExprIdent) or not isinstance(expr.func.ident, FunctionIdentifier):
+                raise NotConstant()
+            # The arguments are evaluated last to first
+            args = [self._run(arg) for arg in expr.args[::-1]][::-1]
+            return self._call(self.parser.func_list[expr.func.ident.index], args)
+
+        elif isinstance(expr, ExprLoop):
+            self._loop(expr)
+
+        elif isinstance(expr, ExprSwitch):
+            self._switch(expr)
+
+        elif isinstance(expr, ExprReturn):
+            raise Jump('return', self._run(expr.expr))
+
+        elif isinstance(expr, ExprBreak):
+            raise Jump('break')
+
+        elif isinstance(expr, ExprContinue):
+            raise Jump('continue')
+
+        elif isinstance(expr, ExprNop) or isinstance(expr, ExprCase):
+            return None
+
+        else:
+            raise NotConstant()
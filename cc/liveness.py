@@ -0,0 +1,228 @@
+"""
+Liveness of the registers over the instructions the translator generated
+
+Every line is a node of the control flow graph. Skips are followed exactly, an IF
+that fails skips the next instruction, and if that one is an IF as well it skips
+the one after it too, so a predicated instruction is only on one of the paths.
+"""
+from .assembler import Reg, Pop, WORD, operand_regs, is_local_label, table_label, REGISTERS
+
+
+# The registers we keep track of, SP is always live
+TRACKED = set(REGISTERS) | {Reg.EX}
+
+# The registers a function has to give back the way it got them
+CALLEE_SAVED = {Reg.X, Reg.Y, Reg.Z, Reg.I, Reg.J}
+
+# The registers arguments may be passed in
+ARGUMENTS = {Reg.A, Reg.B, Reg.C}
+
+# The registers a function returns its value in, a long takes B as well
+RETURNS = {Reg.A}
+LONG_RETURNS = {Reg.A, Reg.B}
+
+# Operations which always write EX
+WRITES_EX = {'ADD', 'SUB', 'MUL', 'MLI', 'DIV', 'DVI', 'SHR', 'ASR', 'SHL', 'ADX', 'SBX'}
+
+# Operations which can read or change anything
+UNKNOWN = {'INT', 'HWI', 'IAQ', 'IAS', 'RFI'}
+
+
+def registers(operand):
+    """
+    The registers an operand reads (or reads to get to the memory it points to)
+    """
+    return operand_regs(operand) & TRACKED
+
+
+class Liveness:
+    """
+    Backward data flow over all the instructions, live_in and live_out have the registers
+    that are live before and after every line.
+
+    A call reads the argument registers the function it calls reads on entry (which we
+    only know for functions in the same instructions, anything else reads all of them)
+    and changes nothing for sure. A return reads the return value (in A, and in B too for
+    the functions in long_returns) and the callee saved registers.
+    """
+
+    def __init__(self, insts, long_returns=()):
+        self.insts = insts
+        self.uses = [set() for _ in insts]
+        self.defs = [set() for _ in insts]
+        self.succs = [[] for _ in insts]
+        self.live_in = [set() for _ in insts]
+        self.live_out = [set() for _ in insts]
+
+        self._labels = {}
+        self._long = []
+        returns_long = False
+        for i, inst in enumerate(insts):
+            name = inst.label
+            if name is not None:
+                self._labels[name] = i
+                if not is_local_label(name):
+                    returns_long = name in long_returns
+            # If the function this line is in returns a long
+            self._long.append(returns_long)
+
+        # The arguments every function reads, start with none of them and
+        # grow until it stops changing
+        self._arguments = {name: set() for name in self._labels if not is_local_label(name)}
+
+        for i in range(len(insts)):
+            self._analyze(i)
+
+        while True:
+            self._solve()
+            changed = False
+            for name in self._arguments:
+                arguments = self.live_in[self._labels[name]] & ARGUMENTS
+                if arguments != self._arguments[name]:
+                    self._arguments[name] = arguments
+                    changed = True
+            if not changed:
+                break
+            for i in range(len(insts)):
+                self._analyze(i)
+
+    def is_live(self, i, reg):
+        """
+        Is the register read before it is written after the line
+        """
+        return reg in self.live_out[i]
+
+    def _next(self, i):
+        """
+        Index of the instruction after i, or None
+        """
+        i += 1
+        while i < len(self.insts) and not self.insts[i].is_instruction:
+            if self.insts[i].is_data:
+                return None
+            i += 1
+        return i if i < len(self.insts) else None
+
+    def _skip(self, i):
+        """
+        Where a failed IF at i continues
+        """
+        j = self._next(i)
+        while j is not None and self.insts[j].is_skip:
+            j = self._next(j)
+        return None if j is None else j + 1
+
+    def _table(self, target):
+        """
+        The lines a jump through a table of local labels can go to, or None
+        """
+        label = table_label(target)
+        if label not in self._labels:
+            return None
+        succs = []
+        i = self._labels[label] + 1
+        while i < len(self.insts) and self.insts[i].op == WORD:
+            name = self.insts[i].operands[0]
+            if len(self.insts[i].operands) != 1 or not is_local_label(name) or name not in self._labels:
+                return None
+            succs.append(self._labels[name])
+            i += 1
+        return succs
+
+    def _analyze(self, i):
+        inst = self.insts[i]
+        uses = set()
+        defs = set()
+        succs = []
+
+        if not inst.is_instruction:
+            # Data is never run through
+            if not inst.is_data:
+                succs = [i + 1]
+
+        else:
+            op, operands = inst.op, inst.operands
+            if inst.is_skip:
+                for operand in operands:
+                    uses |= registers(operand)
+                succs = [i + 1]
+                skip = self._skip(i)
+                if skip is not None:
+                    succs.append(skip)
+
+            elif op == 'JSR':
+                uses |= registers(operands[0])
+                uses |= self._arguments.get(operands[0], ARGUMENTS)
+                succs = [i + 1]
+
+            elif op in UNKNOWN:
+                uses = set(TRACKED)
+                if op != 'RFI':
+                    succs = [i + 1]
+
+            elif op in ['IAG', 'HWN', 'HWQ']:
+                if op == 'HWQ':
+                    uses |= registers(operands[0])
+                    defs |= {Reg.A, Reg.B, Reg.C, Reg.X, Reg.Y}
+                elif operands[0] in TRACKED:
+                    defs.add(operands[0])
+                else:
+                    uses |= registers(operands[0])
+                succs = [i + 1]
+
+            elif len(operands) == 2 and operands[0] == Reg.PC:
+                target = operands[1]
+                if op == 'SET' and target in self._labels and is_local_label(target):
+                    succs = [self._labels[target]]
+                elif op == 'SET' and isinstance(target, Pop):
+                    uses = (LONG_RETURNS if self._long[i] else RETURNS) | CALLEE_SAVED
+                elif op == 'SET' and target in self._labels:
+                    # A jump to another function
+                    uses = ARGUMENTS | CALLEE_SAVED
+                elif op == 'SET' and self._table(target) is not None:
+                    uses = registers(target)
+                    succs = self._table(target)
+                else:
+                    uses = set(TRACKED)
+
+            elif len(operands) == 2:
+                b, a = operands
+                uses |= registers(a)
+                if b in TRACKED:
+                    if op == 'SET':
+                        defs.add(b)
+                    else:
+                        uses.add(b)
+                        defs.add(b)
+                else:
+                    uses |= registers(b)
+
+                if op in ['STI', 'STD']:
+                    uses |= {Reg.I, Reg.J}
+                if op in ['ADX', 'SBX']:
+                    uses.add(Reg.EX)
+                if op in WRITES_EX and b != Reg.EX:
+                    defs.add(Reg.EX)
+                succs = [i + 1]
+
+            else:
+                uses = set(TRACKED)
+                succs = [i + 1]
+
+        self.uses[i] = uses
+        self.defs[i] = defs
+        self.succs[i] = [s for s in succs if s < len(self.insts)]
+
+    def _solve(self):
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(self.insts) - 1, -1, -1):
+                out = set()
+                for s in self.succs[i]:
+                    out |= self.live_in[s]
+                live = self.uses[i] | (out - self.defs[i])
+                if out != self.live_out[i] or live != self.live_in[i]:
+                    self.live_out[i] = out
+                    self.live_in[i] = live
+                    changed = True
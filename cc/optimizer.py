@@ -1,12 +1,65 @@
 from .parser import Parser
 from .ast import *
+from .constant import *
+from .interpreter import Interpreter
+import copy
+
+
+# Instructions a call costs at the call site on top of pushing the arguments,
+# that is the JSR, cleaning the arguments from the stack and reading the result
+CALL_SITE_SIZE = 3
+
+# How many instructions a single call site is allowed to grow by inlining
+INLINE_GROWTH = 4
+
+# Functions which are only called once can be dropped after being inlined, so
+# they are inlined up to this size
+INLINE_SINGLE_CALL_LIMIT = 64
+
+# The registers variables can be kept in, leaving three for evaluating expressions
+REGISTER_VARIABLES = 4
+
+# How many instructions unrolling a loop is allowed to add
+UNROLL_GROWTH = 48
+
+# The most copies of the body a loop that is not unrolled all the way gets
+UNROLL_FACTOR = 8
+
+# Loops that run more times than this are not unrolled
+UNROLL_TRIP_LIMIT = 1024
+
+# The location of memory that could be anywhere and hold anything, which is what a
+# call to a function with side effects writes
+ANY_MEMORY = (None, None)
+
+# The object a temp made after the alias analysis points into, it might be any of them
+NEW_POINTER = 'new'
 
 
 class Optimizer:
 
-    def __init__(self, parser):
+    def __init__(self, parser, optimize_size=False):
         self.parser = parser
 
+        # When optimizing for size loops are only unrolled if that does not make them bigger
+        self.unroll_growth = 0 if optimize_size else UNROLL_GROWTH
+
+        # The alias analysis of the function being optimized, see _analyze_aliases
+        self.points_to = {}
+        self.escaped = None
+        self.analyzed_vars = 0
+
+        # How many times the value range rewrites were done, and how many calls were run at compile time
+        self.hits = {'known-comparison': 0, 'unsigned-division': 0, 'redundant-mask': 0, 'evaluated-call': 0}
+
+        # The globals which keep the value they are initialized with, and what the calls run
+        # at compile time returned (None if they could not be run)
+        self.read_only = set()
+        self.evaluated = {}
+
+    def __str__(self):
+        return '\n'.join([str(f) for f in self.parser.func_list if not f.prototype])
+
     def _find_pure_functions(self):
         for f in self.parser.func_list:
             f.pure_known = False
@@ -17,6 +70,9 @@ class Optimizer:
             if f.pure_known:
                 return False
 
+            self.parser.func = f
+            self._analyze_aliases(f.code, self._address_taken(f.code))
+
             unknown_functions = [False]
             side_effects = False
 
@@ -32,16 +88,33 @@ class Optimizer:
                 elif isinstance(expr, ExprBinary):
                     return check_side_effects(expr.right) or check_side_effects(expr.left)
                 elif isinstance(expr, ExprLoop):
-                    return check_side_effects(expr.cond) or check_side_effects(expr.body)
+                    return check_side_effects(expr.cond) or check_side_effects(expr.body) or \
+                        check_side_effects(expr.step)
+                elif isinstance(expr, ExprSwitch):
+                    return check_side_effects(expr.expr) or check_side_effects(expr.body)
                 elif isinstance(expr, ExprAddrof):
                     return check_side_effects(expr.expr)
+                elif isinstance(expr, ExprCast) or isinstance(expr, ExprReturn):
+                    return check_side_effects(expr.expr)
 
-                # if this is an lvalue and we have a deref we assume side effects
+                # writing to a global (or a static local) is a side effect
+                elif isinstance(expr, ExprIdent):
+                    if expr.resolve_type(self.parser).volatile:
+                        return True
+                    if lvalue and isinstance(expr.ident, GlobalIdentifier):
+                        return True
+                    if lvalue and isinstance(expr.ident, VariableIdentifier):
+                        return f.vars[expr.ident.index].storage == StorageClass.STATIC
+                    return False
+
+                # Writing through a pointer is a side effect unless it can only point to one of our
+                # locals, reading a volatile object is one as well
                 elif isinstance(expr, ExprDeref):
-                    if lvalue:
+                    if expr.resolve_type(self.parser).volatile:
                         return True
-                    else:
-                        return check_side_effects(expr.expr)
+                    if lvalue and not self._is_local(self._pointer_base(expr.expr)):
+                        return True
+                    return check_side_effects(expr.expr)
 
                 elif isinstance(expr, ExprCall):
                     if check_side_effects(expr.func):
@@ -63,10 +136,14 @@ class Optimizer:
                     if not func.pure_known and func.name != f.name:
                         unknown_functions[0] = True
 
+                    return False
+
                 else:
                     return False
 
             side_effects = check_side_effects(f.code)
+            self._forget_aliases()
+            self.parser.func = None
 
             if side_effects or not unknown_functions[0]:
                 f.pure_known = True
@@ -88,19 +165,28 @@ class Optimizer:
                 if check_function(f):
                     count += 1
 
+        self.read_only = self._read_only_globals()
+
     def _constant_fold(self, expr, stmt):
         # TODO: on assign expressions we can probably do some kind of fold inside binary operation
         #       so (5 + (a = 5)) can turn into (a = 5, 10)
 
         if isinstance(expr, ExprComma):
             new_exprs = []
+            dead = False
             for i, e in enumerate(expr.exprs):
+                # After a return only a case label can be reached
+                if dead:
+                    if not isinstance(e, ExprCase):
+                        continue
+                    dead = False
+
                 e = self._constant_fold(e, stmt)
 
                 # If we got to a return just don't continue
                 if isinstance(e, ExprReturn):
                     new_exprs.append(e)
-                    break
+                    dead = True
 
                 # elif isinstance(e, ExprLoop):
                 #
@@ -116,17 +202,19 @@ class Optimizer:
                 elif isinstance(e, ExprNop):
                     continue
 
-                # only add if has side effects
+                # only add if has side effects, outside of statements the last element is the value
                 else:
-                    # inside statements we only append non-pure nodes
-                    if stmt:
-                        if not e.is_pure(self.parser):
-                            new_exprs.append(e)
+                    used = not stmt and i == len(expr.exprs) - 1
+                    if used or not (e.is_pure(self.parser) or self._side_effect_free(e, True)):
+                        new_exprs.append(e)
 
-                    # Outside of that only add non-pure and the last element
-                    else:
-                        if not e.is_pure(self.parser) or i == len(expr.exprs) - 1:
-                            new_exprs.append(e)
+                    # Volatile objects are read even if nothing uses the value, which takes
+                    # putting it somewhere
+                    elif self._touches_volatile(e):
+                        typ = e.resolve_type(self.parser)
+                        if isinstance(typ, CInteger) or isinstance(typ, CPointer):
+                            e = ExprCopy(e, self.parser._temp(typ), e.pos)
+                        new_exprs.append(e)
 
             if len(new_exprs) == 0:
                 return ExprNop()
@@ -150,30 +238,31 @@ class Optimizer:
             if expr.op == '&&':
                 # We know both
                 if isinstance(expr.left, ExprNumber) and isinstance(expr.right, ExprNumber):
-                    return 1 if expr.left.value != 0 and expr.right.value != 0 else 0
+                    return ExprNumber(evaluate('&&', expr.left.value, expr.right.value), CInteger(16, True))
 
                 # If we first have 0 we can just return 0
                 if isinstance(expr.left, ExprNumber):
                     if expr.left.value == 0:
                         return ExprNumber(0)
                     else:
-                        return expr.right
+                        return expr.right if stmt else self._as_truth(expr.right)
 
-                # if the second is a 0 we can just replace this with a comma operator
-                if isinstance(expr.right, ExprNumber) and expr.left.value == 0:
-                    return ExprComma().add(expr.left).add(ExprNumber(0))
+                # if the second is a 0 we can just replace this with a comma operator, which
+                # drops the left one if it has no side effects
+                if isinstance(expr.right, ExprNumber) and expr.right.value == 0:
+                    return self._constant_fold(ExprComma().add(expr.left).add(ExprNumber(0)), False)
 
             elif expr.op == '||':
                 # We know both
                 if isinstance(expr.left, ExprNumber) and isinstance(expr.right, ExprNumber):
-                    return ExprNumber(1) if expr.left.value != 0 or expr.right.value != 0 else ExprNumber(0)
+                    return ExprNumber(evaluate('||', expr.left.value, expr.right.value), CInteger(16, True))
 
                 # Left is constant
                 if isinstance(expr.left, ExprNumber):
                     # if the left is a 0, then we can simply remove it and
                     # return the right expression
                     if expr.left.value == 0:
-                        return expr.right
+                        return expr.right if stmt else self._as_truth(expr.right)
 
                     # if left is 1, we can ommit the right expression
                     else:
@@ -184,17 +273,28 @@ class Optimizer:
                     # If the const is 0 then the left will be the one
                     # who says what will happen
                     if expr.right.value == 0:
-                        return expr.left
+                        return expr.left if stmt else self._as_truth(expr.left)
 
                     # If the const is a 1, then it will always be 1
                     # and we can always run the left
                     else:
-                        return ExprComma().add(expr.left).add(ExprNumber(1))
+                        return self._constant_fold(ExprComma().add(expr.left).add(ExprNumber(1)), False)
 
             else:
                 # The numbers are know and we can calculate them
                 if isinstance(expr.left, ExprNumber) and isinstance(expr.right, ExprNumber):
-                    return ExprNumber(int(eval(f'{expr.left} {expr.op} {expr.right}')))
+                    ltyp, rtyp = expr.left.typ, expr.right.typ
+                    if expr.op in ['<<', '>>']:
+                        # Only what is shifted matters
+                        signed, bits = ltyp.signed, ltyp.bits
+                    elif ltyp.bits == rtyp.bits:
+                        signed, bits = ltyp.signed and rtyp.signed, ltyp.bits
+                    else:
+                        # The smaller one is converted to the bigger one
+                        signed = ltyp.signed if ltyp.bits > rtyp.bits else rtyp.signed
+                        bits = max(ltyp.bits, rtyp.bits)
+                    return ExprNumber(evaluate(expr.op, expr.left.value, expr.right.value, signed, bits),
+                                      expr.resolve_type(self.parser), expr.pos)
 
                 # One of the sides is 0
                 elif (isinstance(expr.left, ExprNumber) and expr.left.value == 0) or (
@@ -214,6 +314,25 @@ class Optimizer:
                     if expr.op == '-':
                         return expr.left
 
+                # Adding constants one after the other, `(x + 1) + 2` is `x + 3`
+                if expr.op in ['+', '-'] and isinstance(expr.right, ExprNumber) and \
+                        isinstance(expr.left, ExprBinary) and expr.left.op in ['+', '-'] and \
+                        isinstance(expr.left.right, ExprNumber) and \
+                        not isinstance(expr.left.right.resolve_type(self.parser), CPointer):
+                    first = expr.left.right.value if expr.left.op == '+' else -expr.left.right.value
+                    second = expr.right.value if expr.op == '+' else -expr.right.value
+                    typ = expr.resolve_type(self.parser)
+                    value = to_signed(first + second, typ.bits if isinstance(typ, CInteger) else 16)
+                    if value == 0:
+                        return expr.left.left
+                    return ExprBinary(expr.left.left, '+' if value > 0 else '-', ExprNumber(abs(value)), expr.pos)
+
+                # One of the sides is 1
+                if expr.op == '*' and isinstance(expr.left, ExprNumber) and expr.left.value == 1:
+                    return self._keep_type(expr.right, expr.resolve_type(self.parser))
+                elif expr.op == '*' and isinstance(expr.right, ExprNumber) and expr.right.value == 1:
+                    return self._keep_type(expr.left, expr.resolve_type(self.parser))
+
         elif isinstance(expr, ExprDeref):
             expr.expr = self._constant_fold(expr.expr, False)
             # deref an addrof
@@ -229,35 +348,2348 @@ class Optimizer:
             expr.source = self._constant_fold(expr.source, False)
             expr.destination = self._constant_fold(expr.destination, False)
             # assignment equals to itself and has no side effects
-            if expr.source == expr.destination and expr.source.is_pure(self):
+            if expr.source == expr.destination and expr.source.is_pure(self.parser) and \
+                    not self._touches_volatile(expr.source):
                 return expr.destination
 
+        elif isinstance(expr, ExprCall):
+            expr.func = self._constant_fold(expr.func, False)
+            expr.args = [self._constant_fold(arg, False) for arg in expr.args]
+
+            # A pure function called with numbers can be run right now
+            value = self._evaluate_call(expr)
+            if value is not None:
+                self.hits['evaluated-call'] += 1
+                return ExprNumber(value, expr.resolve_type(self.parser), expr.pos)
+
         elif isinstance(expr, ExprLoop):
             expr.cond = self._constant_fold(expr.cond, False)
             expr.body = self._constant_fold(expr.body, True)
+            expr.step = self._constant_fold(expr.step, True)
 
             # The loop has a constant 0
-            if isinstance(expr.cond, ExprNumber) and expr.cond.value == 0:
+            if isinstance(expr.cond, ExprNumber) and expr.cond.value == 0 and not expr.post_test:
                 return ExprNop()
 
+        elif isinstance(expr, ExprSwitch):
+            expr.expr = self._constant_fold(expr.expr, False)
+            expr.body = self._constant_fold(expr.body, True)
+
         elif isinstance(expr, ExprCast):
-            expr = self._constant_fold(expr.expr, False)
+            # Keep the cast around since it changes the type of the expression,
+            # unless it is just a number
+            expr.expr = self._constant_fold(expr.expr, False)
+            if isinstance(expr.expr, ExprNumber):
+                if isinstance(expr.typ, CInteger):
+                    return ExprNumber(wrap(expr.expr.value, expr.typ.signed, expr.typ.bits), expr.typ, expr.pos)
+                return ExprNumber(expr.expr.value, expr.expr.typ, expr.pos)
 
         return expr
 
-    def optimize(self):
-        last = str(self)
+    def _as_truth(self, expr):
+        """
+        The expression as 0 or 1, which is what the result of && and || is
+        """
+        if isinstance(expr, ExprNumber):
+            return ExprNumber(int(expr.value != 0), CInteger(16, True), expr.pos)
+        elif isinstance(expr, ExprComma):
+            if len(expr.exprs) != 0:
+                expr.exprs[-1] = self._as_truth(expr.exprs[-1])
+            return expr
+        elif isinstance(expr, ExprBinary) and (expr.op in NEGATED or expr.op in ['&&', '||']):
+            return expr
+        elif isinstance(expr, ExprReturn) or isinstance(expr, ExprBreak) or isinstance(expr, ExprContinue) or \
+                isinstance(expr, ExprLoop) or isinstance(expr, ExprSwitch) or isinstance(expr, ExprNop) or \
+                isinstance(expr, ExprCase):
+            # The branch of an if, its value is never used
+            return expr
 
-        for f in self.parser.global_vars:
-            if f.value is not None:
-                f.value = self._constant_fold(f.value, False).value
+        typ = expr.resolve_type(self.parser)
+        if not isinstance(typ, CInteger) and not isinstance(typ, CPointer):
+            return expr
+        return ExprBinary(expr, '!=', ExprNumber(0), expr.pos)
+
+    ####################################################################################################################
+    # Tree helpers
+    ####################################################################################################################
+
+    def _children(self, expr):
+        """
+        Get the direct children of an expression, in the order the translator evaluates them
+        """
+        if isinstance(expr, ExprComma):
+            return list(expr.exprs)
+        elif isinstance(expr, ExprBinary):
+            return [expr.left, expr.right]
+        elif isinstance(expr, ExprCopy):
+            return [expr.destination, expr.source]
+        elif isinstance(expr, ExprLoop):
+            if expr.post_test:
+                return [expr.body, expr.step, expr.cond]
+            return [expr.cond, expr.body, expr.step]
+        elif isinstance(expr, ExprSwitch):
+            return [expr.expr, expr.body]
+        elif isinstance(expr, ExprCall):
+            return expr.args[::-1] + [expr.func]
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprDeref) or \
+                isinstance(expr, ExprAddrof) or isinstance(expr, ExprReturn):
+            return [expr.expr]
+        else:
+            return []
+
+    def _map_children(self, expr, func):
+        """
+        Replace every direct child of the expression with func(child), the children
+        are visited in the order the translator evaluates them
+        """
+        if isinstance(expr, ExprComma):
+            expr.exprs = [func(e) for e in expr.exprs]
+        elif isinstance(expr, ExprBinary):
+            expr.left = func(expr.left)
+            expr.right = func(expr.right)
+        elif isinstance(expr, ExprCopy):
+            expr.destination = func(expr.destination)
+            expr.source = func(expr.source)
+        elif isinstance(expr, ExprLoop):
+            if expr.post_test:
+                expr.body = func(expr.body)
+                expr.step = func(expr.step)
+                expr.cond = func(expr.cond)
+            else:
+                expr.cond = func(expr.cond)
+                expr.body = func(expr.body)
+                expr.step = func(expr.step)
+        elif isinstance(expr, ExprSwitch):
+            expr.expr = func(expr.expr)
+            expr.body = func(expr.body)
+        elif isinstance(expr, ExprCall):
+            expr.args = [func(arg) for arg in expr.args[::-1]][::-1]
+            expr.func = func(expr.func)
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprDeref) or \
+                isinstance(expr, ExprAddrof) or isinstance(expr, ExprReturn):
+            expr.expr = func(expr.expr)
+        return expr
+
+    def _unshare(self, expr, seen):
+        """
+        The parser reuses nodes in a couple of places (for example `x += 1`), make sure
+        every node appears only once in the tree so it can be rewritten by identity
+        """
+        if id(expr) in seen:
+            expr = copy.copy(expr)
+        seen[id(expr)] = expr
+        return self._map_children(expr, lambda e: self._unshare(e, seen))
+
+    def _is_direct_pure_call(self, expr):
+        if not isinstance(expr, ExprCall):
+            return False
+        if not isinstance(expr.func, ExprIdent) or not isinstance(expr.func.ident, FunctionIdentifier):
+            return False
+        func = self.parser.func_list[expr.func.ident.index]
+        return func.pure_known and func.pure
+
+    def _side_effect_free(self, expr, volatile=False):
+        """
+        Like is_pure, but memory reads are allowed as long as they are not volatile (unless volatile is set)
+        """
+        if not volatile and self._is_volatile(expr):
+            return False
+        elif isinstance(expr, ExprNumber) or isinstance(expr, ExprString) or isinstance(expr, ExprIdent):
+            return True
+        elif isinstance(expr, ExprBinary):
+            return self._side_effect_free(expr.left, volatile) and self._side_effect_free(expr.right, volatile)
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprDeref) or isinstance(expr, ExprAddrof):
+            return self._side_effect_free(expr.expr, volatile)
+        elif isinstance(expr, ExprCall):
+            if not self._is_direct_pure_call(expr):
+                return False
+            for arg in expr.args:
+                if not self._side_effect_free(arg, volatile):
+                    return False
+            return True
+        else:
+            return False
+
+    def _is_address_constant(self, expr):
+        """
+        Expressions the translator turns into an operand without emitting any code
+        """
+        if isinstance(expr, ExprNumber) or isinstance(expr, ExprString):
+            return True
+        elif isinstance(expr, ExprAddrof):
+            return isinstance(expr.expr, ExprIdent)
+        elif isinstance(expr, ExprIdent):
+            if isinstance(expr.ident, FunctionIdentifier):
+                return True
+            typ = expr.resolve_type(self.parser)
+            return isinstance(typ, CArray) or isinstance(typ, CStruct)
+        elif isinstance(expr, ExprCast):
+            return self._is_address_constant(expr.expr)
+        elif isinstance(expr, ExprBinary) and expr.op in ['+', '-']:
+            return self._is_address_constant(expr.left) and self._is_address_constant(expr.right)
+        return False
+
+    def _ident_key(self, ident):
+        return type(ident).__name__, ident.index
+
+    ####################################################################################################################
+    # Alias analysis
+    ####################################################################################################################
+
+    def _ident_in_memory(self, ident, addr_taken):
+        """
+        Can the value of this identifier change behind our back (pointer writes or calls)
+        """
+        if isinstance(ident, GlobalIdentifier):
+            return True
+        if isinstance(ident, VariableIdentifier) and self.parser.func.vars[ident.index].storage == StorageClass.STATIC:
+            return True
+        if ExprIdent(ident).resolve_type(self.parser).volatile:
+            return True
+        return self._ident_key(ident) in addr_taken
+
+    def _address_taken(self, expr, taken=None):
+        if taken is None:
+            taken = set()
+        if isinstance(expr, ExprAddrof) and isinstance(expr.expr, ExprIdent):
+            taken.add(self._ident_key(expr.expr.ident))
+        for e in self._children(expr):
+            self._address_taken(e, taken)
+        return taken
+
+    def _is_volatile(self, expr):
+        """
+        Is this an access to a volatile object
+        """
+        if isinstance(expr, ExprIdent) or isinstance(expr, ExprDeref):
+            return expr.resolve_type(self.parser).volatile
+        return False
+
+    def _touches_volatile(self, expr):
+        """
+        Does the expression access a volatile object anywhere
+        """
+        if isinstance(expr, ExprAddrof):
+            # Only the address is used
+            if isinstance(expr.expr, ExprDeref):
+                return self._touches_volatile(expr.expr.expr)
+            return False
+        if self._is_volatile(expr):
+            return True
+        return any([self._touches_volatile(e) for e in self._children(expr)])
+
+    def _is_pointer(self, expr):
+        typ = expr.resolve_type(self.parser)
+        return isinstance(typ, CPointer) or isinstance(typ, CArray)
+
+    def _pointer_base(self, expr):
+        """
+        The key of the object a pointer points into, or None if it can point anywhere. C doesn't
+        let pointer arithmetic leave the object, so adding to a pointer keeps the object
+        """
+        if isinstance(expr, ExprAddrof):
+            if isinstance(expr.expr, ExprIdent):
+                return self._ident_key(expr.expr.ident)
+            elif isinstance(expr.expr, ExprDeref):
+                return self._pointer_base(expr.expr.expr)
+        elif isinstance(expr, ExprIdent):
+            typ = expr.resolve_type(self.parser)
+            if isinstance(typ, CArray) or isinstance(typ, CStruct):
+                return self._ident_key(expr.ident)
+            if isinstance(expr.ident, VariableIdentifier) and expr.ident.index >= self.analyzed_vars:
+                return NEW_POINTER
+            return self.points_to.get(self._ident_key(expr.ident))
+        elif isinstance(expr, ExprCast):
+            return self._pointer_base(expr.expr)
+        elif isinstance(expr, ExprCopy):
+            return self._pointer_base(expr.source)
+        elif isinstance(expr, ExprComma) and len(expr.exprs) != 0:
+            return self._pointer_base(expr.exprs[-1])
+        elif isinstance(expr, ExprBinary) and expr.op in ['+', '-']:
+            if self._is_pointer(expr.left):
+                return self._pointer_base(expr.left)
+            elif expr.op == '+' and self._is_pointer(expr.right):
+                return self._pointer_base(expr.right)
+        return None
+
+    def _assignments(self, expr, sources):
+        """
+        Collect the values assigned to every identifier
+        """
+        if isinstance(expr, ExprCopy) and isinstance(expr.destination, ExprIdent):
+            sources.setdefault(self._ident_key(expr.destination.ident), []).append(expr.source)
+        for e in self._children(expr):
+            self._assignments(e, sources)
+        return sources
+
+    def _find_escaped(self, expr, escaped, leaked):
+        """
+        Find the objects whose address is used for anything but accessing them, leaked is set
+        when the value of the expression is kept somewhere we don't follow
+        """
+        if leaked:
+            base = self._pointer_base(expr)
+            if base is not None:
+                escaped.add(base)
+
+        if isinstance(expr, ExprDeref):
+            self._find_escaped(expr.expr, escaped, False)
+
+        elif isinstance(expr, ExprCopy):
+            if isinstance(expr.destination, ExprDeref):
+                self._find_escaped(expr.destination.expr, escaped, False)
+            tracked = isinstance(expr.destination, ExprIdent) and \
+                self._ident_key(expr.destination.ident) in self.points_to
+            self._find_escaped(expr.source, escaped, leaked or not tracked)
+
+        elif isinstance(expr, ExprComma):
+            for i, e in enumerate(expr.exprs):
+                self._find_escaped(e, escaped, leaked and i == len(expr.exprs) - 1)
+
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprAddrof):
+            self._find_escaped(expr.expr, escaped, leaked)
+
+        elif isinstance(expr, ExprBinary):
+            # Comparing addresses only gives a truth value, the rest of the operators can
+            # give something the address could be made back from
+            if expr.op not in ['+', '-']:
+                leaked = expr.op not in ['==', '!=', '<', '>', '<=', '>=', '&&', '||']
+            self._find_escaped(expr.left, escaped, leaked)
+            self._find_escaped(expr.right, escaped, leaked)
+
+        elif isinstance(expr, ExprCall):
+            for arg in expr.args:
+                self._find_escaped(arg, escaped, True)
+            self._find_escaped(expr.func, escaped, False)
+
+        elif isinstance(expr, ExprReturn):
+            self._find_escaped(expr.expr, escaped, True)
+
+        else:
+            for e in self._children(expr):
+                self._find_escaped(e, escaped, False)
+
+    def _analyze_aliases(self, code, addr_taken):
+        """
+        Find the locals that always point into the same object, and the objects that a pointer
+        which doesn't show where it points might point into
+        """
+        sources = self._assignments(code, {})
+        self.analyzed_vars = len(self.parser.func.vars)
+        candidates = []
+        for key in sources:
+            if key[0] == 'VariableIdentifier' and not self._ident_in_memory(VariableIdentifier(None, key[1]), addr_taken):
+                candidates.append(key)
+
+        # Start with nothing assigned (an empty tuple) and lower each local to the one object all
+        # the values assigned to it point into, or to None once they point into different ones
+        self.points_to = dict.fromkeys(candidates, ())
+        changed = True
+        while changed:
+            changed = False
+            for key in candidates:
+                if self.points_to[key] is None:
+                    continue
+                bases = set([self._pointer_base(e) for e in sources[key]])
+                bases.discard(())
+                base = bases.pop() if len(bases) == 1 else (None if len(bases) != 0 else ())
+                if base != self.points_to[key]:
+                    self.points_to[key] = base
+                    changed = True
+
+        self.points_to = {key: base for key, base in self.points_to.items() if base}
+        self.escaped = set()
+        self._find_escaped(code, self.escaped, False)
+
+    def _forget_aliases(self):
+        self.points_to = {}
+        self.escaped = None
+        self.analyzed_vars = 0
+
+    def _is_local(self, base):
+        """
+        Is this the key of a local which nothing outside of the function can reach
+        """
+        if base is None or self.escaped is None or base in self.escaped:
+            return False
+        if base[0] == 'ParameterIdentifier':
+            return True
+        return base[0] == 'VariableIdentifier' and \
+            self.parser.func.vars[base[1]].storage != StorageClass.STATIC
+
+    def _location(self, expr):
+        """
+        The memory an identifier or a deref accesses, that is the object it is in (None if it
+        is not known) and the kind of value (None if it can be anything)
+        """
+        if isinstance(expr, ExprIdent):
+            base = self._ident_key(expr.ident)
+        else:
+            base = self._pointer_base(expr.expr)
+
+        typ = expr.resolve_type(self.parser)
+        if isinstance(typ, CInteger):
+            return base, typ.bits
+        elif isinstance(typ, CPointer):
+            return base, 'pointer'
+        return base, None
+
+    def _may_alias(self, first, second):
+        # A pointer which doesn't show where it points can't point into a local whose address
+        # was only used to access it
+        if first[0] is None or second[0] is None:
+            if self._is_local(first[0]) or self._is_local(second[0]):
+                return False
+
+        elif first[0] != second[0] and NEW_POINTER not in [first[0], second[0]]:
+            return False
+
+        # A word is as small as a type gets, so like a char in C it can be used to access anything,
+        # but a long is never accessed as a pointer
+        return set([first[1], second[1]]) != {32, 'pointer'}
+
+    def _overlaps(self, first, second):
+        """
+        Can any of the locations in first be the same memory as one of second
+        """
+        for a in first:
+            for b in second:
+                if self._may_alias(a, b):
+                    return True
+        return False
+
+    def _stored(self, destination, addr_taken):
+        """
+        The identifiers and memory a copy to the destination writes
+        """
+        if isinstance(destination, ExprIdent):
+            key = self._ident_key(destination.ident)
+            if self._ident_in_memory(destination.ident, addr_taken):
+                return {key}, {self._location(destination)}
+            return {key}, set()
+        elif isinstance(destination, ExprDeref):
+            return set(), {self._location(destination)}
+        return set(), {ANY_MEMORY}
+
+    def _reads(self, expr, addr_taken, idents=None, mem=None):
+        """
+        Get the identifiers and the memory an expression reads
+        """
+        if idents is None:
+            idents = set()
+        if mem is None:
+            mem = set()
+        if isinstance(expr, ExprAddrof):
+            # Only the address, which never changes
+            if isinstance(expr.expr, ExprDeref):
+                self._reads(expr.expr.expr, addr_taken, idents, mem)
+            return idents, mem
+        elif isinstance(expr, ExprIdent):
+            idents.add(self._ident_key(expr.ident))
+            if self._ident_in_memory(expr.ident, addr_taken):
+                mem.add(self._location(expr))
+        elif isinstance(expr, ExprDeref):
+            mem.add(self._location(expr))
+        elif isinstance(expr, ExprCall):
+            mem.add(ANY_MEMORY)
+        for e in self._children(expr):
+            self._reads(e, addr_taken, idents, mem)
+        return idents, mem
+
+    def _writes(self, expr, addr_taken, idents=None, mem=None):
+        """
+        Get the identifiers and the memory an expression writes
+        """
+        if idents is None:
+            idents = set()
+        if mem is None:
+            mem = set()
+        if isinstance(expr, ExprCopy):
+            stored_idents, stored_mem = self._stored(expr.destination, addr_taken)
+            idents |= stored_idents
+            mem |= stored_mem
+        elif isinstance(expr, ExprCall) and not self._is_direct_pure_call(expr):
+            mem.add(ANY_MEMORY)
+        for e in self._children(expr):
+            self._writes(e, addr_taken, idents, mem)
+        return idents, mem
+
+    ####################################################################################################################
+    # Value numbering
+    ####################################################################################################################
+
+    def _keep_type(self, expr, typ):
+        """
+        The expression, cast to the type if it has a different one
+        """
+        if self._type_key(expr.resolve_type(self.parser)) != self._type_key(typ):
+            return ExprCast(expr, typ, expr.pos)
+        return expr
+
+    def _type_key(self, typ):
+        if isinstance(typ, CInteger):
+            return 'int', typ.bits, typ.signed
+        return type(typ).__name__
+
+    def _value_key(self, expr):
+        """
+        A key which is the same for expressions computing the same value
+        """
+        if isinstance(expr, ExprNumber):
+            return 'num', expr.value
+        elif isinstance(expr, ExprString):
+            return 'str', expr.value
+        elif isinstance(expr, ExprIdent):
+            return 'ident', self._ident_key(expr.ident)
+        elif isinstance(expr, ExprBinary):
+            return 'bin', expr.op, self._type_key(expr.resolve_type(self.parser)), \
+                   self._value_key(expr.left), self._value_key(expr.right)
+        elif isinstance(expr, ExprCast):
+            return 'cast', self._type_key(expr.typ), self._value_key(expr.expr)
+        elif isinstance(expr, ExprDeref):
+            return 'deref', self._type_key(expr.resolve_type(self.parser)), self._value_key(expr.expr)
+        elif isinstance(expr, ExprAddrof):
+            return 'addrof', self._value_key(expr.expr)
+        elif isinstance(expr, ExprCall):
+            return ('call', self._value_key(expr.func)) + tuple([self._value_key(arg) for arg in expr.args])
+        else:
+            assert False, f'`{expr}` ({type(expr)})'
+
+    def _is_value_candidate(self, expr):
+        """
+        Only bother with expressions which cost code to compute, have no side effects and fit in a register
+        """
+        if isinstance(expr, ExprBinary):
+            if expr.op in ['&&', '||'] or self._is_address_constant(expr):
+                return False
+        elif isinstance(expr, ExprDeref):
+            if self._is_address_constant(expr.expr):
+                return False
+        elif not isinstance(expr, ExprCall):
+            return False
+
+        if not self._side_effect_free(expr):
+            return False
+
+        typ = expr.resolve_type(self.parser)
+        return (isinstance(typ, CInteger) and typ.bits == 16) or isinstance(typ, CPointer)
+
+    def _in_register(self, expr):
+        if isinstance(expr, ExprCast):
+            return self._in_register(expr.expr)
+        return isinstance(expr, ExprIdent) and isinstance(expr.ident, VariableIdentifier) and \
+            self.parser.func.vars[expr.ident.index].storage == StorageClass.REGISTER
+
+    def _kill_values(self, avail, idents, mem):
+        for key in list(avail.keys()):
+            value = avail[key]
+            if len(value[2] & idents) != 0 or self._overlaps(value[3], mem):
+                del avail[key]
+
+    def _number_values(self, expr, avail, values, addr_taken):
+        """
+        Walk the expression in evaluation order, avail has all the values that are
+        known to be computed at this point (they dominate it and nothing changed them
+        since), a candidate which is already available is recorded as a use of it
+        """
+        candidate = self._is_value_candidate(expr)
+        if candidate or isinstance(expr, ExprIdent):
+            key = self._value_key(expr)
+            if key in avail:
+                avail[key][1].append(expr)
+                return
+
+        if isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            # The right side is conditional, nothing computed in it is available after
+            self._number_values(expr.left, avail, values, addr_taken)
+            self._number_values(expr.right, dict(avail), values, addr_taken)
+            self._kill_values(avail, *self._writes(expr.right, addr_taken))
+
+        elif isinstance(expr, ExprLoop):
+            # Anything that is changed in the loop is not available from the back edge,
+            # the condition dominates the body unless the body runs first, a continue
+            # goes to the step from the middle of the body
+            self._kill_values(avail, *self._writes(expr, addr_taken))
+            if expr.post_test:
+                self._number_values(expr.body, dict(avail), values, addr_taken)
+                self._number_values(expr.step, dict(avail), values, addr_taken)
+                self._number_values(expr.cond, dict(avail), values, addr_taken)
+            else:
+                inner = dict(avail)
+                self._number_values(expr.cond, inner, values, addr_taken)
+                step = dict(inner)
+                self._number_values(expr.body, inner, values, addr_taken)
+                self._number_values(expr.step, step, values, addr_taken)
+
+        elif isinstance(expr, ExprSwitch):
+            # A case can be reached from the dispatch or by falling into it, so only
+            # the values from before the switch which the body doesn't change are known there
+            self._number_values(expr.expr, avail, values, addr_taken)
+            self._kill_values(avail, *self._writes(expr.body, addr_taken))
+            inner = dict(avail)
+            for stmt in self._statements(expr.body, []):
+                if isinstance(stmt, ExprCase):
+                    inner = dict(avail)
+                else:
+                    self._number_values(stmt, inner, values, addr_taken)
+
+        elif isinstance(expr, ExprCopy):
+            if isinstance(expr.destination, ExprDeref):
+                self._number_values(expr.destination.expr, avail, values, addr_taken)
+            self._number_values(expr.source, avail, values, addr_taken)
+            self._kill_values(avail, *self._stored(expr.destination, addr_taken))
+
+            # Until something changes it, reading the destination again gives the stored value, unless
+            # the source changed what the address was computed from. Reading it through a register costs
+            # as much as reading a temp would so that is left alone
+            if self._is_value_candidate(expr.destination) and not self._in_register(expr.destination.expr):
+                idents, mem = self._reads(expr.destination, addr_taken)
+                source_idents, source_mem = self._writes(expr.source, addr_taken)
+                if isinstance(expr.source, ExprIdent) and self._is_forwarded_operand(expr.source, addr_taken):
+                    idents.add(self._ident_key(expr.source.ident))
+                if len(idents & source_idents) == 0 and not self._overlaps(mem, source_mem):
+                    value = [expr, [], idents, mem]
+                    values.append(value)
+                    avail[self._value_key(expr.destination)] = value
+
+            # A copy from a number or another local, the local is read from there instead
+            elif self._is_propagated_copy(expr, addr_taken):
+                idents = {self._ident_key(expr.destination.ident)}
+                if isinstance(expr.source, ExprIdent):
+                    idents.add(self._ident_key(expr.source.ident))
+                value = [expr, [], idents, set()]
+                values.append(value)
+                avail[self._value_key(expr.destination)] = value
+
+        elif isinstance(expr, ExprAddrof) and isinstance(expr.expr, ExprIdent):
+            pass
+
+        else:
+            for e in self._children(expr):
+                self._number_values(e, avail, values, addr_taken)
+
+            if isinstance(expr, ExprCall) and not self._is_direct_pure_call(expr):
+                self._kill_values(avail, set(), {ANY_MEMORY})
+
+        if candidate:
+            idents, mem = self._reads(expr, addr_taken)
+            value = [expr, [], idents, mem]
+            values.append(value)
+            avail[key] = value
+
+    def _is_forwarded_operand(self, expr, addr_taken):
+        """
+        A stored value which is used directly instead of through a temp, which is a number or a
+        local we know about every change of
+        """
+        if isinstance(expr, ExprNumber):
+            return True
+        if not isinstance(expr, ExprIdent) or self._ident_in_memory(expr.ident, addr_taken):
+            return False
+        typ = expr.resolve_type(self.parser)
+        return (isinstance(typ, CInteger) and typ.bits == 16) or isinstance(typ, CPointer)
+
+    def _is_propagated_copy(self, expr, addr_taken):
+        """
+        A copy to a local which later reads can take from the source directly, unless that moves
+        the read from a register to memory or to a literal which takes another word. A number is
+        only put in place of an integer, folding drops the cast that would give it a pointer type
+        """
+        if not isinstance(expr.destination, ExprIdent) or not self._is_forwarded_operand(expr.destination, addr_taken) or \
+                not self._is_forwarded_operand(expr.source, addr_taken):
+            return False
+        if isinstance(expr.source, ExprNumber) and not isinstance(expr.destination.resolve_type(self.parser), CInteger):
+            return False
+        if not self._in_register(expr.destination):
+            return True
+        if isinstance(expr.source, ExprNumber):
+            return -1 <= expr.source.value <= 30 or expr.source.value == 0xFFFF
+        return self._in_register(expr.source)
+
+    def _replace_values(self, expr, gens, uses):
+        if id(expr) in uses:
+            use = self._clone(uses[id(expr)], {})
+            use.pos = expr.pos
+            return use
+        self._map_children(expr, lambda e: self._replace_values(e, gens, uses))
+        if id(expr) in gens:
+            return ExprCopy(expr, ExprIdent(gens[id(expr)]), expr.pos)
+        return expr
+
+    def _value_numbering(self, f):
+        """
+        Common subexpression elimination, the first computation of a value that is
+        used again is saved to a temp and the later computations read the temp, a value
+        stored to memory counts as computed by the store
+        """
+        self.parser.func = f
+        f.code = self._unshare(f.code, {})
+        addr_taken = self._address_taken(f.code)
+        self._analyze_aliases(f.code, addr_taken)
+
+        values = []
+        self._number_values(f.code, {}, values, addr_taken)
+
+        gens = {}
+        uses = {}
+        for expr, value_uses, idents, mem in values:
+            if len(value_uses) == 0:
+                continue
+            if isinstance(expr, ExprCopy) and self._is_forwarded_operand(expr.source, addr_taken):
+                value = self._keep_type(expr.source, expr.resolve_type(self.parser))
+            else:
+                temp = self.parser._temp(expr.resolve_type(self.parser)).ident
+                gens[id(expr)] = temp
+                value = ExprIdent(temp)
+            for use in value_uses:
+                uses[id(use)] = value
+
+        # Numbers put in place of locals might fold with what is around them
+        if len(uses) != 0:
+            f.code = self._replace_values(f.code, gens, uses)
+            f.code = self._constant_fold(f.code, True)
+
+        self._forget_aliases()
+        self.parser.func = None
+
+    ####################################################################################################################
+    # Dead stores
+    ####################################################################################################################
+
+    def _is_store_candidate(self, destination):
+        """
+        Only stores of a number or a pointer, which are not volatile
+        """
+        if self._is_volatile(destination):
+            return False
+        typ = destination.resolve_type(self.parser)
+        return isinstance(typ, CInteger) or isinstance(typ, CPointer)
+
+    def _read_keys(self, expr, addr_taken):
+        """
+        The identifiers an expression reads and the objects it reads through pointers
+        """
+        idents, mem = self._reads(expr, addr_taken)
+        return idents | set([base for base, kind in mem if base is not None])
+
+    def _kill_overwritten(self, overwritten, mem):
+        for key in list(overwritten.keys()):
+            if self._overlaps({overwritten[key]}, mem):
+                del overwritten[key]
+
+    def _drop_store(self, expr, stmt):
+        """
+        What is left of a copy whose value is never read, the source if it does anything
+        """
+        if stmt and self._side_effect_free(expr.source):
+            return ExprNop()
+        if not stmt:
+            return self._keep_type(expr.source, expr.resolve_type(self.parser))
+        if isinstance(expr.source, ExprCall):
+            return expr.source
+        return expr
+
+    def _remove_dead_stores(self, expr, live, overwritten, jumps, addr_taken, stmt):
+        """
+        Walk the expression backwards, live has the locals which might be read before they are
+        written again and overwritten the variables in memory which are written again before
+        anything might read them (with their location). jumps has both for where a break and a
+        continue go. A copy to a local which is not live or to an overwritten variable is dropped,
+        and so is a store through a pointer into a local object which is not live
+        """
+        if isinstance(expr, ExprComma):
+            exprs = []
+            for i in range(len(expr.exprs) - 1, -1, -1):
+                e = self._remove_dead_stores(expr.exprs[i], live, overwritten, jumps, addr_taken,
+                                             stmt or i != len(expr.exprs) - 1)
+                if not isinstance(e, ExprNop):
+                    exprs.append(e)
+            if len(exprs) == 0:
+                return ExprNop()
+            expr.exprs = exprs[::-1]
+            return expr
+
+        elif isinstance(expr, ExprCopy):
+            dest = expr.destination
+            dead = False
+            if isinstance(dest, ExprIdent) and not self._ident_in_memory(dest.ident, addr_taken):
+                key = self._ident_key(dest.ident)
+                dead = key not in live and self._is_store_candidate(dest)
+                live.discard(key)
+            elif isinstance(dest, ExprIdent):
+                key = self._ident_key(dest.ident)
+                dead = key in overwritten and self._is_store_candidate(dest)
+                if self._is_store_candidate(dest):
+                    overwritten[key] = self._location(dest)
+            elif isinstance(dest, ExprDeref):
+                # Nothing but a deref of a pointer into it can read the local later
+                base = self._pointer_base(dest.expr)
+                dead = self._is_local(base) and base not in live and self._is_store_candidate(dest)
+
+            expr.source = self._remove_dead_stores(expr.source, live, overwritten, jumps, addr_taken, False)
+            if isinstance(dest, ExprDeref):
+                dest.expr = self._remove_dead_stores(dest.expr, live, overwritten, jumps, addr_taken, False)
+            elif not isinstance(dest, ExprIdent):
+                overwritten.clear()
+                expr.destination = self._remove_dead_stores(dest, live, overwritten, jumps, addr_taken, False)
+
+            if dead:
+                return self._drop_store(expr, stmt)
+            return expr
+
+        elif isinstance(expr, ExprIdent):
+            live.add(self._ident_key(expr.ident))
+            if self._ident_in_memory(expr.ident, addr_taken):
+                self._kill_overwritten(overwritten, {self._location(expr)})
+            return expr
+
+        elif isinstance(expr, ExprAddrof) and isinstance(expr.expr, ExprIdent):
+            return expr
+
+        elif isinstance(expr, ExprReturn) or isinstance(expr, ExprBreak) or isinstance(expr, ExprContinue):
+            # Nothing after it runs, a return leaves the variables in memory to whoever looks next
+            live.clear()
+            overwritten.clear()
+            if isinstance(expr, ExprBreak):
+                live.update(jumps[0])
+            elif isinstance(expr, ExprContinue):
+                live.update(jumps[1])
+            else:
+                expr.expr = self._remove_dead_stores(expr.expr, live, overwritten, jumps, addr_taken, False)
+            return expr
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            # The right side might not run, so both ways meet before it
+            right_live = set(live)
+            right_overwritten = dict(overwritten)
+            expr.right = self._remove_dead_stores(expr.right, right_live, right_overwritten, jumps, addr_taken, stmt)
+            live.update(right_live)
+            for key in list(overwritten.keys()):
+                if key not in right_overwritten:
+                    del overwritten[key]
+            expr.left = self._remove_dead_stores(expr.left, live, overwritten, jumps, addr_taken, False)
+            return expr
+
+        elif isinstance(expr, ExprLoop):
+            # Anything read in the loop might be read again at any point of it through the back
+            # edge, nothing is overwritten for sure there
+            inner = live | self._read_keys(expr, addr_taken)
+            inner_jumps = (set(live), inner)
+            expr.cond = self._remove_dead_stores(expr.cond, set(inner), {}, inner_jumps, addr_taken, False)
+            expr.body = self._remove_dead_stores(expr.body, set(inner), {}, inner_jumps, addr_taken, True)
+            expr.step = self._remove_dead_stores(expr.step, set(inner), {}, inner_jumps, addr_taken, True)
+            live.update(inner)
+            overwritten.clear()
+            return expr
+
+        elif isinstance(expr, ExprSwitch):
+            # The same goes for the cases, any of them can be jumped to
+            inner = live | self._read_keys(expr.body, addr_taken)
+            expr.body = self._remove_dead_stores(expr.body, set(inner), {}, (set(live), jumps[1]), addr_taken, True)
+            live.update(inner)
+            overwritten.clear()
+            expr.expr = self._remove_dead_stores(expr.expr, live, overwritten, jumps, addr_taken, False)
+            return expr
+
+        else:
+            replaced = {}
+            for e in self._children(expr)[::-1]:
+                replaced[id(e)] = self._remove_dead_stores(e, live, overwritten, jumps, addr_taken, False)
+            expr = self._map_children(expr, lambda e: replaced[id(e)])
+            if isinstance(expr, ExprDeref):
+                location = self._location(expr)
+                live.add(location[0])
+                self._kill_overwritten(overwritten, {location})
+            elif isinstance(expr, ExprCall):
+                overwritten.clear()
+            return expr
+
+    def _dead_stores(self, f):
+        """
+        Dead store elimination, a copy to a local that is never read after it or to a variable
+        in memory which is written again before anything might read it is dropped. Globals are
+        only followed in straight line code, a call or a join lets them be read
+        """
+        self.parser.func = f
+        f.code = self._unshare(f.code, {})
+        addr_taken = self._address_taken(f.code)
+        self._analyze_aliases(f.code, addr_taken)
+        f.code = self._remove_dead_stores(f.code, set(), {}, (set(), set()), addr_taken, True)
+        self._forget_aliases()
+        self.parser.func = None
+
+    ####################################################################################################################
+    # Value ranges
+    ####################################################################################################################
+
+    def _type_range(self, typ):
+        """
+        The values a word sized integer type can have, None for anything else
+        """
+        if isinstance(typ, CInteger) and typ.bits == 16:
+            return (-0x8000, 0x7FFF) if typ.signed else (0, 0xFFFF)
+        return None
+
+    def _fit(self, rng, typ):
+        """
+        The range as a value of the type, if it doesn't fit the value wraps around so it can be anything
+        """
+        full = self._type_range(typ)
+        if full is None or rng is None or rng[0] < full[0] or rng[1] > full[1]:
+            return full
+        return rng
+
+    def _is_range_tracked(self, ident, addr_taken):
+        if self._ident_in_memory(ident, addr_taken):
+            return False
+        return self._type_range(ExprIdent(ident).resolve_type(self.parser)) is not None
+
+    def _join_states(self, states):
+        """
+        The ranges known on all of the ways to a point, None is a way that can't be taken
+        """
+        states = [state for state in states if state is not None]
+        if len(states) == 0:
+            return None
+        joined = dict(states[0])
+        for state in states[1:]:
+            for key in list(joined.keys()):
+                if key not in state:
+                    del joined[key]
+                else:
+                    joined[key] = (min(joined[key][0], state[key][0]), max(joined[key][1], state[key][1]))
+        return joined
+
+    def _widen_states(self, old, new):
+        """
+        A bound that moved goes all the way to the end of the type, so a loop takes a couple of passes to settle
+        """
+        if old is None or new is None:
+            return new
+        widened = {}
+        for key, (lo, hi) in new.items():
+            if key not in old:
+                continue
+            full = self._type_range(ExprIdent(self._key_ident(key)).resolve_type(self.parser))
+            widened[key] = (old[key][0] if lo >= old[key][0] else full[0], old[key][1] if hi <= old[key][1] else full[1])
+        return widened
+
+    def _key_ident(self, key):
+        if key[0] == 'ParameterIdentifier':
+            return ParameterIdentifier(None, key[1])
+        return VariableIdentifier(None, key[1])
+
+    def _comparison_type(self, expr):
+        """
+        The type a comparison is done in, like the translator does it
+        """
+        ltyp = expr.left.resolve_type(self.parser)
+        rtyp = expr.right.resolve_type(self.parser)
+        if not isinstance(ltyp, CInteger) or not isinstance(rtyp, CInteger) or ltyp.bits != rtyp.bits:
+            return None
+        return CInteger(ltyp.bits, ltyp.signed and rtyp.signed)
+
+    def _compare_ranges(self, op, left, right):
+        """
+        The result of the comparison if it is the same for all the values in the ranges, or None
+        """
+        if left is None or right is None:
+            return None
+        # Comparing the two is the same as comparing their difference with zero
+        lo, hi = left[0] - right[1], left[1] - right[0]
+        points = [lo, hi] + ([0] if lo <= 0 <= hi else [])
+        results = set([OPERATORS[op](d, 0) for d in points])
+        if len(results) == 1:
+            return results.pop()
+        return None
+
+    def _binary_range(self, expr, left, right):
+        """
+        The range of a binary expression from the ranges of its operands
+        """
+        typ = expr.resolve_type(self.parser)
+        op = expr.op
+        if op in NEGATED or op in ['&&', '||']:
+            return 0, 1
+
+        if op in ['+', '-', '*']:
+            # These wrap the same for any of the types, so only the result has to fit
+            if left is None or right is None:
+                return self._type_range(typ)
+            if op == '+':
+                return self._fit((left[0] + right[0], left[1] + right[1]), typ)
+            if op == '-':
+                return self._fit((left[0] - right[1], left[1] - right[0]), typ)
+            products = [a * b for a in left for b in right]
+            return self._fit((min(products), max(products)), typ)
+
+        left = self._fit(left, typ)
+        right = self._fit(right, expr.right.resolve_type(self.parser) if op in ['<<', '>>'] else typ)
+        if left is None or right is None:
+            return None
+
+        if op == '/' and right[0] > 0:
+            # Rounds towards zero, which only gets closer to zero with a bigger divisor
+            quotients = [OPERATORS['/'](a, b) for a in left for b in right]
+            return min(quotients), max(quotients)
+        elif op == '%' and right[0] > 0:
+            # The sign of the dividend and less than the divisor
+            lo = max(left[0], 1 - right[1]) if left[0] < 0 else 0
+            hi = min(left[1], right[1] - 1) if left[1] > 0 else 0
+            return lo, hi
+        elif op == '&' and (left[0] >= 0 or right[0] >= 0):
+            # Only bits of the non negative one can be left
+            return 0, min([rng[1] for rng in [left, right] if rng[0] >= 0])
+        elif op in ['|', '^'] and left[0] >= 0 and right[0] >= 0:
+            lo = max(left[0], right[0]) if op == '|' else 0
+            return lo, (1 << max(left[1], right[1]).bit_length()) - 1
+        elif op == '>>' and 0 <= right[0] and right[1] < 16:
+            return left[0] >> right[1 if left[0] >= 0 else 0], left[1] >> right[0 if left[1] >= 0 else 1]
+        elif op == '<<' and right[0] == right[1] and 0 <= right[0] < 16:
+            return self._fit((left[0] << right[0], left[1] << right[0]), typ)
+        return self._type_range(typ)
+
+    def _simplify_binary(self, expr, left, right):
+        """
+        Use what the ranges of the operands say, returns the new expression or None
+        """
+        typ = expr.resolve_type(self.parser)
+
+        if expr.op in NEGATED:
+            ctyp = self._comparison_type(expr)
+            if ctyp is None or not self._side_effect_free(expr):
+                return None
+            result = self._compare_ranges(expr.op, self._fit(left, ctyp), self._fit(right, ctyp))
+            if result is None:
+                return None
+            self.hits['known-comparison'] += 1
+            return ExprNumber(result, typ, expr.pos)
+
+        if self._type_range(typ) is None:
+            return None
+        left = self._fit(left, typ)
+        right = self._fit(right, typ)
+
+        if expr.op == '&':
+            # A mask that keeps all the bits the value can have
+            for value, other, rng in [(expr.left, expr.right, left), (expr.right, expr.left, right)]:
+                if not isinstance(other, ExprNumber) or rng is None or rng[0] < 0:
+                    continue
+                bits = (1 << rng[1].bit_length()) - 1
+                if to_unsigned(other.value) & bits == bits:
+                    self.hits['redundant-mask'] += 1
+                    return self._keep_type(value, typ)
+
+        elif expr.op == '%' and left is not None and right is not None and 0 <= left[0] and left[1] < right[0] and \
+                self._side_effect_free(expr.right):
+            # A modulo bigger than the value
+            self.hits['redundant-mask'] += 1
+            return self._keep_type(expr.left, typ)
+
+        if expr.op in ['/', '%'] and typ.signed and isinstance(expr.right, ExprNumber) and \
+                left is not None and left[0] >= 0 and right[0] > 0:
+            # Dividing by a constant takes less code on unsigned values
+            unsigned = CInteger(16, False)
+            self.hits['unsigned-division'] += 1
+            return ExprCast(ExprBinary(ExprCast(expr.left, unsigned), expr.op,
+                                       ExprNumber(expr.right.value, unsigned), expr.pos), typ, expr.pos)
+
+        return None
+
+    def _refine(self, cond, state, truth, addr_taken):
+        """
+        The ranges after the condition was found to be truth, None if that can't happen
+        """
+        if state is None or not self._side_effect_free(cond):
+            return state
+
+        if isinstance(cond, ExprComma) and len(cond.exprs) != 0:
+            return self._refine(cond.exprs[-1], state, truth, addr_taken)
+
+        elif isinstance(cond, ExprBinary) and cond.op in ['&&', '||']:
+            if truth == (cond.op == '&&'):
+                # Both of them are
+                state = self._refine(cond.left, state, truth, addr_taken)
+                return self._refine(cond.right, state, truth, addr_taken)
+            # One of them is, if the first one isn't the second one is
+            other = self._refine(cond.left, state, not truth, addr_taken)
+            return self._join_states([self._refine(cond.left, state, truth, addr_taken),
+                                      self._refine(cond.right, other, truth, addr_taken)])
+
+        elif isinstance(cond, ExprBinary) and cond.op in NEGATED:
+            ctyp = self._comparison_type(cond)
+            if ctyp is None or ctyp.bits != 16:
+                return state
+            op = cond.op if truth else NEGATED[cond.op]
+            state = dict(state)
+            for ident, other, op in [(cond.left, cond.right, op), (cond.right, cond.left, MIRRORED[op])]:
+                if not isinstance(ident, ExprIdent) or not self._is_range_tracked(ident.ident, addr_taken):
+                    continue
+                if ident.resolve_type(self.parser).signed != ctyp.signed:
+                    continue
+                key = self._ident_key(ident.ident)
+                lo, hi = state.get(key, self._type_range(ctyp))
+                rng = self._fit(self._track_ranges(other, state, {}, addr_taken, False)[1], ctyp)
+                if op == '<':
+                    hi = min(hi, rng[1] - 1)
+                elif op == '<=':
+                    hi = min(hi, rng[1])
+                elif op == '>':
+                    lo = max(lo, rng[0] + 1)
+                elif op == '>=':
+                    lo = max(lo, rng[0])
+                elif op == '==':
+                    lo, hi = max(lo, rng[0]), min(hi, rng[1])
+                elif rng[0] == rng[1]:
+                    lo, hi = lo + int(lo == rng[0]), hi - int(hi == rng[0])
+                if lo > hi:
+                    return None
+                state[key] = (lo, hi)
+            return state
+
+        elif isinstance(cond, ExprIdent) and self._is_range_tracked(cond.ident, addr_taken):
+            # Compared with zero
+            return self._refine(ExprBinary(cond, '!=', ExprNumber(0, cond.resolve_type(self.parser))),
+                                state, truth, addr_taken)
+
+        return state
+
+    def _track_loop(self, loop, state, ctx, addr_taken, rewrite):
+        """
+        Run the loop over and over from where it starts until the ranges there settle,
+        returns the ranges after the loop
+        """
+        head = state
+        while True:
+            inner = {'break': [], 'continue': [], 'case': ctx.get('case')}
+            if loop.post_test:
+                _, _, body = self._track_ranges(loop.body, head, inner, addr_taken, False)
+                _, _, step = self._track_ranges(loop.step, self._join_states([body] + inner['continue']), inner,
+                                                addr_taken, False)
+                _, _, cond = self._track_ranges(loop.cond, step, inner, addr_taken, False)
+            else:
+                _, _, cond = self._track_ranges(loop.cond, head, inner, addr_taken, False)
+                _, _, body = self._track_ranges(loop.body, self._refine(loop.cond, cond, True, addr_taken), inner,
+                                                addr_taken, False)
+                _, _, step = self._track_ranges(loop.step, self._join_states([body] + inner['continue']), inner,
+                                                addr_taken, False)
+            if loop.post_test:
+                back = self._refine(loop.cond, cond, True, addr_taken)
+            else:
+                back = step
+            new_head = self._widen_states(head, self._join_states([head, back]))
+            if new_head == head:
+                break
+            head = new_head
+
+        # Once more with what is known at the start of every iteration
+        inner = {'break': [], 'continue': [], 'case': ctx.get('case')}
+        if loop.post_test:
+            loop.body, _, body = self._track_ranges(loop.body, head, inner, addr_taken, rewrite)
+            loop.step, _, step = self._track_ranges(loop.step, self._join_states([body] + inner['continue']), inner,
+                                                    addr_taken, rewrite)
+            loop.cond, _, cond = self._track_ranges(loop.cond, step, inner, addr_taken, rewrite)
+        else:
+            loop.cond, _, cond = self._track_ranges(loop.cond, head, inner, addr_taken, rewrite)
+            loop.body, _, body = self._track_ranges(loop.body, self._refine(loop.cond, cond, True, addr_taken), inner,
+                                                    addr_taken, rewrite)
+            loop.step, _, _ = self._track_ranges(loop.step, self._join_states([body] + inner['continue']), inner,
+                                                 addr_taken, rewrite)
+        return self._join_states([self._refine(loop.cond, cond, False, addr_taken)] + inner['break'])
+
+    def _track_ranges(self, expr, state, ctx, addr_taken, rewrite):
+        """
+        Walk the expression in evaluation order, state has the ranges of the locals we know something
+        about (or is None where nothing gets to), ctx has the ranges at the breaks and continues seen
+        and at the start of the switch the cases are in. Returns the expression (which is simplified
+        with what the ranges say if rewrite is set), its range and the ranges after it
+        """
+        if isinstance(expr, ExprCase):
+            return expr, None, self._join_states([state, ctx.get('case')])
+
+        elif state is None:
+            # Only a case label gets us back
+            if isinstance(expr, ExprComma):
+                for i, e in enumerate(expr.exprs):
+                    e, _, state = self._track_ranges(e, state, ctx, addr_taken, rewrite)
+                    if rewrite:
+                        expr.exprs[i] = e
+            return expr, None, state
+
+        elif isinstance(expr, ExprNop):
+            return expr, None, state
+
+        elif isinstance(expr, ExprNumber):
+            typ = expr.resolve_type(self.parser)
+            value = to_signed(expr.value) if typ.signed else to_unsigned(expr.value)
+            return expr, self._fit((value, value), typ), state
+
+        elif isinstance(expr, ExprIdent):
+            rng = self._type_range(expr.resolve_type(self.parser))
+            if self._is_range_tracked(expr.ident, addr_taken):
+                return expr, state.get(self._ident_key(expr.ident), rng), state
+            return expr, rng, state
+
+        elif isinstance(expr, ExprAddrof) and isinstance(expr.expr, ExprIdent):
+            return expr, None, state
+
+        elif isinstance(expr, ExprComma):
+            rng = None
+            for i, e in enumerate(expr.exprs):
+                e, rng, state = self._track_ranges(e, state, ctx, addr_taken, rewrite)
+                if rewrite:
+                    expr.exprs[i] = e
+            return expr, rng, state
+
+        elif isinstance(expr, ExprCopy):
+            if isinstance(expr.destination, ExprDeref):
+                dest, _, state = self._track_ranges(expr.destination.expr, state, ctx, addr_taken, rewrite)
+                if rewrite:
+                    expr.destination.expr = dest
+            source, rng, state = self._track_ranges(expr.source, state, ctx, addr_taken, rewrite)
+            if rewrite:
+                expr.source = source
+            rng = self._fit(rng, expr.resolve_type(self.parser))
+            if state is not None and isinstance(expr.destination, ExprIdent) and \
+                    self._is_range_tracked(expr.destination.ident, addr_taken):
+                state = dict(state)
+                state[self._ident_key(expr.destination.ident)] = rng
+            return expr, rng, state
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            left, _, state = self._track_ranges(expr.left, state, ctx, addr_taken, rewrite)
+            right, _, right_state = self._track_ranges(expr.right, self._refine(left, state, expr.op == '&&', addr_taken),
+                                                       ctx, addr_taken, rewrite)
+            if rewrite:
+                expr.left, expr.right = left, right
+            return expr, (0, 1), self._join_states([self._refine(left, state, expr.op == '||', addr_taken), right_state])
+
+        elif isinstance(expr, ExprLoop):
+            return expr, None, self._track_loop(expr, state, ctx, addr_taken, rewrite)
+
+        elif isinstance(expr, ExprSwitch):
+            value, _, state = self._track_ranges(expr.expr, state, ctx, addr_taken, rewrite)
+            inner = {'break': [], 'continue': ctx.get('continue', []), 'case': state}
+            body, _, end = self._track_ranges(expr.body, None, inner, addr_taken, rewrite)
+            if rewrite:
+                expr.expr, expr.body = value, body
+            return expr, None, self._join_states([end, state] + inner['break'])
+
+        elif isinstance(expr, ExprBreak) or isinstance(expr, ExprContinue):
+            ctx.setdefault('break' if isinstance(expr, ExprBreak) else 'continue', []).append(state)
+            return expr, None, None
+
+        elif isinstance(expr, ExprReturn):
+            value, _, _ = self._track_ranges(expr.expr, state, ctx, addr_taken, rewrite)
+            if rewrite:
+                expr.expr = value
+            return expr, None, None
+
+        # Everything else runs its parts in order
+        ranges = {}
+        replaced = {}
+        for e in self._children(expr):
+            replaced[id(e)], ranges[id(e)], state = self._track_ranges(e, state, ctx, addr_taken, rewrite)
+
+        if isinstance(expr, ExprBinary):
+            left, right = ranges[id(expr.left)], ranges[id(expr.right)]
+            if rewrite:
+                expr = self._map_children(expr, lambda e: replaced[id(e)])
+                simplified = self._simplify_binary(expr, left, right)
+                if simplified is not None:
+                    return simplified, self._binary_range(expr, left, right), state
+            return expr, self._binary_range(expr, left, right), state
+
+        # The ranges are of the children before they were replaced
+        rng = None
+        if isinstance(expr, ExprCast):
+            rng = self._fit(ranges[id(expr.expr)], expr.typ)
+        elif isinstance(expr, ExprDeref) or isinstance(expr, ExprCall):
+            rng = self._type_range(expr.resolve_type(self.parser))
+        if rewrite:
+            expr = self._map_children(expr, lambda e: replaced[id(e)])
+        return expr, rng, state
+
+    def _value_ranges(self, f):
+        """
+        Find the ranges of the values of the locals, comparisons which always give the same result are
+        replaced with it (and the branches they decide are dropped by the constant folding), divisions
+        of values that are never negative are done unsigned and masks which keep the whole value go
+        """
+        self.parser.func = f
+        f.code = self._unshare(f.code, {})
+        addr_taken = self._address_taken(f.code)
+        last = sum(self.hits.values())
+        f.code = self._track_ranges(f.code, {}, {}, addr_taken, True)[0]
+        if sum(self.hits.values()) != last:
+            f.code = self._constant_fold(f.code, True)
+        self.parser.func = None
+
+    ####################################################################################################################
+    # Compile time evaluation
+    ####################################################################################################################
+
+    def _read_only_globals(self):
+        """
+        The static globals nothing assigns to or takes the address of, they always have the value
+        they are initialized with
+        """
+        written = set()
+        for f in self.parser.func_list:
+            if not f.prototype:
+                written |= self._address_taken(f.code)
+                written |= set(self._assignments(f.code, {}).keys())
+
+        read_only = set()
+        for index, var in enumerate(self.parser.global_vars):
+            if var.storage == StorageClass.STATIC and not var.typ.volatile and \
+                    ('GlobalIdentifier', index) not in written:
+                read_only.add(index)
+        return read_only
+
+    def _evaluate_call(self, call):
+        """
+        The value a call to a pure function with numbers for arguments returns, or None if it
+        can not be found at compile time
+        """
+        if not isinstance(call.func, ExprIdent) or not isinstance(call.func.ident, FunctionIdentifier):
+            return None
+        if any([not isinstance(arg, ExprNumber) for arg in call.args]):
+            return None
+        func = self.parser.func_list[call.func.ident.index]
+        if not func.pure or not isinstance(func.type.ret_type, CInteger):
+            return None
+
+        # Removing a parameter changes the arguments of all the calls, so the count is a part of the key
+        key = call.func.ident.index, func.num_params, tuple([(arg.value, str(arg.typ)) for arg in call.args])
+        if key not in self.evaluated:
+            args = [arg.value for arg in call.args]
+            self.evaluated[key] = Interpreter(self.parser, self.read_only).call(func, args)
+        return self.evaluated[key]
+
+    ####################################################################################################################
+    # Inlining
+    ####################################################################################################################
+
+    def _code_size(self, expr):
+        """
+        Rough estimate of the amount of instructions an expression is translated to
+        """
+        size = 0
+        if isinstance(expr, ExprBinary):
+            size = 3 if expr.op in ['==', '&&', '||'] else 1
+        elif isinstance(expr, ExprCopy) or isinstance(expr, ExprDeref):
+            size = 1
+        elif isinstance(expr, ExprLoop):
+            size = 3
+        elif isinstance(expr, ExprSwitch):
+            size = 4
+        elif isinstance(expr, ExprCase):
+            size = 2
+        elif isinstance(expr, ExprCall):
+            size = CALL_SITE_SIZE + len(expr.args)
+        for e in self._children(expr):
+            size += self._code_size(e)
+        return size
+
+    def _call_graph(self):
+        """
+        Get the functions every function calls directly, how many call sites
+        every function has and which functions have their address taken
+        """
+        calls = [set() for _ in self.parser.func_list]
+        call_sites = [0] * len(self.parser.func_list)
+        escapes = set()
+
+        def walk(expr, caller):
+            if isinstance(expr, ExprCall) and isinstance(expr.func, ExprIdent) and \
+                    isinstance(expr.func.ident, FunctionIdentifier):
+                calls[caller].add(expr.func.ident.index)
+                call_sites[expr.func.ident.index] += 1
+                for arg in expr.args:
+                    walk(arg, caller)
+                return
+            if isinstance(expr, ExprIdent) and isinstance(expr.ident, FunctionIdentifier):
+                escapes.add(expr.ident.index)
+            for e in self._children(expr):
+                walk(e, caller)
+
+        for i, f in enumerate(self.parser.func_list):
+            if not f.prototype:
+                walk(f.code, i)
+        for var in self.parser.global_vars:
+            if isinstance(var.value, ExprIdent) and isinstance(var.value.ident, FunctionIdentifier):
+                escapes.add(var.value.ident.index)
+
+        return calls, call_sites, escapes
+
+    def _statements(self, expr, stmts):
+        if isinstance(expr, ExprComma):
+            for e in expr.exprs:
+                self._statements(e, stmts)
+        else:
+            stmts.append(expr)
+        return stmts
+
+    def _contains(self, expr, typ):
+        if isinstance(expr, typ):
+            return True
+        for e in self._children(expr):
+            if self._contains(e, typ):
+                return True
+        return False
+
+    def _inline_body(self, f):
+        """
+        Get the statements and the returned expression of a function we know how to inline,
+        that is a function with a single return at the end and only simple types
+        """
+        if f.prototype or f.type.callconv == CallConv.INTERRUPT:
+            return None
+
+        for typ in f.type.param_types + [f.type.ret_type]:
+            if not (isinstance(typ, CInteger) or isinstance(typ, CPointer) or isinstance(typ, CVoid)):
+                return None
+
+        for var in f.vars:
+            if var.storage == StorageClass.STATIC:
+                return None
+
+        # Everything after the first return is dead
+        stmts = self._statements(f.code, [])
+        for i, stmt in enumerate(stmts):
+            if isinstance(stmt, ExprReturn):
+                stmts = stmts[:i + 1]
+                break
+        else:
+            return None
+
+        for stmt in stmts[:-1]:
+            if self._contains(stmt, ExprReturn):
+                return None
+
+        addr_taken = self._address_taken(f.code)
+        writes = self._writes(f.code, addr_taken)[0]
+        return stmts[:-1], stmts[-1].expr, writes, addr_taken
+
+    def _clone(self, expr, idents):
+        """
+        Deep copy an expression, idents maps the identifiers to the expressions that replace them
+        """
+        if isinstance(expr, ExprIdent):
+            key = self._ident_key(expr.ident)
+            if key in idents:
+                return self._clone(idents[key], {})
+        expr = copy.copy(expr)
+        if isinstance(expr, ExprComma):
+            expr.exprs = list(expr.exprs)
+        elif isinstance(expr, ExprCall):
+            expr.args = list(expr.args)
+        return self._map_children(expr, lambda e: self._clone(e, idents))
+
+    def _can_substitute(self, arg, args, caller_addr_taken):
+        """
+        Can an argument be used directly instead of copying it to a temp first
+        """
+        if isinstance(arg, ExprNumber) or self._is_address_constant(arg):
+            return True
+        # The callee can't change a local of ours unless its address is taken
+        if isinstance(arg, ExprIdent) and not self._ident_in_memory(arg.ident, caller_addr_taken):
+            return all([self._side_effect_free(a) for a in args])
+        return False
+
+    def _inline_call(self, call, callee, body, caller_addr_taken):
+        stmts, result, callee_writes, callee_addr_taken = body
+
+        idents = {}
+        inlined = ExprComma(call.pos)
+
+        # Evaluate the arguments in the same order a real call would
+        for i in reversed(range(len(call.args))):
+            arg = call.args[i]
+            typ = callee.type.param_types[i]
+            key = self._ident_key(ParameterIdentifier(None, i))
+            if self._type_key(arg.resolve_type(self.parser)) != self._type_key(typ):
+                arg = ExprCast(arg, typ, arg.pos)
+            if key not in callee_writes and key not in callee_addr_taken and \
+                    self._can_substitute(call.args[i], call.args, caller_addr_taken):
+                idents[key] = arg
+            else:
+                temp = self.parser._temp(typ)
+                inlined.add(ExprCopy(arg, temp, arg.pos))
+                idents[key] = temp
+
+        for var in callee.vars:
+            idents[self._ident_key(var.ident)] = self.parser._temp(var.typ)
+
+        for stmt in stmts:
+            inlined.add(self._clone(stmt, idents))
+
+        result = self._clone(result, idents)
+        if not isinstance(result, ExprNop) and \
+                self._type_key(result.resolve_type(self.parser)) != self._type_key(callee.type.ret_type):
+            result = ExprCast(result, callee.type.ret_type, result.pos)
+        inlined.add(result)
+
+        if len(inlined.exprs) == 1:
+            return inlined.exprs[0]
+        return inlined
+
+    def _should_inline(self, call, index, body, call_sites, escapes):
+        callee = self.parser.func_list[index]
+        if len(call.args) != len(callee.type.param_types):
+            return False
+
+        stmts, result, writes, addr_taken = body
+        size = sum([self._code_size(e) for e in stmts]) + self._code_size(result)
+        growth = size - CALL_SITE_SIZE
+
+        # A single call to a function nobody else can see, it will not be needed after this
+        if callee.storage_decl == StorageClass.STATIC and call_sites[index] == 1 and index not in escapes:
+            return size <= INLINE_SINGLE_CALL_LIMIT
+
+        return growth <= INLINE_GROWTH
+
+    def _inline_calls(self, expr, caller, bodies, call_sites, escapes, addr_taken):
+        self._map_children(expr, lambda e: self._inline_calls(e, caller, bodies, call_sites, escapes, addr_taken))
+
+        if isinstance(expr, ExprCall) and isinstance(expr.func, ExprIdent) and \
+                isinstance(expr.func.ident, FunctionIdentifier):
+            index = expr.func.ident.index
+            body = bodies[index]
+            if body is not None and index != caller and \
+                    self._should_inline(expr, index, body, call_sites, escapes):
+                return self._inline_call(expr, self.parser.func_list[index], body, addr_taken)
+
+        return expr
+
+    def _inline_functions(self):
+        """
+        Inline small functions into their callers, the functions are handled bottom up in
+        the call graph so a function is inlined only after its own calls were, functions
+        that are part of a recursion are never inlined
+        """
+        calls, call_sites, escapes = self._call_graph()
+
+        # Find the functions that can reach themselves
+        recursive = set()
+        for i in range(len(calls)):
+            seen = set()
+            todo = list(calls[i])
+            while len(todo) != 0:
+                callee = todo.pop()
+                if callee == i:
+                    recursive.add(i)
+                    break
+                if callee not in seen:
+                    seen.add(callee)
+                    todo += list(calls[callee])
+
+        # Bottom up order of the call graph
+        order = []
+        visited = set()
+
+        def visit(i):
+            if i in visited:
+                return
+            visited.add(i)
+            for callee in calls[i]:
+                visit(callee)
+            order.append(i)
+
+        for i in range(len(calls)):
+            visit(i)
+
+        bodies = [None] * len(calls)
+        for i in order:
+            f = self.parser.func_list[i]
+            if f.prototype:
+                continue
+
+            self.parser.func = f
+            f.code = self._unshare(f.code, {})
+            f.code = self._inline_calls(f.code, i, bodies, call_sites, escapes, self._address_taken(f.code))
+            if i not in recursive:
+                bodies[i] = self._inline_body(f)
+            self.parser.func = None
+
+    ####################################################################################################################
+    # Interprocedural constant propagation
+    ####################################################################################################################
+
+    def _is_link_constant(self, expr):
+        """
+        Constants which mean the same thing in every function
+        """
+        if isinstance(expr, ExprNumber):
+            return True
+        elif isinstance(expr, ExprIdent):
+            return isinstance(expr.ident, FunctionIdentifier)
+        elif isinstance(expr, ExprAddrof) and isinstance(expr.expr, ExprIdent):
+            return isinstance(expr.expr.ident, GlobalIdentifier) or isinstance(expr.expr.ident, FunctionIdentifier)
+        return False
+
+    def _link_constant_key(self, expr):
+        if isinstance(expr, ExprNumber):
+            return 'num', expr.value
+        elif isinstance(expr, ExprIdent):
+            return 'ident', self._ident_key(expr.ident)
+        else:
+            return 'addrof', self._ident_key(expr.expr.ident)
+
+    def _calls_to(self, expr, index, calls):
+        if isinstance(expr, ExprCall) and isinstance(expr.func, ExprIdent) and \
+                isinstance(expr.func.ident, FunctionIdentifier) and expr.func.ident.index == index:
+            calls.append(expr)
+        for e in self._children(expr):
+            self._calls_to(e, index, calls)
+        return calls
+
+    def _constant_parameter(self, index, calls):
+        """
+        Find a parameter which gets the same constant from every call site
+        """
+        f = self.parser.func_list[index]
+        for i in range(f.num_params):
+            value = None
+            for call in calls:
+                if len(call.args) != f.num_params or not self._is_link_constant(call.args[i]):
+                    break
+                if value is not None and self._link_constant_key(value) != self._link_constant_key(call.args[i]):
+                    break
+                value = call.args[i]
+            else:
+                if value is not None:
+                    return i, value
+        return None
+
+    def _parameters(self, expr, params):
+        if isinstance(expr, ExprIdent) and isinstance(expr.ident, ParameterIdentifier):
+            params[expr.ident.index] = expr.ident
+        for e in self._children(expr):
+            self._parameters(e, params)
+        return params
+
+    def _remove_parameter(self, index, param, value):
+        """
+        Turn a parameter into a constant and remove it from the function and all of the calls to it
+        """
+        f = self.parser.func_list[index]
+        self.parser.func = f
+
+        addr_taken = self._address_taken(f.code)
+        key = self._ident_key(ParameterIdentifier(None, param))
+        value = ExprCast(value, f.type.param_types[param], value.pos)
+
+        idents = {}
+        if key in addr_taken or key in self._writes(f.code, addr_taken)[0]:
+            # The parameter is changed by the function, use a local initialized to the value
+            idents[key] = self.parser._temp(f.type.param_types[param])
+            f.code = ExprComma().add(ExprCopy(value, idents[key])).add(f.code)
+        else:
+            idents[key] = value
+
+        # Move down the parameters that come after it
+        for i, ident in self._parameters(f.code, {}).items():
+            if i > param:
+                idents[self._ident_key(ident)] = ExprIdent(ParameterIdentifier(ident.name, i - 1))
+
+        f.code = self._clone(f.code, idents)
+        f.type.param_types.pop(param)
+        f.num_params -= 1
+
+        for caller in self.parser.func_list:
+            if not caller.prototype:
+                for call in self._calls_to(caller.code, index, []):
+                    call.args.pop(param)
+
+        self.parser.func = None
+
+    def _propagate_constant_arguments(self):
+        """
+        A static function which no one outside can call, and that always gets the same
+        constant in a parameter, does not need that parameter
+        """
+        changed = False
+        _, _, escapes = self._call_graph()
+        for index, f in enumerate(self.parser.func_list):
+            if f.prototype or f.storage_decl != StorageClass.STATIC or index in escapes or \
+                    f.type.callconv == CallConv.INTERRUPT:
+                continue
+
+            while True:
+                calls = []
+                for caller in self.parser.func_list:
+                    if not caller.prototype:
+                        self._calls_to(caller.code, index, calls)
+
+                param = self._constant_parameter(index, calls)
+                if param is None:
+                    break
+
+                self._remove_parameter(index, param[0], param[1])
+                changed = True
+
+        return changed
+
+    ####################################################################################################################
+    # Calling convention
+    ####################################################################################################################
+
+    def _use_regcall(self):
+        """
+        A static function which no one outside can call can take its arguments
+        in registers instead of on the stack
+        """
+        _, _, escapes = self._call_graph()
+        for index, f in enumerate(self.parser.func_list):
+            if f.prototype or f.storage_decl != StorageClass.STATIC or index in escapes or \
+                    f.type.callconv != CallConv.STACKCALL:
+                continue
+
+            # Parameters in registers must be a single word and can't have their address taken
+            if any([param.sizeof() != 1 for param in f.type.param_types]):
+                continue
+            taken = self._address_taken(f.code)
+            if any([('ParameterIdentifier', i) in taken for i in range(len(f.type.param_types))]):
+                continue
+
+            f.type.callconv = CallConv.REGCALL
+
+    ####################################################################################################################
+    # Unused functions and variables
+    ####################################################################################################################
+
+    def _mark_used(self):
+        """
+        Mark every static function and variable that can't be reached from
+        the outside as unused, so it is not emitted
+        """
+        used_funcs = set()
+        used_vars = set()
+
+        def walk(expr):
+            if isinstance(expr, ExprIdent):
+                if isinstance(expr.ident, FunctionIdentifier):
+                    visit(expr.ident.index)
+                elif isinstance(expr.ident, GlobalIdentifier):
+                    used_vars.add(expr.ident.index)
+            for e in self._children(expr):
+                walk(e)
+
+        def visit(index):
+            if index in used_funcs:
+                return
+            used_funcs.add(index)
+            f = self.parser.func_list[index]
+            if not f.prototype:
+                walk(f.code)
+
+        for index, f in enumerate(self.parser.func_list):
+            if f.storage_decl != StorageClass.STATIC:
+                visit(index)
+
+        for index, f in enumerate(self.parser.func_list):
+            f.used = index in used_funcs
+
+        for index, var in enumerate(self.parser.global_vars):
+            if var.storage == StorageClass.STATIC and isinstance(var.ident, GlobalIdentifier):
+                var.used = index in used_vars
+
+    ####################################################################################################################
+    # Loop unrolling
+    ####################################################################################################################
+
+    def _leaves_loop(self, expr):
+        """
+        Check for a break or a continue that goes to the loop the expression is the body of
+        """
+        if isinstance(expr, ExprBreak) or isinstance(expr, ExprContinue):
+            return True
+        elif isinstance(expr, ExprLoop):
+            return False
+        elif isinstance(expr, ExprSwitch):
+            # A break in the switch is its own
+            return self._leaves_loop(expr.expr) or self._contains(expr.body, ExprContinue)
+        for e in self._children(expr):
+            if self._leaves_loop(e):
+                return True
+        return False
+
+    def _add_constant(self, expr, value):
+        if value < 0:
+            return ExprBinary(expr, '-', ExprNumber(-value))
+        return ExprBinary(expr, '+', ExprNumber(value))
+
+    def _trip_count(self, loop, key, typ, start, delta, addr_taken):
+        """
+        Run the condition of the loop on the values the induction variable goes through, returns
+        how many times the body runs or None if we can't tell or it runs too many times
+        """
+        reads, mem = self._reads(loop.cond, addr_taken)
+        if reads != {key} or mem or not self._side_effect_free(loop.cond):
+            return None
+
+        count = 0
+        value = start
+        if loop.post_test:
+            count = 1
+            value = wrap(value + delta, typ.signed)
+
+        while count <= UNROLL_TRIP_LIMIT:
+            cond = self._constant_fold(self._clone(loop.cond, {key: ExprNumber(value, typ)}), False)
+            if not isinstance(cond, ExprNumber):
+                return None
+            if cond.value == 0:
+                return count
+            count += 1
+            value = wrap(value + delta, typ.signed)
+        return None
+
+    def _unroll_loop(self, loop, previous, following, addr_taken):
+        """
+        Unroll a loop that runs a known amount of times, all the way if it fits in the budget,
+        or else a few copies of the body per iteration with the iterations that are left over
+        done in front of it. Returns the statements that replace the loop and the statement
+        before it (which starts the induction variable), or None
+        """
+        self._step_to_end(loop)
+        if not isinstance(previous, ExprCopy) or not isinstance(previous.destination, ExprIdent) or \
+                not isinstance(previous.source, ExprNumber):
+            return None
+
+        key = self._ident_key(previous.destination.ident)
+        ivs = self._induction_variables_of(loop, addr_taken)
+        steps = self._statements(loop.step, [])
+        if key not in ivs or steps != [ivs[key][2]] or self._leaves_loop(loop.body):
+            return None
+
+        ident, delta, _ = ivs[key]
+        typ = previous.destination.resolve_type(self.parser)
+        start = wrap(previous.source.value, typ.signed)
+        count = self._trip_count(loop, key, typ, start, delta, addr_taken)
+        if count is None:
+            return None
+
+        def value(k):
+            return ExprNumber(wrap(start + k * delta, typ.signed), typ)
+
+        body = self._code_size(loop.body)
+        size = self._code_size(loop) + 1
+
+        # All the way, the induction variable is a constant in every copy
+        if count * body + 1 <= size + self.unroll_growth:
+            stmts = [self._clone(loop.body, {key: value(k)}) for k in range(count)]
+            if not self._dead_after(key, following, addr_taken):
+                stmts.append(ExprCopy(value(count), ExprIdent(ident)))
+            return stmts
+
+        factors = [factor for factor in range(min(UNROLL_FACTOR, count // 2), 1, -1)
+                   if (factor + count % factor - 1) * body <= self.unroll_growth]
+        if len(factors) == 0:
+            return None
+
+        # The iterations left over are done with constant addresses which cost more than
+        # going through the pointer, so a factor that leaves nothing over is worth twice
+        # as much as one that does
+        factor = max(factors, key=lambda f: (f if count % f == 0 else f // 2, count % f == 0))
+        left = count % factor
+
+        stmts = [self._clone(loop.body, {key: value(k)}) for k in range(left)]
+        stmts.append(ExprCopy(value(left), ExprIdent(ident)))
+
+        # What is left is a multiple of the factor, so the condition only has to be tested after
+        # every few copies, and the body runs at least once
+        copies = [loop.body] + [self._clone(loop.body, {key: self._add_constant(ExprIdent(ident), k * delta)})
+                                for k in range(1, factor)]
+        loop.body = ExprComma().add(copies)
+        loop.step = ExprCopy(self._add_constant(ExprIdent(ident), factor * delta), ExprIdent(ident))
+        loop.post_test = True
+        stmts.append(loop)
+        return stmts
+
+    def _unroll(self, expr, following, addr_taken):
+        """
+        Unroll the loops inside of the expression, inner loops first
+        """
+        if isinstance(expr, ExprComma):
+            exprs = []
+            for i, e in enumerate(expr.exprs):
+                after = [expr.exprs[i + 1:] + stmts for stmts in following]
+                e = self._unroll(e, after, addr_taken)
+                if isinstance(e, ExprLoop) and len(exprs) != 0:
+                    stmts = self._unroll_loop(e, exprs[-1], after, addr_taken)
+                    if stmts is not None:
+                        exprs.pop()
+                        exprs += stmts
+                        continue
+                exprs.append(e)
+            expr.exprs = exprs
+
+        elif isinstance(expr, ExprLoop):
+            stmts = self._statements(expr.body, [])
+            after = [[expr.step, expr.cond] + stmts] + [[expr.step, expr.cond] + s for s in following]
+            expr.body = self._unroll(ExprComma().add(stmts), after, addr_taken)
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            expr.right = self._unroll(expr.right, following, addr_taken)
+
+        else:
+            self._map_children(expr, lambda e: self._unroll(e, [[None]], addr_taken))
+
+        return expr
+
+    def _unroll_loops(self, f):
+        self.parser.func = f
+        f.code = self._unshare(f.code, {})
+        f.code = self._unroll(f.code, [[]], self._address_taken(f.code))
+        f.code = self._constant_fold(f.code, True)
+        self.parser.func = None
+
+    ####################################################################################################################
+    # Induction variables
+    ####################################################################################################################
+
+    def _induction_step(self, stmt):
+        """
+        If the statement adds a constant to a local or a parameter get the identifier and the constant
+        """
+        if isinstance(stmt, ExprCopy) and isinstance(stmt.destination, ExprIdent) and \
+                (isinstance(stmt.destination.ident, VariableIdentifier) or
+                 isinstance(stmt.destination.ident, ParameterIdentifier)) and \
+                isinstance(stmt.source, ExprBinary) and stmt.source.op in ['+', '-'] and \
+                stmt.source.left == stmt.destination and isinstance(stmt.source.right, ExprNumber):
+            typ = stmt.destination.resolve_type(self.parser)
+            if isinstance(typ, CInteger) and typ.bits == 16 and stmt.source.right.value != 0:
+                delta = stmt.source.right.value
+                return stmt.destination.ident, delta if stmt.source.op == '+' else -delta
+        return None
+
+    def _induction_variables_of(self, loop, addr_taken):
+        """
+        The variables that only change by adding a constant to them in the step of the loop
+        """
+        stmts = self._statements(loop.step, [])
+        writes = self._writes(loop.cond, addr_taken)[0] | self._writes(loop.body, addr_taken)[0]
+        ivs = {}
+        for stmt in stmts:
+            step = self._induction_step(stmt)
+            idents = self._writes(stmt, addr_taken)[0]
+            if step is not None and not self._ident_in_memory(step[0], addr_taken):
+                key = self._ident_key(step[0])
+                if key not in writes:
+                    ivs[key] = step[0], step[1], stmt
+                idents = idents - {key}
+            writes |= idents
+
+        # Changed by more than one step
+        for stmt in stmts:
+            for key in list(ivs.keys()):
+                if ivs[key][2] is not stmt and key in self._writes(stmt, addr_taken)[0]:
+                    del ivs[key]
+        return ivs
+
+    def _induction_address(self, expr, ivs):
+        """
+        Split an address like `base + (i + k) * size` where i is an induction variable,
+        returns the key of i, the base, the size and k, or None (a size of 1 is already
+        folded away so it is just `base + (i + k)`)
+        """
+        if not isinstance(expr, ExprBinary) or expr.op != '+':
+            return None
+
+        index = expr.right
+        size = 1
+        if isinstance(index, ExprBinary) and index.op == '*' and isinstance(index.right, ExprNumber):
+            if index.right.value <= 0:
+                return None
+            size = index.right.value
+            index = index.left
+
+        offset = 0
+        if isinstance(index, ExprBinary) and index.op in ['+', '-'] and isinstance(index.right, ExprNumber):
+            offset = index.right.value if index.op == '+' else -index.right.value
+            index = index.left
+
+        if not isinstance(index, ExprIdent) or self._ident_key(index.ident) not in ivs or \
+                not isinstance(index.resolve_type(self.parser), CInteger) or \
+                not isinstance(expr.resolve_type(self.parser), CPointer):
+            return None
+        return self._ident_key(index.ident), expr.left, size, offset
+
+    def _find_addresses(self, expr, ivs, invariant, found):
+        address = self._induction_address(expr, ivs)
+        if address is not None and invariant(address[1]):
+            found.append((expr,) + address)
+            return
+        for e in self._children(expr):
+            self._find_addresses(e, ivs, invariant, found)
+
+    def _replace_nodes(self, expr, replace):
+        if id(expr) in replace:
+            return replace[id(expr)]
+        return self._map_children(expr, lambda e: self._replace_nodes(e, replace))
+
+    def _dead_after(self, key, following, addr_taken):
+        """
+        Check if the value a variable has is never read again, following has every way
+        the code can go on as lists of the statements that run next, a None in one of
+        them means we don't know what comes after that
+        """
+        for stmts in following:
+            for stmt in stmts:
+                if stmt is None:
+                    return False
+
+                # Written before it is read
+                if isinstance(stmt, ExprCopy) and isinstance(stmt.destination, ExprIdent) and \
+                        self._ident_key(stmt.destination.ident) == key and \
+                        key not in self._reads(stmt.source, addr_taken)[0] and \
+                        not self._contains(stmt.source, ExprBreak) and not self._contains(stmt.source, ExprContinue):
+                    break
+
+                # A jump might skip the statements we look at
+                if key in self._reads(stmt, addr_taken)[0] or \
+                        self._contains(stmt, ExprBreak) or self._contains(stmt, ExprContinue):
+                    return False
+        return True
+
+    def _step_to_end(self, loop):
+        """
+        Move the change of a variable at the end of the body of a loop to its
+        step, which we can only do if no continue skips to the step
+        """
+        if not isinstance(loop.step, ExprNop) or self._contains(loop.body, ExprContinue):
+            return
+        stmts = self._statements(loop.body, [])
+        if len(stmts) != 0 and self._induction_step(stmts[-1]) is not None:
+            loop.step = stmts[-1]
+            loop.body = ExprComma().add(stmts[:-1]) if len(stmts) > 1 else ExprNop()
+
+    def _induction_start(self, previous, key, addr_taken):
+        """
+        The value the statement before the loop starts the induction variable at, if it can
+        be calculated again in its place, or None
+        """
+        if isinstance(previous, ExprCopy) and isinstance(previous.destination, ExprIdent) and \
+                self._ident_key(previous.destination.ident) == key and self._side_effect_free(previous.source) and \
+                key not in self._reads(previous.source, addr_taken)[0]:
+            return previous.source
+        return None
+
+    def _reduce_loop(self, loop, previous, following, depth, addr_taken, candidates, budget):
+        """
+        Turn the addresses the loop computes from its induction variables to pointers that are
+        moved along with them, and if the induction variable is only left in the condition test
+        the pointer instead. Returns the statements to run before the loop and if the statement
+        before the loop is not needed anymore
+        """
+        before = []
+        drop_previous = False
+        ivs = self._induction_variables_of(loop, addr_taken)
+
+        idents, mem = self._writes(loop, addr_taken)
+
+        def invariant(e):
+            return self._side_effect_free(e) and self._is_loop_invariant(e, idents, mem, addr_taken)
+
+        found = []
+        self._find_addresses(loop.cond, ivs, invariant, found)
+        self._find_addresses(loop.body, ivs, invariant, found)
+
+        # The same base and size share a pointer
+        groups = {}
+        for address in found:
+            expr, key, base, size, offset = address
+            group = key, self._value_key(base), size
+            groups.setdefault(group, []).append(address)
+
+        replace = {}
+        pointers = {}
+        for (key, _, size), addresses in groups.items():
+            # Only worth it when the pointer is in a register
+            if budget[0] == 0:
+                break
+            budget[0] -= 1
+
+            ident, delta, _ = ivs[key]
+            base = addresses[0][2]
+            pointer = self.parser._temp(addresses[0][0].resolve_type(self.parser))
+            candidates.append((depth, 0, self._ident_key(pointer.ident)))
+            pointers.setdefault(key, (pointer, base, size))
+
+            # Start where the variable is when we get to the loop
+            start = self._induction_start(previous, key, addr_taken)
+            start = ExprIdent(ident) if start is None else self._clone(start, {})
+            init = ExprBinary(self._clone(base, {}), '+', ExprBinary(start, '*', ExprNumber(size)))
+            before.append(self._constant_fold(ExprCopy(init, pointer), True))
+
+            loop.step = ExprComma().add(self._statements(loop.step, []))\
+                .add(ExprCopy(ExprBinary(ExprIdent(pointer.ident), '+', ExprNumber(delta * size)), pointer))
+
+            for expr, _, _, _, offset in addresses:
+                if offset == 0:
+                    replace[id(expr)] = ExprIdent(pointer.ident, expr.pos)
+                else:
+                    replace[id(expr)] = ExprBinary(ExprIdent(pointer.ident), '+', ExprNumber(offset * size), expr.pos)
+
+        if len(replace) != 0:
+            loop.cond = self._replace_nodes(loop.cond, replace)
+            loop.body = self._replace_nodes(loop.body, replace)
+
+        # Test the pointer instead of the induction variable when nothing else needs it,
+        # `a != b` is parsed as `(a == b) == 0`
+        cond = loop.cond
+        negate = False
+        if isinstance(cond, ExprBinary) and cond.op == '==' and isinstance(cond.right, ExprNumber) and \
+                cond.right.value == 0 and isinstance(cond.left, ExprBinary) and cond.left.op in NEGATED:
+            cond, negate = cond.left, True
+        if isinstance(cond, ExprBinary) and cond.op in NEGATED:
+            ident, other, op = cond.left, cond.right, NEGATED[cond.op] if negate else cond.op
+            if not isinstance(ident, ExprIdent):
+                ident, other, op = cond.right, cond.left, MIRRORED[op]
+            key = self._ident_key(ident.ident) if isinstance(ident, ExprIdent) else None
+
+            step = ivs[key][2] if key in ivs else None
+            rest = [e for e in self._statements(loop.step, []) if e is not step]
+            if key in pointers and invariant(other) and key not in self._reads(other, addr_taken)[0] and \
+                    key not in self._reads(loop.body, addr_taken)[0] and \
+                    not any([key in self._reads(e, addr_taken)[0] for e in rest]) and \
+                    self._dead_after(key, following, addr_taken):
+                pointer, base, size = pointers[key]
+                end = self._constant_fold(ExprBinary(self._clone(base, {}), '+',
+                                                     ExprBinary(other, '*', ExprNumber(size))), False)
+                # Unless it is a single operand keep the end aside
+                if not self._is_link_constant(end.expr if isinstance(end, ExprCast) else end):
+                    temp = self.parser._temp(end.resolve_type(self.parser))
+                    candidates.append((depth, 1, self._ident_key(temp.ident)))
+                    before.append(ExprCopy(end, temp))
+                    end = ExprIdent(temp.ident)
+                loop.cond = ExprBinary(ExprIdent(pointer.ident), op, end, cond.pos)
+
+                # The variable is not needed anymore
+                loop.step = ExprComma().add(rest)
+                del ivs[key]
+                if self._induction_start(previous, key, addr_taken) is not None:
+                    drop_previous = True
+
+        # Whatever else the loop works on is better off in a register
+        for key in ivs:
+            candidates.append((depth, 2, key))
+        for key in sorted(self._reads(loop, addr_taken)[0] | self._writes(loop, addr_taken)[0]):
+            candidates.append((depth, 3, key))
+
+        return before, drop_previous
+
+    def _reduce_induction(self, expr, following, depth, addr_taken, candidates, budget):
+        """
+        Reduce the loops inside of the expression, inner loops first
+        """
+        if isinstance(expr, ExprComma):
+            exprs = []
+            for i, e in enumerate(expr.exprs):
+                rest = expr.exprs[i + 1:]
+                after = [rest + stmts for stmts in following]
+                e = self._reduce_induction(e, after, depth, addr_taken, candidates, budget)
+                if isinstance(e, ExprLoop):
+                    previous = exprs[-1] if len(exprs) != 0 else None
+                    before, drop_previous = self._reduce_loop(e, previous, after, depth, addr_taken,
+                                                              candidates, budget)
+                    if drop_previous:
+                        exprs.pop()
+                    exprs += before
+                exprs.append(e)
+            expr.exprs = exprs
+
+        elif isinstance(expr, ExprLoop):
+            self._step_to_end(expr)
+
+            # After the body comes the step and the condition, and then the body again or whatever
+            # comes after the loop
+            stmts = self._statements(expr.body, [])
+            after = [[expr.step, expr.cond] + stmts] + [[expr.step, expr.cond] + s for s in following]
+            expr.body = self._reduce_induction(ExprComma().add(stmts), after, depth + 1,
+                                               addr_taken, candidates, budget)
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            expr.right = self._reduce_induction(expr.right, following, depth, addr_taken, candidates, budget)
+
+        else:
+            self._map_children(expr, lambda e: self._reduce_induction(e, [[None]], depth, addr_taken,
+                                                                      candidates, budget))
+
+        return expr
+
+    def _induction_variables(self, f):
+        """
+        Strength reduction of the loops in the function, the array accesses indexed by a variable which
+        changes by a constant every iteration become pointers that change along with it, and the variables
+        the loops work on are kept in registers
+        """
+        self.parser.func = f
+        f.code = self._unshare(f.code, {})
+        addr_taken = self._address_taken(f.code)
+        self._analyze_aliases(f.code, addr_taken)
+
+        used = len([var for var in f.vars if var.storage == StorageClass.REGISTER])
+        if f.type.callconv == CallConv.REGCALL:
+            used += min(len(f.type.param_types), 3)
+        budget = [max(REGISTER_VARIABLES - used, 0)]
+
+        candidates = []
+        f.code = self._reduce_induction(f.code, [[]], 0, addr_taken, candidates, budget)
+
+        # Pointers we made took their registers already, the rest goes to the deepest loops first
+        registers = [key for _, kind, key in candidates if kind == 0]
+        for _, kind, key in sorted(candidates, key=lambda c: (-c[0], c[1])):
+            if budget[0] == 0:
+                break
+            if key in registers or key[0] != 'VariableIdentifier' or key in addr_taken:
+                continue
+            var = f.vars[key[1]]
+            if var.storage != StorageClass.AUTO or var.typ.volatile:
+                continue
+            if (isinstance(var.typ, CInteger) and var.typ.bits == 16) or isinstance(var.typ, CPointer):
+                registers.append(key)
+                budget[0] -= 1
+
+        for key in registers:
+            f.vars[key[1]].storage = StorageClass.REGISTER
+
+        self._forget_aliases()
+        f.code = self._constant_fold(f.code, True)
+        self.parser.func = None
+
+    ####################################################################################################################
+    # Loop invariant code motion
+    ####################################################################################################################
+
+    def _is_loop_invariant(self, expr, idents, mem, addr_taken):
+        reads, reads_mem = self._reads(expr, addr_taken)
+        return len(reads & idents) == 0 and not self._overlaps(reads_mem, mem)
+
+    def _hoist_invariants(self, expr, idents, mem, addr_taken, hoisted, conditional):
+        """
+        Replace the biggest loop invariant subexpressions with temps, hoisted maps the value
+        of every replaced expression to the temp and the expression that computes it
+
+        conditional is set when the expression might not run on every iteration, we still
+        hoist memory reads from there (they can't fault) but not calls
+        """
+        if self._is_value_candidate(expr) and self._is_loop_invariant(expr, idents, mem, addr_taken):
+            if not (conditional and isinstance(expr, ExprCall)):
+                key = self._value_key(expr)
+                if key not in hoisted:
+                    hoisted[key] = self.parser._temp(expr.resolve_type(self.parser)).ident, expr
+                return ExprIdent(hoisted[key][0], expr.pos)
+
+        def hoist(e, cond=conditional):
+            return self._hoist_invariants(e, idents, mem, addr_taken, hoisted, cond)
+
+        if isinstance(expr, ExprCopy):
+            # The destination itself can never be replaced, only the address of it
+            if isinstance(expr.destination, ExprDeref):
+                expr.destination.expr = hoist(expr.destination.expr)
+            expr.source = hoist(expr.source)
+
+        elif isinstance(expr, ExprAddrof):
+            if isinstance(expr.expr, ExprDeref):
+                expr.expr.expr = hoist(expr.expr.expr)
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            expr.left = hoist(expr.left)
+            expr.right = hoist(expr.right, True)
+
+        elif isinstance(expr, ExprLoop):
+            expr.cond = hoist(expr.cond, True)
+            expr.body = hoist(expr.body, True)
+            expr.step = hoist(expr.step, True)
+
+        elif isinstance(expr, ExprSwitch):
+            expr.expr = hoist(expr.expr)
+            expr.body = hoist(expr.body, True)
+
+        else:
+            self._map_children(expr, hoist)
+
+        return expr
+
+    def _loop_invariant_code_motion(self, expr, addr_taken):
+        """
+        Move the loop invariant expressions of every loop to temps that are set right before it,
+        outer loops are handled first, anything invariant in them is invariant in the inner loops
+        as well so it gets moved all the way out
+        """
+        if isinstance(expr, ExprLoop):
+            idents, mem = self._writes(expr, addr_taken)
+            hoisted = {}
+            expr.cond = self._hoist_invariants(expr.cond, idents, mem, addr_taken, hoisted, False)
+            expr.body = self._hoist_invariants(expr.body, idents, mem, addr_taken, hoisted, True)
+            expr.step = self._hoist_invariants(expr.step, idents, mem, addr_taken, hoisted, True)
+            expr.body = self._loop_invariant_code_motion(expr.body, addr_taken)
+
+            if len(hoisted) != 0:
+                comma = ExprComma()
+                for temp, e in hoisted.values():
+                    comma.add(ExprCopy(e, ExprIdent(temp), e.pos))
+                comma.add(expr)
+                return comma
+            return expr
+
+        return self._map_children(expr, lambda e: self._loop_invariant_code_motion(e, addr_taken))
+
+    def _licm(self, f):
+        self.parser.func = f
+        f.code = self._unshare(f.code, {})
+        addr_taken = self._address_taken(f.code)
+        self._analyze_aliases(f.code, addr_taken)
+        f.code = self._loop_invariant_code_motion(f.code, addr_taken)
+        self._forget_aliases()
+        self.parser.func = None
+
+    def _fold_functions(self):
+        last = str(self)
 
         self._find_pure_functions()
         for f in self.parser.func_list:
+            self.parser.func = f
             f.code = self._constant_fold(f.code, True)
+        self.parser.func = None
 
         while str(self) != last:
             last = str(self)
             self._find_pure_functions()
             for f in self.parser.func_list:
+                self.parser.func = f
                 f.code = self._constant_fold(f.code, True)
+            self.parser.func = None
+
+    def optimize(self):
+        for f in self.parser.global_vars:
+            if isinstance(f.value, list):
+                f.value = [self._constant_fold(value, False).value for value in f.value]
+            elif f.value is not None:
+                f.value = self._constant_fold(f.value, False).value
+
+        self._fold_functions()
+
+        # Inlining gives the constant folding more to work with
+        self._inline_functions()
+        self._fold_functions()
+
+        while self._propagate_constant_arguments():
+            self._fold_functions()
+
+        self._use_regcall()
+
+        self._mark_used()
+
+        self._find_pure_functions()
+        for f in self.parser.func_list:
+            if not f.prototype and f.used:
+                self._value_ranges(f)
+                self._unroll_loops(f)
+                self._induction_variables(f)
+                self._licm(f)
+                self._value_numbering(f)
+                self._dead_stores(f)
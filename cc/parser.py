@@ -1,5 +1,6 @@
 from .tokenizer import *
 from .ast import *
+from .constant import *
 import sys
 
 
@@ -36,7 +37,9 @@ class Parser(Tokenizer):
         self._add_typedef(['unsigned', 'long'], CInteger(32, False))
 
         self._temp_counter = 0
+        self._data_counter = 0
         self._loop_nesting = 0
+        self._switch_nesting = 0
         self.got_errors = False
 
         # Start the parsing
@@ -89,6 +92,17 @@ class Parser(Tokenizer):
         self._temp_counter += 1
         return ret
 
+    def _constant_data(self, typ, values) -> ExprIdent:
+        """
+        A static global with the values, local arrays are initialized by copying it
+        """
+        ident = GlobalIdentifier(f'_data{self._data_counter}', len(self.global_vars))
+        self._data_counter += 1
+        var = Variable(ident, typ, StorageClass.STATIC)
+        var.value = values
+        self.global_vars.append(var)
+        return ExprIdent(ident)
+
     def _use(self, name: str) -> ExprIdent:
         for scope in reversed(self._scopes):
             if name in scope.idents:
@@ -178,6 +192,8 @@ class Parser(Tokenizer):
             if t1.type != t2.type:
                 self.report_warn(f'{action} from incompatible pointer type', e2.pos)
             return True
+        elif isinstance(t1, CStruct) and t1 is t2:
+            return True
         else:
             if action == 'return':
                 action = 'returning'
@@ -192,7 +208,7 @@ class Parser(Tokenizer):
 
         valid = False
 
-        if op in ['+', '-', '==', '!=', '||', '&&']:
+        if op in ['+', '-', '==', '!=', '<', '>', '<=', '>=', '||', '&&']:
             valid = (isinstance(t1, CPointer) or isinstance(t1, CInteger)) and \
                    (isinstance(t2, CPointer) or isinstance(t2, CInteger))
         elif op in ['<<', '>>', '*', '/', '%', '&', '|', '^']:
@@ -271,6 +287,11 @@ class Parser(Tokenizer):
             elif self.is_token(IdentToken) and self.token.value == 'l':
                 typ = CInteger(32, True)
                 self.next_token()
+            elif val > 0x7FFFFFFF:
+                typ = CInteger(32, False)
+            elif val > 0xFFFF:
+                # Too big for an int
+                typ = CInteger(32, True)
             else:
                 typ = CInteger(16, True)
 
@@ -336,11 +357,14 @@ class Parser(Tokenizer):
                 if not isinstance(sub.resolve_type(self), CInteger):
                     self.report_error('array subscript is not an integer', pos)
 
-                multiply = 1
-                if isinstance(arr_type, CPointer):
-                    multiply = arr_type.type.sizeof()
+                multiply = arr_type.type.sizeof()
 
-                x = ExprDeref(ExprBinary(ExprAddrof(x), '+', ExprBinary(sub, '*', ExprNumber(multiply))), self._combine_pos(x.pos, temp_pos))
+                # Arrays need their address while pointers already are one, the address
+                # points to the first element and not the whole array
+                if isinstance(arr_type, CArray):
+                    x = ExprCast(ExprAddrof(x, x.pos), CPointer(arr_type.type), x.pos)
+
+                x = ExprDeref(ExprBinary(x, '+', ExprBinary(sub, '*', ExprNumber(multiply))), self._combine_pos(x.pos, temp_pos))
 
             elif self.match_token('.'):
                 member, mempos = self.expect_ident()
@@ -353,7 +377,9 @@ class Parser(Tokenizer):
                 if member not in typ.items:
                     self.report_fatal_error(f'`{typ}` has no member named `{member}`')
 
-                x = ExprDeref(ExprCast(ExprBinary(ExprAddrof(x), '+', ExprNumber(typ.offsetof(member))), CPointer(typ.items[member])), self._combine_pos(x.pos, mempos))
+                # The members of a volatile struct are volatile
+                member_typ = typ.items[member].qualified(typ.volatile)
+                x = ExprDeref(ExprCast(ExprBinary(ExprAddrof(x), '+', ExprNumber(typ.offsetof(member))), CPointer(member_typ)), self._combine_pos(x.pos, mempos))
 
             elif self.match_token('->'):
                 member, mempos = self.expect_ident()
@@ -371,7 +397,8 @@ class Parser(Tokenizer):
                 if member not in typ.items:
                     self.report_fatal_error(f'{typ} has not member named `{member}`')
 
-                x = ExprDeref(ExprCast(ExprBinary(ExprAddrof(x), '+', ExprNumber(typ.offsetof(member))), CPointer(typ.items[member])), self._combine_pos(x.pos, mempos))
+                member_typ = typ.items[member].qualified(typ.volatile)
+                x = ExprDeref(ExprCast(ExprBinary(x, '+', ExprNumber(typ.offsetof(member))), CPointer(member_typ)), self._combine_pos(x.pos, mempos))
 
             elif self.match_token('('):
                 args = []
@@ -438,7 +465,9 @@ class Parser(Tokenizer):
             pos = self._combine_pos(pos, e.pos)
             if not isinstance(typ, CInteger):
                 self.report_error(f'invalid type argument of unary `~` (have `{typ}`)', pos)
-            return ExprBinary(e, '^', ExprNumber(0xFFFF))
+            if isinstance(typ, CInteger) and typ.bits == 32:
+                return ExprBinary(e, '^', ExprNumber(0xFFFFFFFF, typ), pos)
+            return ExprBinary(e, '^', ExprNumber(0xFFFF), pos)
 
         elif self.match_token('!'):
             e = self._parse_prefix()
@@ -481,7 +510,8 @@ class Parser(Tokenizer):
                 self.expect_token(')')
                 # TODO: check the cast is actually doable
                 # TODO: Compound literal
-                return ExprCast(self._parse_prefix(), typ)
+                e = self._parse_prefix()
+                return ExprCast(e, typ, self._combine_pos(pos, e.pos))
             else:
                 self.restore()
 
@@ -521,15 +551,15 @@ class Parser(Tokenizer):
         return e1
 
     def _parse_relational(self):
-        # e1 = self._parse_shift()
-        # while self.is_token('<') or self.is_token('>') or self.is_token('>=') or self.is_token('<='):
-        #     op = self.token
-        #     self.next_token()
-        #     e2 = self._parse_shift()
-        #     self._check_binary_op(op, e1, e2)
-        #     e1 = ExprBinary(self._expand_pos(e1.pos, self.token.pos), e1, op.value, e2)
-        # return e1
-        return self._parse_shift()
+        e1 = self._parse_shift()
+        while self.is_token('<') or self.is_token('>') or self.is_token('>=') or self.is_token('<='):
+            pos = self.token.pos
+            op = self.token.value
+            self.next_token()
+            e2 = self._parse_shift()
+            self._check_binary_op(op, pos, e1, e2)
+            e1 = ExprBinary(e1, op, e2, self._combine_pos(e1.pos, e2.pos))
+        return e1
 
     def _parse_equality(self):
         e1 = self._parse_relational()
@@ -557,23 +587,23 @@ class Parser(Tokenizer):
         return e1
 
     def _parse_bitwise_xor(self):
-        e1 = self._parse_equality()
+        e1 = self._parse_bitwise_and()
         while self.is_token('^'):
             pos = self.token.pos
             op = self.token.value
             self.next_token()
-            e2 = self._parse_equality()
+            e2 = self._parse_bitwise_and()
             self._check_binary_op(op, pos, e1, e2)
             e1 = ExprBinary(e1, op, e2, self._combine_pos(e1.pos, e2.pos))
         return e1
 
     def _parse_bitwise_or(self):
-        e1 = self._parse_equality()
+        e1 = self._parse_bitwise_xor()
         while self.is_token('|'):
             pos = self.token.pos
             op = self.token.value
             self.next_token()
-            e2 = self._parse_equality()
+            e2 = self._parse_bitwise_xor()
             self._check_binary_op(op, pos, e1, e2)
             e1 = ExprBinary(e1, op, e2, self._combine_pos(e1.pos, e2.pos))
         return e1
@@ -691,9 +721,23 @@ class Parser(Tokenizer):
                 break
         return spec
 
+    def _parse_qualifiers(self):
+        """
+        Parse the type qualifiers and return if one of them is volatile, const is
+        accepted but nothing is checked for it
+        """
+        volatile = False
+        while True:
+            if self.match_keyword('volatile'):
+                volatile = True
+            elif not self.match_keyword('const'):
+                break
+        return volatile
+
     def _parse_type(self, raise_error):
         typ = None
         pos = self.token.pos
+        volatile = self._parse_qualifiers()
 
         # See if any of these
         words = []
@@ -765,26 +809,27 @@ class Parser(Tokenizer):
             name, pos = self.expect_ident()
 
             # Check if is a typedef
-            if self._resolve_type(name) is not None:
-                return self._resolve_type(name)
-
-            if raise_error:
-                self.token.pos = pos
-                self.report_fatal_error(f'unknown type name `{name}`')
-            else:
-                return None
+            typ = self._resolve_type(name)
+            if typ is None:
+                if raise_error:
+                    self.token.pos = pos
+                    self.report_fatal_error(f'unknown type name `{name}`')
+                else:
+                    return None
         else:
             if raise_error:
                 self.expect_ident()
             else:
                 return None
 
-        return typ
+        # The qualifiers can come after the type as well
+        volatile = self._parse_qualifiers() or volatile
+        return typ.qualified(volatile)
 
     def _parse_type_prefix(self, typ):
-        # Parse the prefixes
+        # Parse the prefixes, the qualifiers after a star are for the pointer itself
         while self.match_token('*'):
-            typ = CPointer(typ)
+            typ = CPointer(typ).qualified(self._parse_qualifiers())
 
         return typ
 
@@ -849,7 +894,7 @@ class Parser(Tokenizer):
                 return ExprBinary(x, "&&", y)
 
         elif self.match_keyword('break'):
-            if self._loop_nesting == 0:
+            if self._loop_nesting == 0 and self._switch_nesting == 0:
                 self.report_error('break statement not within loop or switch', pos)
 
             e = ExprBreak(pos)
@@ -865,7 +910,18 @@ class Parser(Tokenizer):
             return e
 
         elif self.match_keyword('for'):
-            assert False
+            self.expect_token('(')
+            init = ExprNop() if self.is_token(';') else self._discard_value(self._parse_expr())
+            self.expect_token(';')
+            cond = ExprNumber(1) if self.is_token(';') else self._parse_expr()
+            self.expect_token(';')
+            step = ExprNop() if self.is_token(')') else self._discard_value(self._parse_expr())
+            self.expect_token(')')
+            self._loop_nesting += 1
+            body = self._parse_stmt()
+            self._loop_nesting -= 1
+            loop = ExprLoop(cond, body, self._combine_pos(pos, body.pos), step)
+            return ExprComma(loop.pos).add(init).add(loop)
 
         elif self.match_keyword('while'):
             self.expect_token('(')
@@ -877,18 +933,37 @@ class Parser(Tokenizer):
             return ExprLoop(cond, body, self._combine_pos(pos, body.pos))
 
         elif self.match_keyword('do'):
-            # body = self._parse_stmt()
-            # self.expect_keyword('while')
-            # self.expect_token('(')
-            # cond = self._parse_expr()
-            # temp_pos = self.token.pos
-            # self.expect_token(')')
-            # # TODO: This will not result in that efficient code gen tbh, we could probably do it better somehow
-            # return ExprComma(self._combine_pos(pos, temp_pos)).add(body).add(ExprLoop(cond, body))
-            pass
+            self._loop_nesting += 1
+            body = self._parse_stmt()
+            self._loop_nesting -= 1
+            self.expect_keyword('while')
+            self.expect_token('(')
+            cond = self._parse_expr()
+            self.expect_token(')')
+            temp_pos = self.token.pos
+            self.expect_token(';')
+            return ExprLoop(cond, body, self._combine_pos(pos, temp_pos), post_test=True)
 
         elif self.match_keyword('switch'):
-            assert False
+            self.expect_token('(')
+            x = self._parse_expr()
+            self.expect_token(')')
+            typ = x.resolve_type(self)
+            if not isinstance(typ, CInteger):
+                self.report_error(f'switch quantity not an integer (have `{typ}`)', x.pos)
+                typ = CInteger(16, True)
+            self._switch_nesting += 1
+            body = self._parse_switch_body(typ)
+            self._switch_nesting -= 1
+            return ExprSwitch(x, body, self._combine_pos(pos, body.pos))
+
+        elif self.is_keyword('case') or self.is_keyword('default'):
+            if self._switch_nesting == 0:
+                self.report_error('case label not within a switch statement', pos)
+            else:
+                self.report_error('case label is only supported directly in the body of a switch', pos)
+            self._parse_case(CInteger(16, True))
+            return ExprNop()
 
         elif self.match_keyword('return'):
             stmt = ExprReturn(ExprNop())
@@ -919,12 +994,94 @@ class Parser(Tokenizer):
             return ExprNop()
 
         else:
-            stmt = self._parse_expr()
+            stmt = self._discard_value(self._parse_expr())
             temp_pos = self.token.pos
             self.expect_token(';')
             stmt.pos = self._combine_pos(stmt.pos, temp_pos)
             return stmt
 
+    def _discard_value(self, expr):
+        """
+        Nothing uses the value of an expression statement, so a postfix
+        increment or decrement doesn't have to keep the old value around
+        """
+        if isinstance(expr, ExprComma) and len(expr.exprs) == 3:
+            save, change, temp = expr.exprs
+            if isinstance(save, ExprCopy) and save.destination is temp and isinstance(change, ExprCopy) and \
+                    save.source is change.destination and save.source.is_pure(self):
+                change.pos = expr.pos
+                return change
+        return expr
+
+    def _constant_value(self, expr):
+        """
+        The value of an integer constant expression, or None if it is not one
+        """
+        if isinstance(expr, ExprNumber):
+            return expr.value
+        elif isinstance(expr, ExprCast) and isinstance(expr.typ, CInteger):
+            value = self._constant_value(expr.expr)
+            return None if value is None else wrap(value, expr.typ.signed, expr.typ.bits)
+        elif isinstance(expr, ExprBinary) and expr.op in OPERATORS:
+            left = self._constant_value(expr.left)
+            right = self._constant_value(expr.right)
+            if left is None or right is None:
+                return None
+            ltyp = expr.left.resolve_type(self)
+            rtyp = expr.right.resolve_type(self)
+            signed = isinstance(ltyp, CInteger) and ltyp.signed and isinstance(rtyp, CInteger) and rtyp.signed
+            bits = max([typ.bits for typ in [ltyp, rtyp] if isinstance(typ, CInteger)], default=16)
+            if expr.op in ['<<', '>>'] and isinstance(ltyp, CInteger):
+                # Only what is shifted matters
+                signed, bits = ltyp.signed, ltyp.bits
+            elif isinstance(ltyp, CInteger) and isinstance(rtyp, CInteger) and ltyp.bits != rtyp.bits:
+                # The smaller one is converted to the bigger one
+                signed = ltyp.signed if ltyp.bits > rtyp.bits else rtyp.signed
+            return evaluate(expr.op, left, right, signed, bits)
+        return None
+
+    def _parse_case(self, typ):
+        """
+        Parse a case or default label, returns the case node
+        """
+        pos = self.token.pos
+        if self.match_keyword('default'):
+            self.expect_token(':')
+            return ExprCase(None, pos)
+
+        self.expect_keyword('case')
+        x = self._parse_conditional()
+        value = self._constant_value(x)
+        if value is None:
+            self.report_error('case label does not reduce to an integer constant', x.pos)
+            value = 0
+        self.expect_token(':')
+        return ExprCase(wrap(value, typ.signed, typ.bits), self._combine_pos(pos, x.pos))
+
+    def _parse_switch_body(self, typ):
+        """
+        The body of a switch is a block where the case labels may appear between the statements
+        """
+        block = ExprComma(self.token.pos)
+        self.expect_token('{')
+
+        values = set()
+        has_default = False
+        while not self.match_token('}'):
+            if self.is_keyword('case') or self.is_keyword('default'):
+                case = self._parse_case(typ)
+                if case.value is None:
+                    if has_default:
+                        self.report_error('multiple default labels in one switch', case.pos)
+                    has_default = True
+                elif case.value in values:
+                    self.report_error(f'duplicate case value `{case.value}`', case.pos)
+                values.add(case.value)
+                block.add(case)
+            else:
+                block.add(self._parse_stmt())
+        return block
+
     def _parse_func(self, func_name_pos: CodePosition, already_exists: bool):
         # Get the params
         self._push_scope()
@@ -936,7 +1093,7 @@ class Parser(Tokenizer):
 
                 # Parse it
                 typ = self._parse_type(True)
-                self._parse_type_prefix(typ)
+                typ = self._parse_type_prefix(typ)
                 pname, ppos = self.expect_ident()
 
                 if already_exists:
@@ -1019,11 +1176,16 @@ class Parser(Tokenizer):
 
                     # Check for initialization
                     if self.match_token('='):
-                        # if has initialization then parse the expression, check the assignment and add the
-                        # copy expression to the start of the function
-                        expr = self._parse_assignment()
-                        self._check_assignment(cur_typ, expr, 'initialization')
-                        self.func.code.add(ExprCopy(expr, new_var))
+                        if self.is_token('{'):
+                            # the values of an array are kept aside and copied over
+                            values = self._parse_initializer(cur_typ)
+                            self.func.code.add(ExprCopy(self._constant_data(cur_typ, values), new_var))
+                        else:
+                            # if has initialization then parse the expression, check the assignment and add the
+                            # copy expression to the start of the function
+                            expr = self._parse_assignment()
+                            self._check_assignment(cur_typ, expr, 'initialization')
+                            self.func.code.add(ExprCopy(expr, new_var))
 
                     if self.match_token(';'):
                         # we are done with the specific variable list
@@ -1048,6 +1210,31 @@ class Parser(Tokenizer):
 
         self._pop_scope()
 
+    def _parse_initializer(self, typ: CType):
+        """
+        Parse the values of an array in braces, the ones which are missing are 0
+        """
+        pos = self.token.pos
+        self.expect_token('{')
+        if not isinstance(typ, CArray) or typ.type.sizeof() != 1:
+            self.report_fatal_error(f'initializer lists are only supported for arrays of words (not `{typ}`)', pos)
+
+        values = []
+        while not self.match_token('}'):
+            value = self._parse_assignment()
+            if not value.is_constant(self):
+                self.report_error(f'initializer element is not constant', value.pos)
+            self._check_assignment(typ.type, value, 'initialization')
+            if len(values) == typ.len:
+                self.report_warn(f'excess elements in array initializer', value.pos)
+            else:
+                values.append(value)
+
+            if not self.is_token('}'):
+                self.expect_token(',')
+
+        return values + [ExprNumber(0) for i in range(typ.len - len(values))]
+
     def _parse_global_variable(self, typ: CType, storage: StorageClass):
         storage = self._parse_storage_decl(storage)
 
@@ -1057,11 +1244,14 @@ class Parser(Tokenizer):
             typ = self._parse_type_postfix(typ, name_pos)
 
             if self.match_token('='):
-                new_value = self._parse_conditional()
-                if not new_value.is_constant(self):
-                    self.report_error(f'initializer element is not constant')
+                if self.is_token('{'):
+                    new_value = self._parse_initializer(typ)
+                else:
+                    new_value = self._parse_conditional()
+                    if not new_value.is_constant(self):
+                        self.report_error(f'initializer element is not constant')
 
-                self._check_assignment(typ, new_value, 'initialization')
+                    self._check_assignment(typ, new_value, 'initialization')
             else:
                 new_value = None
 
@@ -1135,9 +1325,9 @@ class Parser(Tokenizer):
                         self._add_function(name, ret_typ)
                         self.func = self.func_list[e.ident.index]
                     else:
+                        self.func = self.func_list[self._use(name).ident.index]
                         if self.func.type.ret_type != ret_typ:
                             self.report_fatal_error(f'conflicting types for `{self.func.name}`', name_pos, False)
-                        self.func = self.func_list[self._use(name).ident.index]
 
                     # Handle setting the calling conv
                     if self.func.type.callconv is None:
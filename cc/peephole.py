@@ -0,0 +1,578 @@
+from .assembler import Reg, Push, Pop, Inst, BLANK, operand_regs, is_stack_ref, is_local_label, table_label, \
+    inst_words, REGISTERS, CALLER_SAVED
+from .liveness import Liveness, CALLEE_SAVED
+
+
+# Operations which change nothing with this operand (other than EX)
+NO_EFFECT = {
+    'ADD': [0],
+    'SUB': [0],
+    'BOR': [0],
+    'XOR': [0],
+    'SHL': [0],
+    'SHR': [0],
+    'ASR': [0],
+    'MUL': [1],
+    'MLI': [1],
+    'DIV': [1],
+    'DVI': [1],
+    'AND': [0xFFFF, -1],
+}
+
+# Operands which move the stack or have to be where they are
+FIXED = (Reg.PC, Reg.SP, Reg.EX)
+
+
+class Peephole:
+    """
+    Pattern based optimizations on the instructions the translator generated
+
+    Every rule is tried on every position of the instruction list until none of them
+    matches anymore, a rule changes the list in place and returns True if it matched.
+    The rules look at the operands of the instructions, they never parse any text.
+    More rules can be added to the rules list, hits counts the matches of every rule.
+    """
+
+    def __init__(self):
+        self.rules = [
+            ('unused-label', self._unused_label),
+            ('duplicate-label', self._duplicate_label),
+            ('dead-code', self._dead_code),
+            ('jump-to-next', self._jump_to_next),
+            ('jump-chain', self._jump_chain),
+            ('jump-to-return', self._jump_to_return),
+            ('useless-op', self._useless_op),
+            ('set-back', self._set_back),
+            ('forward-set', self._forward_set),
+            ('push-pop', self._push_pop),
+            ('call-save', self._call_save),
+            ('dead-save', self._dead_save),
+            ('shrink-wrap', self._shrink_wrap),
+        ]
+        self.hits = {name: 0 for name, rule in self.rules}
+
+        # The functions which return a long, in A and B
+        self.long_returns = set()
+
+        self._insts = []
+        self._labels = {}
+        self._refs = {}
+        self._clobbers = {}
+        self._liveness = None
+
+    def __str__(self):
+        return '\n'.join([f'{name}: {self.hits[name]}' for name, rule in self.rules])
+
+    def optimize(self, insts):
+        self._insts = list(insts)
+        self._analyze()
+
+        changed = True
+        while changed:
+            changed = False
+            i = 0
+            while i < len(self._insts):
+                for name, rule in self.rules:
+                    if rule(self._insts, i):
+                        self.hits[name] += 1
+                        self._analyze()
+                        changed = True
+                        break
+                else:
+                    i += 1
+
+        return self._insts
+
+    ####################################################################################################################
+    # Analysis
+    ####################################################################################################################
+
+    def _analyze(self):
+        self._labels = {}
+        self._refs = {}
+        for i, inst in enumerate(self._insts):
+            name = inst.label
+            if name is not None:
+                self._labels[name] = i
+            else:
+                for ref in inst.labels():
+                    self._refs[ref] = self._refs.get(ref, 0) + 1
+
+        self._clobbers = {}
+        self._liveness = None
+
+    def _live(self):
+        # Only calculated when a rule needs it
+        if self._liveness is None:
+            self._liveness = Liveness(self._insts, self.long_returns)
+        return self._liveness
+
+    def _clobbered_by(self, target):
+        """
+        The registers a call to the target may change, we look at the code of functions
+        in this file, anything else may change the caller saved registers
+        """
+        if target in self._clobbers:
+            return self._clobbers[target]
+
+        if target not in self._labels or is_local_label(target):
+            clobbers = set(CALLER_SAVED)
+        else:
+            clobbers = set()
+            for inst in self._insts[self._labels[target] + 1:]:
+                name = inst.label
+                if name is not None and not is_local_label(name):
+                    break
+                if not inst.is_instruction:
+                    continue
+                op, operands = inst.op, inst.operands
+                if op == 'JSR':
+                    clobbers |= CALLER_SAVED
+                elif op == 'SET' and operands[0] == Reg.PC and not isinstance(operands[1], Pop) and \
+                        not is_local_label(operands[1]) and table_label(operands[1]) is None:
+                    # A tail call, the function we jump to returns for us
+                    clobbers |= CALLER_SAVED
+                elif op in ['INT', 'HWI', 'IAQ', 'RFI']:
+                    # Hardware and interrupt handlers can change anything
+                    clobbers |= set(REGISTERS)
+                elif op in ['IAG', 'HWN', 'HWQ']:
+                    clobbers |= set(operands) if op != 'HWQ' else {Reg.A, Reg.B, Reg.C, Reg.X, Reg.Y}
+                elif op in ['STI', 'STD']:
+                    clobbers |= {Reg.I, Reg.J}
+                elif not inst.is_skip and len(operands) == 2 and operands[0] in REGISTERS:
+                    clobbers.add(operands[0])
+
+        self._clobbers[target] = clobbers
+        return clobbers
+
+    def _next(self, insts, i):
+        """
+        Index of the next instruction, skipping nothing but blank lines
+        """
+        i += 1
+        while i < len(insts) and insts[i].op == BLANK:
+            i += 1
+        return i
+
+    def _is_conditional(self, insts, i):
+        """
+        Is the instruction the target of a skip
+        """
+        i -= 1
+        while i >= 0:
+            if insts[i].is_instruction:
+                return insts[i].is_skip
+            if insts[i].is_data:
+                return False
+            i -= 1
+        return False
+
+    def _is_dead(self, insts, i, reg):
+        """
+        Is the register written before it is read after the instruction, on every path
+        """
+        return not self._live().is_live(i, reg)
+
+    def _reads_ex(self, insts, i):
+        i = self._next(insts, i)
+        if i >= len(insts):
+            return False
+        inst = insts[i]
+        return not inst.is_instruction or Reg.EX in inst.operands or inst.op in ['ADX', 'SBX']
+
+    def _target_of(self, inst):
+        if inst.op == 'SET' and inst.operands[0] == Reg.PC:
+            return inst.operands[1]
+        return None
+
+    def _labels_after(self, insts, i):
+        """
+        Get the labels right after the instruction and the index of the next instruction
+        """
+        labels = []
+        i += 1
+        while i < len(insts):
+            name = insts[i].label
+            if name is not None:
+                labels.append(name)
+            elif insts[i].op != BLANK:
+                break
+            i += 1
+        return labels, i
+
+    def _return_at(self, insts, label):
+        """
+        The straight line code from a local label up to the return it ends with, or None
+        """
+        if not is_local_label(label) or label not in self._labels:
+            return None
+        _, j = self._labels_after(insts, self._labels[label])
+        code = []
+        while j < len(insts) and insts[j].is_instruction and not insts[j].is_skip:
+            code.append(insts[j])
+            target = self._target_of(insts[j])
+            if target is not None:
+                return code if isinstance(target, Pop) else None
+            j = self._next(insts, j)
+        return None
+
+    ####################################################################################################################
+    # Rules
+    ####################################################################################################################
+
+    def _unused_label(self, insts, i):
+        # Local labels nobody jumps to
+        name = insts[i].label
+        if name is None or not is_local_label(name) or self._refs.get(name, 0) != 0:
+            return False
+        del insts[i]
+        return True
+
+    def _rename_label(self, insts, old, new):
+        for j, inst in enumerate(insts):
+            if old in inst.labels():
+                insts[j] = inst.renamed(old, new)
+
+    def _duplicate_label(self, insts, i):
+        # Two labels of the same place, keep only one of them
+        first = insts[i].label
+        if first is None or i + 1 >= len(insts):
+            return False
+        second = insts[i + 1].label
+        if second is None:
+            return False
+
+        if is_local_label(second):
+            self._rename_label(insts, second, first)
+            del insts[i + 1]
+        elif is_local_label(first):
+            self._rename_label(insts, first, second)
+            del insts[i]
+        else:
+            return False
+        return True
+
+    def _dead_code(self, insts, i):
+        # Nothing can get to an instruction after a jump without a label in between
+        target = self._target_of(insts[i])
+        if target is None and insts[i].op != 'RFI':
+            return False
+        if self._is_conditional(insts, i):
+            return False
+
+        j = self._next(insts, i)
+        if j >= len(insts) or not insts[j].is_instruction:
+            return False
+        del insts[j]
+        return True
+
+    def _jump_to_next(self, insts, i):
+        # A jump to the label right after it
+        target = self._target_of(insts[i])
+        if target is None:
+            return False
+
+        labels, _ = self._labels_after(insts, i)
+        if target not in labels:
+            return False
+
+        if not self._is_conditional(insts, i):
+            del insts[i]
+            return True
+
+        # A conditional jump, the condition itself has no side effects
+        # so both can go if nothing skips the condition
+        j = i - 1
+        while insts[j].op == BLANK:
+            j -= 1
+        if insts[j].label is not None or self._is_conditional(insts, j):
+            return False
+        del insts[i]
+        del insts[j]
+        return True
+
+    def _jump_chain(self, insts, i):
+        # A jump to a jump, go directly to the end of the chain
+        target = self._target_of(insts[i])
+        if target is None or target not in self._labels:
+            return False
+
+        seen = {target}
+        final = target
+        while final in self._labels:
+            _, j = self._labels_after(insts, self._labels[final])
+            if j >= len(insts):
+                break
+            next_target = self._target_of(insts[j])
+            if next_target is None or isinstance(next_target, Pop) or next_target in seen or \
+                    next_target in REGISTERS or self._is_conditional(insts, j):
+                break
+            seen.add(next_target)
+            final = next_target
+
+        if final == target:
+            return False
+        insts[i] = Inst('SET', Reg.PC, final)
+        return True
+
+    def _jump_to_return(self, insts, i):
+        # A jump to a function ending which is no bigger than the jump, return right there
+        code = self._return_at(insts, self._target_of(insts[i]))
+        if code is None or sum([inst_words(inst) for inst in code]) > inst_words(insts[i]):
+            return False
+        if len(code) > 1 and self._is_conditional(insts, i):
+            return False
+        insts[i:i + 1] = code
+        return True
+
+    def _useless_op(self, insts, i):
+        # Arithmetic that does not change the value
+        inst = insts[i]
+        if inst.op not in NO_EFFECT or not isinstance(inst.operands[1], int) or \
+                inst.operands[1] not in NO_EFFECT[inst.op]:
+            return False
+        if isinstance(inst.operands[0], (Push, Pop)) or self._is_conditional(insts, i) or self._reads_ex(insts, i):
+            return False
+        del insts[i]
+        return True
+
+    def _set_back(self, insts, i):
+        # SET a, b followed by SET b, a, the second one does nothing
+        if insts[i].op != 'SET':
+            return False
+        j = self._next(insts, i)
+        if j >= len(insts):
+            return False
+        b, a = insts[i].operands
+        if insts[j].op != 'SET' or insts[j].operands != (a, b):
+            return False
+
+        for op in [b, a]:
+            if isinstance(op, (Push, Pop)) or op in FIXED:
+                return False
+        # One of them has to be a register that the other one does not use
+        if not ((b in REGISTERS and b not in operand_regs(a)) or
+                (a in REGISTERS and a not in operand_regs(b))):
+            return False
+        if self._is_conditional(insts, i):
+            return False
+
+        del insts[j]
+        return True
+
+    def _forward_set(self, insts, i):
+        # SET r, a followed by OP b, r where r is not used after, is just OP b, a
+        if insts[i].op != 'SET' or insts[i].operands[0] not in REGISTERS:
+            return False
+        reg, a = insts[i].operands
+        if isinstance(a, Pop) or a in FIXED or self._is_conditional(insts, i):
+            return False
+
+        j = self._next(insts, i)
+        if j >= len(insts):
+            return False
+        q = insts[j]
+        if not q.is_instruction or len(q.operands) != 2 or q.operands[1] != reg or reg in operand_regs(q.operands[0]):
+            return False
+        if q.op in ['STI', 'STD'] or not self._is_dead(insts, j, reg):
+            return False
+
+        insts[j] = Inst(q.op, q.operands[0], a)
+        del insts[i]
+        return True
+
+    def _push_pop(self, insts, i):
+        # SET PUSH, a followed by SET b, POP is just SET b, a
+        if insts[i].op != 'SET' or not isinstance(insts[i].operands[0], Push):
+            return False
+        j = self._next(insts, i)
+        if j >= len(insts):
+            return False
+        if insts[j].op != 'SET' or not isinstance(insts[j].operands[1], Pop):
+            return False
+        a = insts[i].operands[1]
+        b = insts[j].operands[0]
+        if self._is_conditional(insts, i) or Reg.SP in operand_regs(a) | operand_regs(b):
+            return False
+
+        if a == b:
+            del insts[j]
+        else:
+            insts[j] = Inst('SET', b, a)
+        del insts[i]
+        return True
+
+    def _restore_of(self, insts, i, changes=False):
+        """
+        Find where the register pushed at i is popped back, the code in between has to be
+        straight line code which only uses the stack for calls and does not change the register
+        (unless changes is set), returns the index of the pop and the targets of the calls in
+        between, or None
+        """
+        reg = insts[i].operands[1]
+        depth = 1
+        calls = []
+        j = i + 1
+        while j < len(insts):
+            inst = insts[j]
+            if not inst.is_instruction:
+                if inst.op != BLANK:
+                    return None
+                j += 1
+                continue
+
+            op, operands = inst.op, inst.operands
+            if inst.is_skip or Reg.PC in operands or any([is_stack_ref(o) for o in operands]):
+                return None
+
+            if op == 'JSR':
+                if len(operands) != 1:
+                    return None
+                calls.append(operands[0])
+
+            elif len(operands) == 2 and operands[0] == Reg.SP:
+                if op not in ['ADD', 'SUB'] or not isinstance(operands[1], int) or operands[1] < 0:
+                    return None
+                depth += -operands[1] if op == 'ADD' else operands[1]
+
+            else:
+                if Push() in operands:
+                    depth += 1
+                if Pop() in operands:
+                    depth -= 1
+                    if depth == 0:
+                        if op == 'SET' and operands == (reg, Pop()):
+                            return j, calls
+                        return None
+                if len(operands) == 2 and operands[0] == reg and not changes:
+                    return None
+
+            if depth <= 0:
+                return None
+            j += 1
+
+        return None
+
+    def _is_save(self, insts, i):
+        inst = insts[i]
+        if inst.op != 'SET' or not isinstance(inst.operands[0], Push) or inst.operands[1] not in REGISTERS:
+            return False
+        return not self._is_conditional(insts, i)
+
+    def _call_save(self, insts, i):
+        # A register that is saved around calls to functions that don't change it
+        if not self._is_save(insts, i):
+            return False
+        reg = insts[i].operands[1]
+
+        restore = self._restore_of(insts, i)
+        if restore is None:
+            return False
+        j, calls = restore
+        if len(calls) == 0 or any([reg in self._clobbered_by(target) for target in calls]):
+            return False
+
+        del insts[j]
+        del insts[i]
+        return True
+
+    def _dead_save(self, insts, i):
+        # A register that is saved around calls but nothing reads it after it is restored
+        if not self._is_save(insts, i):
+            return False
+        reg = insts[i].operands[1]
+
+        # What happens to the register in between does not matter if it is not read after
+        restore = self._restore_of(insts, i, True)
+        if restore is None:
+            return False
+        j, calls = restore
+        if self._live().is_live(j, reg):
+            return False
+
+        del insts[j]
+        del insts[i]
+        return True
+
+    def _shrink_wrap(self, insts, i):
+        # The callee saved registers are pushed once on every path through the function, if the
+        # pushes are followed by straight line code that returns without using them, push them
+        # only where that code jumps to
+        if not self._is_save(insts, i) or insts[i].operands[1] not in CALLEE_SAVED - {Reg.J}:
+            return False
+
+        # Only the first push, right after the frame is set up or a label
+        k = i - 1
+        while k >= 0 and insts[k].op == BLANK:
+            k -= 1
+        if k > 0 and insts[k].op == 'SUB' and insts[k].operands[0] == Reg.SP:
+            k -= 1
+        if k < 0 or insts[k] != Inst('SET', Reg.J, Reg.SP) and insts[k].label is None:
+            return False
+
+        pushes = []
+        j = i
+        while j < len(insts):
+            inst = insts[j]
+            if inst.op != 'SET' or not isinstance(inst.operands[0], Push) or \
+                    inst.operands[1] not in CALLEE_SAVED - {Reg.J}:
+                break
+            pushes.append(j)
+            j = self._next(insts, j)
+        saved = [insts[k].operands[1] for k in pushes]
+
+        # The code until the first label, has to end with a return
+        body = []
+        while j < len(insts) and insts[j].is_instruction:
+            body.append(j)
+            j = self._next(insts, j)
+        teardown = [Inst('SET', Reg.SP, Reg.J), Inst('SET', Reg.J, Pop()), Inst('SET', Reg.PC, Pop())]
+        epilogue = [Inst('SET', reg, Pop()) for reg in saved[::-1]] + teardown
+        shared = None
+        if len(body) >= len(epilogue) and [insts[k] for k in body[-len(epilogue):]] == epilogue:
+            pops = body[-len(epilogue):][:len(saved)]
+            body = body[:-len(epilogue)]
+            end = pops[0]
+        elif len(body) > 0 and self._return_at(insts, self._target_of(insts[body[-1]])) == epilogue:
+            # It jumps to the function ending the other returns share, it gets one of
+            # its own without the pops
+            shared = body.pop()
+            pops = []
+            end = shared
+        else:
+            return False
+        if self._is_conditional(insts, end):
+            return False
+
+        # Nothing before the return may need the registers or the stack
+        targets = {}
+        for k in body:
+            op, operands = insts[k].op, insts[k].operands
+            if self._live().uses[k] & set(saved) or self._live().defs[k] & set(saved):
+                return False
+            if op == 'JSR' or any([isinstance(o, (Push, Pop)) or o == Reg.SP or is_stack_ref(o) for o in operands]):
+                return False
+            if Reg.PC in operands:
+                target = self._target_of(insts[k])
+                if target is None or not is_local_label(target) or target not in self._labels:
+                    return False
+                targets[target] = targets.get(target, 0) + 1
+
+        # Only that code can get to where it jumps
+        for target, count in targets.items():
+            if self._refs.get(target, 0) != count:
+                return False
+            k = self._labels[target] - 1
+            while k >= 0 and (insts[k].op == BLANK or insts[k].label is not None):
+                k -= 1
+            if k < 0 or self._target_of(insts[k]) is None or self._is_conditional(insts, k):
+                return False
+
+        for target in sorted(targets, key=lambda t: self._labels[t], reverse=True):
+            k = self._labels[target] + 1
+            insts[k:k] = [insts[push] for push in pushes]
+        if shared is not None:
+            insts[shared:shared + 1] = teardown
+        for k in pops[::-1] + pushes[::-1]:
+            del insts[k]
+        return True
@@ -0,0 +1,252 @@
+"""
+Runtime helpers for the long operations that take too much code to do in place
+
+Only the helpers a file uses are put in it, as static functions. They are called like
+any stackcall function, with the low word of a long pushed last, and they return a
+long in A and B (the low word in A). The division helpers return the quotient and leave
+the remainder in place of the dividend on the stack, where the caller pops it from.
+"""
+from .assembler import Reg, Deref, Offset, Push, Pop
+
+
+def _arg(i):
+    """
+    The word i places up the stack, on entry the first argument is right above the
+    return address
+    """
+    return Deref(Offset(Reg.SP, i))
+
+
+def _emit_shift(asm, name, shift):
+    """
+    Shift the long in the first two words by the third word, shift is the instruction
+    for the high word (SHR or ASR), or None for a left shift
+    """
+    big = asm.make_label()
+
+    asm.emit_blank()
+    asm.mark_label(name)
+    asm.emit_set(Reg.A, _arg(1))
+    asm.emit_set(Reg.B, _arg(2))
+    asm.emit_set(Reg.C, _arg(3))
+    asm.emit_and(Reg.C, 31)
+    asm.emit_ifg(Reg.C, 15)
+    asm.emit_set(Reg.PC, big)
+
+    # EX gets the bits shifted out of the second word we shift
+    if shift is None:
+        asm.emit_shl(Reg.B, Reg.C)
+        asm.emit_shl(Reg.A, Reg.C)
+        asm.emit_bor(Reg.B, Reg.EX)
+    else:
+        asm.emit_shr(Reg.A, Reg.C)
+        shift(Reg.B, Reg.C)
+        asm.emit_bor(Reg.A, Reg.EX)
+    asm.emit_set(Reg.PC, Pop())
+
+    # A whole word or more, one word moves to the other
+    asm.mark_label(big)
+    asm.emit_sub(Reg.C, 16)
+    if shift is None:
+        asm.emit_shl(Reg.A, Reg.C)
+        asm.emit_set(Reg.B, Reg.A)
+        asm.emit_set(Reg.A, 0)
+    else:
+        asm.emit_set(Reg.A, Reg.B)
+        shift(Reg.A, Reg.C)
+        if shift == asm.emit_asr:
+            asm.emit_asr(Reg.B, 15)
+        else:
+            asm.emit_set(Reg.B, 0)
+    asm.emit_set(Reg.PC, Pop())
+
+
+def _emit_shll(asm):
+    _emit_shift(asm, '__shll', None)
+
+
+def _emit_shrl(asm):
+    _emit_shift(asm, '__shrl', asm.emit_shr)
+
+
+def _emit_sarl(asm):
+    _emit_shift(asm, '__sarl', asm.emit_asr)
+
+
+def _emit_udivmodl(asm):
+    """
+    Unsigned division of the long in the first two words by the long in the other two
+    """
+    small = asm.make_label()
+    wide = asm.make_label()
+    carry = asm.make_label()
+    done = asm.make_label()
+    loop = asm.make_label()
+    sub = asm.make_label()
+    bit = asm.make_label()
+
+    asm.emit_blank()
+    asm.mark_label('__udivmodl')
+    asm.emit_set(Reg.A, _arg(1))
+    asm.emit_set(Reg.B, _arg(2))
+    asm.emit_set(Reg.C, _arg(3))
+    asm.emit_ifn(_arg(4), 0)
+    asm.emit_set(Reg.PC, wide)
+    asm.emit_ife(Reg.B, 0)
+    asm.emit_set(Reg.PC, small)
+
+    # A word divisor, the high word of the quotient is the high word divided by it and
+    # what is left of it (r) goes on to the low word. r * 0x10000 / d is what DIV leaves
+    # in EX, the remainders of that and of the low word divided by d together might be
+    # worth one more
+    asm.emit_set(_arg(4), Reg.B)
+    asm.emit_div(_arg(4), Reg.C)
+    asm.emit_mod(Reg.B, Reg.C)
+    asm.emit_div(Reg.B, Reg.C)
+    asm.emit_set(Reg.B, Reg.EX)
+    asm.emit_set(_arg(3), Reg.C)
+    asm.emit_mul(_arg(3), Reg.B)
+    asm.emit_set(_arg(2), 0)
+    asm.emit_sub(_arg(2), _arg(3))
+    asm.emit_set(_arg(3), Reg.A)
+    asm.emit_mod(_arg(3), Reg.C)
+    asm.emit_div(Reg.A, Reg.C)
+    asm.emit_add(Reg.A, Reg.B)
+    asm.emit_set(Reg.B, _arg(2))
+    asm.emit_add(Reg.B, _arg(3))
+    asm.emit_ifn(Reg.EX, 0)
+    asm.emit_set(Reg.PC, carry)
+    asm.emit_ifl(Reg.B, Reg.C)
+    asm.emit_set(Reg.PC, done)
+    asm.mark_label(carry)
+    asm.emit_sub(Reg.B, Reg.C)
+    asm.emit_add(Reg.A, 1)
+    asm.mark_label(done)
+    asm.emit_set(_arg(1), Reg.B)
+    asm.emit_set(_arg(2), 0)
+    asm.emit_set(Reg.B, _arg(4))
+    asm.emit_set(Reg.PC, Pop())
+
+    # Both fit in a word
+    asm.mark_label(small)
+    asm.emit_set(Reg.B, Reg.A)
+    asm.emit_mod(Reg.B, Reg.C)
+    asm.emit_set(_arg(1), Reg.B)
+    asm.emit_div(Reg.A, Reg.C)
+    asm.emit_set(Reg.B, 0)
+    asm.emit_set(Reg.PC, Pop())
+
+    # The divisor is more than a word so the quotient fits in one, and only comes from the low
+    # word of the dividend, shift it into the remainder (which starts as the high word) a bit at
+    # a time, the remainder might go over 32 bits on the way but then it is over the divisor
+    asm.mark_label(wide)
+    asm.emit_set(Push(), Reg.X)
+    asm.emit_set(Push(), Reg.Y)
+    asm.emit_set(Reg.X, Reg.B)
+    asm.emit_set(Reg.Y, 0)
+    asm.emit_set(Reg.B, 0)
+    asm.emit_set(Reg.C, 16)
+    asm.mark_label(loop)
+    asm.emit_add(Reg.B, Reg.B)
+    asm.emit_add(Reg.A, Reg.A)
+    asm.emit_adx(Reg.X, Reg.X)
+    asm.emit_adx(Reg.Y, Reg.Y)
+    asm.emit_ifn(Reg.EX, 0)
+    asm.emit_set(Reg.PC, sub)
+    asm.emit_ifg(Reg.Y, _arg(6))
+    asm.emit_set(Reg.PC, sub)
+    asm.emit_ifn(Reg.Y, _arg(6))
+    asm.emit_set(Reg.PC, bit)
+    asm.emit_ifl(Reg.X, _arg(5))
+    asm.emit_set(Reg.PC, bit)
+    asm.mark_label(sub)
+    asm.emit_sub(Reg.X, _arg(5))
+    asm.emit_sbx(Reg.Y, _arg(6))
+    asm.emit_bor(Reg.B, 1)
+    asm.mark_label(bit)
+    asm.emit_sub(Reg.C, 1)
+    asm.emit_ifn(Reg.C, 0)
+    asm.emit_set(Reg.PC, loop)
+    asm.emit_set(_arg(3), Reg.X)
+    asm.emit_set(_arg(4), Reg.Y)
+    asm.emit_set(Reg.A, Reg.B)
+    asm.emit_set(Reg.B, 0)
+    asm.emit_set(Reg.Y, Pop())
+    asm.emit_set(Reg.X, Pop())
+    asm.emit_set(Reg.PC, Pop())
+
+
+def _emit_divmodl(asm):
+    """
+    Signed division of the long in the first two words by the long in the other two, done
+    on the magnitudes with the unsigned division. The quotient is negative if the signs
+    are different and the remainder has the sign of the dividend, like C wants
+    """
+    asm.emit_blank()
+    asm.mark_label('__divmodl')
+    asm.emit_set(Push(), Reg.X)
+    asm.emit_set(Push(), Reg.Y)
+
+    # X and Y are all ones for a negative dividend and divisor, with them x ^ s - s is
+    # the magnitude of x
+    asm.emit_set(Reg.X, _arg(4))
+    asm.emit_asr(Reg.X, 15)
+    asm.emit_set(Reg.Y, _arg(6))
+    asm.emit_asr(Reg.Y, 15)
+    asm.emit_set(Reg.A, _arg(6))
+    asm.emit_set(Reg.C, _arg(5))
+    asm.emit_xor(Reg.C, Reg.Y)
+    asm.emit_xor(Reg.A, Reg.Y)
+    asm.emit_sub(Reg.C, Reg.Y)
+    asm.emit_sbx(Reg.A, Reg.Y)
+    asm.emit_set(Push(), Reg.A)
+    asm.emit_set(Push(), Reg.C)
+    asm.emit_set(Reg.A, _arg(5))
+    asm.emit_set(Reg.C, _arg(6))
+    asm.emit_xor(Reg.A, Reg.X)
+    asm.emit_xor(Reg.C, Reg.X)
+    asm.emit_sub(Reg.A, Reg.X)
+    asm.emit_sbx(Reg.C, Reg.X)
+    asm.emit_set(Push(), Reg.C)
+    asm.emit_set(Push(), Reg.A)
+    asm.emit_xor(Reg.Y, Reg.X)
+    asm.emit_jsr('__udivmodl')
+
+    # Give the results their signs back
+    asm.emit_xor(Reg.A, Reg.Y)
+    asm.emit_xor(Reg.B, Reg.Y)
+    asm.emit_sub(Reg.A, Reg.Y)
+    asm.emit_sbx(Reg.B, Reg.Y)
+    asm.emit_set(Reg.C, Pop())
+    asm.emit_set(Reg.Y, Pop())
+    asm.emit_xor(Reg.C, Reg.X)
+    asm.emit_xor(Reg.Y, Reg.X)
+    asm.emit_sub(Reg.C, Reg.X)
+    asm.emit_sbx(Reg.Y, Reg.X)
+    asm.emit_add(Reg.SP, 2)
+    asm.emit_set(_arg(3), Reg.C)
+    asm.emit_set(_arg(4), Reg.Y)
+    asm.emit_set(Reg.Y, Pop())
+    asm.emit_set(Reg.X, Pop())
+    asm.emit_set(Reg.PC, Pop())
+
+
+# The helpers by name, with the helpers each of them calls
+HELPERS = {
+    '__shll': (_emit_shll, []),
+    '__shrl': (_emit_shrl, []),
+    '__sarl': (_emit_sarl, []),
+    '__udivmodl': (_emit_udivmodl, []),
+    '__divmodl': (_emit_divmodl, ['__udivmodl']),
+}
+
+
+def emit_runtime(asm, names):
+    """
+    Put the helpers in names, and the ones they call, in the code
+    """
+    needed = set(names)
+    for name in names:
+        needed.update(HELPERS[name][1])
+    for name in sorted(needed):
+        HELPERS[name][0](asm)
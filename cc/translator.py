@@ -1,6 +1,36 @@
 from cc.ast import *
 from cc.parser import Parser
 from .assembler import *
+from .constant import *
+from .peephole import Peephole
+from .runtime import HELPERS, emit_runtime
+
+# The most entries a jump table of a switch may have for every case in it
+JUMP_TABLE_SPAN = 3
+
+# Copies of more words than this are done with a loop instead of one STI for every word
+BLOCK_UNROLL = 32
+
+# How many words every iteration of such a loop copies
+BLOCK_LOOP_STEP = 4
+
+# What the skip instructions test
+SKIP_TEST = {
+    'ife': lambda b, a: b == a,
+    'ifn': lambda b, a: b != a,
+    'ifg': lambda b, a: b > a,
+    'ifl': lambda b, a: b < a,
+    'ifa': lambda b, a: to_signed(b) > to_signed(a),
+    'ifu': lambda b, a: to_signed(b) < to_signed(a),
+    'ifb': lambda b, a: b & a != 0,
+    'ifc': lambda b, a: b & a == 0,
+}
+
+# The skip instruction that tests the same with the operands swapped
+SKIP_MIRRORED = {
+    'ife': 'ife', 'ifn': 'ifn', 'ifb': 'ifb', 'ifc': 'ifc',
+    'ifg': 'ifl', 'ifl': 'ifg', 'ifa': 'ifu', 'ifu': 'ifa',
+}
 
 
 class Translator:
@@ -11,23 +41,41 @@ class Translator:
     https://github.com/0x10cStandardsCommittee/0x10c-Standards/blob/master/ABI/ABI%20draft%202.txt
     """
 
-    def __init__(self, ast):
+    def __init__(self, ast, omit_frame_pointer=False):
         self._ast = ast  # type: Parser
         self._asm = Assembler()
+        self.peephole = Peephole()
+
+        # Address the stack of leaf functions from SP instead of setting up J
+        self.omit_frame_pointer = omit_frame_pointer
 
         # Function compilation state
         self._regs = [Reg.I, Reg.Z, Reg.Y, Reg.X, Reg.C, Reg.B, Reg.A]
         self._to_restore = []
         self._save_on_call = []
-        self._return_pos = []
+        self._epilogues = {}
+        self._last_epilogue = None
         self._stack = 0
         self._params = []
         self._vars = []
 
+        # The size of the stack frame when addressing it from SP, None when J is used
+        self._frame = None
+        self._leaf = True
+
+        # Where a call to ourselves in a tail position jumps to, and if it can't
+        # because something might point into the stack frame
+        self._body_label = None
+        self._frame_escapes = False
+
         # For break and continue
         self._cond_label = []
         self._end_label = []
 
+        # The runtime helpers the file calls, all of them return longs
+        self._runtime = set()
+        self.peephole.long_returns.update(HELPERS)
+
     def clear(self):
         """
         Clear the compilation state
@@ -35,17 +83,23 @@ class Translator:
         self._regs = [Reg.I, Reg.Z, Reg.Y, Reg.X, Reg.C, Reg.B, Reg.A]
         self._to_restore.clear()
         self._save_on_call.clear()
-        self._return_pos.clear()
+        self._epilogues.clear()
+        self._last_epilogue = None
         self._stack = 0
         self._params.clear()
         self._vars.clear()
+        self._frame = None
+        self._leaf = True
+        self._body_label = None
+        self._frame_escapes = False
 
     def _can_resolve_to_operand_without_deref(self, expr):
         if isinstance(expr, ExprNumber):
             return True
 
         elif isinstance(expr, ExprComma):
-            return self._can_resolve_to_operand_without_deref(expr.exprs[-1])
+            # Checking would translate the expressions before the last one
+            return len(expr.exprs) == 1 and self._can_resolve_to_operand_without_deref(expr.exprs[-1])
 
         elif isinstance(expr, ExprIdent):
             typ = expr.resolve_type(self._ast)
@@ -62,11 +116,18 @@ class Translator:
                 return False
 
         elif isinstance(expr, ExprBinary):
-            if self._can_resolve_to_operand_without_deref(expr.left) and self._can_resolve_to_operand_without_deref(expr.right):
+            if self._is_long(expr):
+                return False
+            elif self._can_resolve_to_operand_without_deref(expr.left) and self._can_resolve_to_operand_without_deref(expr.right):
                 left = self._translate_expr(expr.left, None)
                 right = self._translate_expr(expr.right, None)
-                if isinstance(left, Offset) and isinstance(right, int) or \
-                        isinstance(right, Offset) and isinstance(left, int):
+                if expr.op in ['+', '-'] and isinstance(left, Offset) and isinstance(right, int) or \
+                        expr.op == '+' and isinstance(right, Offset) and isinstance(left, int):
+                    # Only adding to the offset can be done at compile time
+                    return True
+                elif expr.op in ['+', '-'] and isinstance(left, Reg) and isinstance(right, int) or \
+                        expr.op == '+' and isinstance(right, Reg) and isinstance(left, int):
+                    # A register plus a constant, like a pointer in a register
                     return True
                 else:
                     return False
@@ -78,20 +139,14 @@ class Translator:
             return True
 
     def _can_resolve_to_operand(self, expr):
-        if self._can_resolve_to_operand_without_deref(expr):
-            return True
+        if isinstance(expr, ExprComma):
+            # Only the last expression is the value
+            return self._can_resolve_to_operand(expr.exprs[-1])
 
-        elif isinstance(expr, ExprBinary):
-            if self._can_resolve_to_operand_without_deref(expr.left) and self._can_resolve_to_operand_without_deref(expr.right):
-                left = self._translate_expr(expr.left, None)
-                right = self._translate_expr(expr.right, None)
-                if isinstance(left, Offset) and isinstance(right, int) or \
-                        isinstance(right, Offset) and isinstance(left, int) or \
-                        isinstance(left, Reg) and isinstance(right, int) and expr.op in '-+' or \
-                        isinstance(right, Reg) and isinstance(left, int) and expr.op in '-+':
-                    return True
-                else:
-                    return False
+        elif self._can_resolve_to_operand_without_deref(expr):
+            # An address on the stack or a register plus a constant is not a
+            # valid operand by itself, only once it is dereferenced
+            return not isinstance(self._translate_expr(expr, None), Offset)
 
         elif isinstance(expr, ExprCast):
             return self._can_resolve_to_operand(expr.expr)
@@ -99,12 +154,97 @@ class Translator:
         elif isinstance(expr, ExprIdent):
             return True
 
+        elif isinstance(expr, ExprDeref):
+            if self._can_resolve_to_operand_without_deref(expr.expr):
+                return True
+
+        return False
+
+    def _evaluated_after_write(self, expr, parts):
+        """
+        Get the parts of an expression which are evaluated after the destination
+        it is translated into was first written to
+        """
+        if isinstance(expr, ExprBinary) and expr.op not in ['&&', '||'] and expr.op not in NEGATED:
+            self._evaluated_after_write(expr.left, parts)
+            parts.append(expr.right)
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprDeref):
+            # The address is calculated into the destination before it is read from
+            self._evaluated_after_write(expr.expr, parts)
         elif isinstance(expr, ExprComma):
-            return self._can_resolve_to_operand(expr.exprs[-1])
+            self._evaluated_after_write(expr.exprs[-1], parts)
+        return parts
+
+    def _may_read(self, expr, destination):
+        """
+        Check if an expression might read the destination of a copy
+        """
+        if isinstance(expr, ExprCall):
+            return True
+
+        elif isinstance(expr, ExprIdent):
+            if isinstance(destination, ExprIdent):
+                return expr.ident == destination.ident
+            return isinstance(expr.ident, GlobalIdentifier)
 
         elif isinstance(expr, ExprDeref):
-            if self._can_resolve_to_operand_without_deref(expr.expr):
+            if not isinstance(destination, ExprIdent) or isinstance(destination.ident, GlobalIdentifier):
                 return True
+            return self._may_read(expr.expr, destination)
+
+        elif isinstance(expr, ExprBinary):
+            return self._may_read(expr.left, destination) or self._may_read(expr.right, destination)
+
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprAddrof):
+            return self._may_read(expr.expr, destination)
+
+        elif isinstance(expr, ExprCopy):
+            return self._may_read(expr.source, destination) or self._may_read(expr.destination, destination)
+
+        elif isinstance(expr, ExprComma):
+            return any([self._may_read(e, destination) for e in expr.exprs])
+
+        elif isinstance(expr, ExprLoop):
+            return self._may_read(expr.cond, destination) or self._may_read(expr.body, destination) or \
+                self._may_read(expr.step, destination)
+
+        elif isinstance(expr, ExprSwitch):
+            return self._may_read(expr.expr, destination) or self._may_read(expr.body, destination)
+
+        return False
+
+    def _reads_reg(self, expr, reg):
+        """
+        Check if an expression reads a variable or parameter that lives in the register
+        """
+        if isinstance(expr, ExprIdent):
+            if isinstance(expr.ident, VariableIdentifier):
+                return self._get_var(expr.ident.index) == reg
+            elif isinstance(expr.ident, ParameterIdentifier):
+                return self._get_param(expr.ident.index) == reg
+            return False
+
+        elif isinstance(expr, ExprCall):
+            return self._reads_reg(expr.func, reg) or any([self._reads_reg(e, reg) for e in expr.args])
+
+        elif isinstance(expr, ExprBinary):
+            return self._reads_reg(expr.left, reg) or self._reads_reg(expr.right, reg)
+
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprAddrof) or \
+                isinstance(expr, ExprDeref) or isinstance(expr, ExprReturn):
+            return self._reads_reg(expr.expr, reg)
+
+        elif isinstance(expr, ExprCopy):
+            return self._reads_reg(expr.source, reg) or self._reads_reg(expr.destination, reg)
+
+        elif isinstance(expr, ExprComma):
+            return any([self._reads_reg(e, reg) for e in expr.exprs])
+
+        elif isinstance(expr, ExprLoop):
+            return self._reads_reg(expr.cond, reg) or self._reads_reg(expr.body, reg) or self._reads_reg(expr.step, reg)
+
+        elif isinstance(expr, ExprSwitch):
+            return self._reads_reg(expr.expr, reg) or self._reads_reg(expr.body, reg)
 
         return False
 
@@ -117,17 +257,17 @@ class Translator:
     def _alloc_scratch(self):
         if len(self._regs) == 0:
             # if out of registers allocate a scratch on the stack
-            return self._alloca(2)
+            return Deref(self._alloca(1))
         else:
             reg = self._regs.pop()
-            if reg in [Reg.J, Reg.Z, Reg.Y, Reg.X] and reg not in self._to_restore:
+            if reg in [Reg.J, Reg.I, Reg.Z, Reg.Y, Reg.X] and reg not in self._to_restore:
                 self._to_restore.append(reg)
             if reg in [Reg.A, Reg.B, Reg.C] and reg not in self._save_on_call:
                 self._save_on_call.append(reg)
             return reg
 
     def _free_scratch(self, reg: Reg):
-        if isinstance(reg, Offset):
+        if isinstance(reg, Deref):
             # If this is a spilled register then append it
             # to the start of the list, so it will have least
             # priority on allocation
@@ -146,36 +286,1484 @@ class Translator:
         if reg in self._regs:
             self._regs.remove(reg)
 
+    def _operand_reg(self, op):
+        """
+        The register an operand reads, or None
+        """
+        op = op.a if isinstance(op, Deref) else op
+        op = op.a if isinstance(op, Offset) else op
+        return op if isinstance(op, Reg) else None
+
+    def _place_arguments(self, args, targets):
+        """
+        Place the arguments of a call in the target registers (or stack slots)
+
+        The arguments may be calculated from the values that are in the targets right
+        now, so all of them are moved at once. Returns the registers that have to be freed
+        after the call
+        """
+        def reads(op, target):
+            if isinstance(target, Reg):
+                return self._operand_reg(op) == target
+            return str(op) == str(target)
+
+        def alloc_aside():
+            # A target is free until an argument is placed in it, which might have happened
+            # already, so a value put aside is never kept in one
+            regs = self._regs
+            self._regs = [reg for reg in regs if reg not in targets]
+            tmp = self._alloc_scratch()
+            self._regs = [reg for reg in regs if reg != tmp]
+            return tmp
+
+        # Calculate everything which is not an operand first, this might
+        # call other functions which would change what we already placed
+        sources = []
+        scratches = []
+        reserved = []
+        for i, (arg, reg) in enumerate(zip(args, targets)):
+            assert not isinstance(arg.resolve_type(self._ast), CStruct)
+            others = args[:i] + args[i + 1:] + self._evaluated_after_write(arg, [])
+            if self._can_resolve_to_operand(arg):
+                sources.append(self._translate_expr(arg, None))
+            elif isinstance(reg, Reg) and not any([self._reads_reg(e, reg) for e in others]):
+                # Nothing else needs what is in the register, so calculate it in place
+                if reg in self._regs:
+                    self._regs.remove(reg)
+                    self._save_on_call.append(reg)
+                    reserved.append(reg)
+                self._translate_expr(arg, reg)
+                sources.append(reg)
+            else:
+                reg = alloc_aside()
+                self._translate_expr(arg, reg)
+                sources.append(reg)
+                scratches.append(reg)
+
+        # Place every argument whose target no other argument still needs
+        moves = list(zip(targets, sources))
+        while len(moves) != 0:
+            for i, (reg, src) in enumerate(moves):
+                if not any([reads(other, reg) for j, (_, other) in enumerate(moves) if j != i]):
+                    if str(src) != str(reg):
+                        self._asm.emit_set(reg, src)
+                    moves.pop(i)
+                    break
+            else:
+                # The targets are needed in a cycle, moving one of the
+                # values to the side frees the target it was read from
+                reg, src = moves[0]
+                tmp = alloc_aside()
+                self._asm.emit_set(tmp, src)
+                moves[0] = (reg, tmp)
+                scratches.append(tmp)
+
+        for reg in scratches:
+            self._free_scratch(reg)
+
+        # The arguments have to stay where they are until the call
+        for reg in targets:
+            if isinstance(reg, Reg) and reg in self._regs:
+                self._regs.remove(reg)
+                self._save_on_call.append(reg)
+                reserved.append(reg)
+        return reserved
+
+    def _addresses_frame(self, expr):
+        """
+        Check if an expression takes the address of anything in the stack frame
+        """
+        if isinstance(expr, ExprAddrof):
+            if isinstance(expr.expr, ExprIdent) and (isinstance(expr.expr.ident, VariableIdentifier) or
+                                                     isinstance(expr.expr.ident, ParameterIdentifier)):
+                return True
+            return self._addresses_frame(expr.expr)
+
+        elif isinstance(expr, ExprIdent):
+            # Arrays and structs are used by their address
+            if isinstance(expr.ident, VariableIdentifier) or isinstance(expr.ident, ParameterIdentifier):
+                typ = expr.resolve_type(self._ast)
+                return isinstance(typ, CArray) or isinstance(typ, CStruct)
+            return False
+
+        elif isinstance(expr, ExprCall):
+            return self._addresses_frame(expr.func) or any([self._addresses_frame(e) for e in expr.args])
+
+        elif isinstance(expr, ExprBinary):
+            return self._addresses_frame(expr.left) or self._addresses_frame(expr.right)
+
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprDeref) or isinstance(expr, ExprReturn):
+            return self._addresses_frame(expr.expr)
+
+        elif isinstance(expr, ExprCopy):
+            return self._addresses_frame(expr.source) or self._addresses_frame(expr.destination)
+
+        elif isinstance(expr, ExprComma):
+            return any([self._addresses_frame(e) for e in expr.exprs])
+
+        elif isinstance(expr, ExprLoop):
+            return self._addresses_frame(expr.cond) or self._addresses_frame(expr.body) or self._addresses_frame(expr.step)
+
+        elif isinstance(expr, ExprSwitch):
+            return self._addresses_frame(expr.expr) or self._addresses_frame(expr.body)
+
+        return False
+
+    def _used_vars(self, expr, used):
+        """
+        Collect the indexes of the local variables an expression uses
+        """
+        if isinstance(expr, ExprIdent) and isinstance(expr.ident, VariableIdentifier):
+            used.add(expr.ident.index)
+
+        elif isinstance(expr, ExprCall):
+            self._used_vars(expr.func, used)
+            for e in expr.args:
+                self._used_vars(e, used)
+
+        elif isinstance(expr, ExprBinary):
+            self._used_vars(expr.left, used)
+            self._used_vars(expr.right, used)
+
+        elif isinstance(expr, ExprCast) or isinstance(expr, ExprDeref) or isinstance(expr, ExprAddrof) or \
+                isinstance(expr, ExprReturn):
+            self._used_vars(expr.expr, used)
+
+        elif isinstance(expr, ExprCopy):
+            self._used_vars(expr.source, used)
+            self._used_vars(expr.destination, used)
+
+        elif isinstance(expr, ExprComma):
+            for e in expr.exprs:
+                self._used_vars(e, used)
+
+        elif isinstance(expr, ExprLoop):
+            self._used_vars(expr.cond, used)
+            self._used_vars(expr.body, used)
+            self._used_vars(expr.step, used)
+
+        elif isinstance(expr, ExprSwitch):
+            self._used_vars(expr.expr, used)
+            self._used_vars(expr.body, used)
+
+        return used
+
+    def _tail_call_targets(self, expr):
+        """
+        Where the arguments of a call we return the value of go if we can leave the
+        function before making it, or None if we can't
+
+        The function we call takes our place, it gets its stack arguments where ours
+        are (our caller is going to remove them) and returns straight to our caller
+        """
+        if not isinstance(expr, ExprCall) or self._frame_escapes:
+            return None
+
+        typ = expr.func.resolve_type(self._ast)
+        if typ.callconv == CallConv.STACKCALL:
+            regs = []
+            stack_args = expr.args
+        elif typ.callconv == CallConv.REGCALL:
+            regs = [Reg.A, Reg.B, Reg.C][:len(expr.args)]
+            stack_args = expr.args[3:]
+        else:
+            return None
+
+        func = self._ast.func
+        if func.type.callconv not in [CallConv.STACKCALL, CallConv.REGCALL] or \
+                any([param.sizeof() != 1 for param in func.type.param_types + typ.param_types]) or \
+                self._is_long_type(func.type.ret_type) != self._is_long_type(typ.ret_type):
+            return None
+
+        slots = [Deref(param) for param in self._params if not isinstance(param, Reg)]
+        if len(slots) != len(stack_args):
+            return None
+
+        # The function ending changes the registers and the stack
+        if not self._can_resolve_to_operand(expr.func) or \
+                self._operand_reg(self._translate_expr(expr.func, None)) is not None:
+            return None
+
+        return regs + slots
+
+    def _translate_tail_call(self, expr, targets):
+        """
+        Place the arguments of a tail call, returns where the function ending should jump
+        to, or None if it jumped back to our own start
+        """
+        for reg in self._place_arguments(expr.args, targets):
+            self._free_scratch(reg)
+
+        if isinstance(expr.func, ExprIdent) and isinstance(expr.func.ident, FunctionIdentifier) and \
+                self._ast.func_list[expr.func.ident.index] is self._ast.func:
+            # Calling ourselves, everything is already set up
+            self._asm.emit_set(Reg.PC, self._body_label)
+            return None
+
+        return self._translate_expr(expr.func, None)
+
     def _alloca(self, size):
         self._stack += size
+        if self._frame is not None:
+            # SP points below all of the frame
+            return Offset(Reg.SP, self._frame - self._stack)
         return Offset(Reg.J, -self._stack)
 
+    def _translate_div_by_constant(self, dest, d, signed, modulo):
+        """
+        Lower a division (or modulo) of dest by the constant d when there is something
+        cheaper than DIV/DVI/MOD/MDI, dividing by one (or minus one when signed) and
+        unsigned dividing by a power of two, which is a shift or a mask
+
+        A multiply-high (MUL and then the high word from EX) is never faster than the
+        3 cycles of a division, so all of the other constants are left to it
+
+        returns True if emitted the instructions
+        """
+        d &= 0xFFFF
+        if signed and d == 0xFFFF:
+            if modulo:
+                self._asm.emit_set(dest, 0)
+            else:
+                self._asm.emit_mli(dest, -1)
+        elif d == 1:
+            if modulo:
+                self._asm.emit_set(dest, 0)
+        elif not signed and d != 0 and d & (d - 1) == 0:
+            if modulo:
+                self._asm.emit_and(dest, d - 1)
+            else:
+                self._asm.emit_shr(dest, d.bit_length() - 1)
+        else:
+            return False
+        return True
+
+    def _condition_operand(self, expr):
+        """
+        Get the operand of an expression if it can be used without running any code
+        """
+        if not isinstance(expr, ExprComma) and self._can_resolve_to_operand(expr):
+            op = self._translate_expr(expr, None)
+            if not isinstance(op, Offset):
+                return op
+        return None
+
+    def _as_comparison(self, expr):
+        """
+        Get a condition as an operator between two expressions and if it is a signed
+        comparison, anything which is not a comparison is compared against 0
+        """
+        if isinstance(expr, ExprBinary) and expr.op in NEGATED:
+            t1 = expr.left.resolve_type(self._ast)
+            t2 = expr.right.resolve_type(self._ast)
+            signed = isinstance(t1, CInteger) and t1.signed and isinstance(t2, CInteger) and t2.signed
+            if isinstance(t1, CInteger) and isinstance(t2, CInteger) and t1.bits != t2.bits:
+                # The smaller one is converted to the bigger one
+                signed = t1.signed if t1.bits > t2.bits else t2.signed
+            return expr.op, expr.left, expr.right, signed
+        elif isinstance(expr, ExprBinary) and expr.op == '&':
+            return '&', expr.left, expr.right, False
+        else:
+            return '!=', expr, ExprNumber(0), False
+
+    def _is_negation(self, expr):
+        """
+        Check if this is `x == 0`, which is how `!x` is parsed
+        """
+        return isinstance(expr, ExprBinary) and expr.op == '==' and \
+            isinstance(expr.right, ExprNumber) and expr.right.value == 0
+
+    def _compare_tests(self, op, signed, left, right, negate):
+        """
+        The skip instructions that test a comparison between two operands
+
+        The result is a list of alternatives, the comparison holds if all the tests
+        of one of the alternatives pass, so an empty list never holds and a list
+        with an empty alternative always holds
+        """
+        if op == '&':
+            return [[(self._asm.emit_ifc if negate else self._asm.emit_ifb, left, right)]]
+
+        if negate:
+            op = NEGATED[op]
+
+        if isinstance(left, int) and isinstance(right, int):
+            return [[]] if evaluate(op, left, right, signed) else []
+
+        # Literals can only be short in the a operand
+        if isinstance(left, int):
+            left, right, op = right, left, MIRRORED[op]
+
+        # There is no skip for these, but against a constant they are the same as a strict
+        # comparison against the constant next to it
+        if isinstance(right, int):
+            right = wrap(right, signed)
+            lowest, highest = (-0x8000, 0x7FFF) if signed else (0, 0xFFFF)
+            if op in ['>=', '<'] and right == lowest or op in ['<=', '>'] and right == highest:
+                return [[]] if op in ['>=', '<='] else []
+            elif op == '>=':
+                op, right = '>', right - 1
+            elif op == '<=':
+                op, right = '<', right + 1
+
+        greater = self._asm.emit_ifa if signed else self._asm.emit_ifg
+        less = self._asm.emit_ifu if signed else self._asm.emit_ifl
+        if op == '==':
+            return [[(self._asm.emit_ife, left, right)]]
+        elif op == '!=':
+            return [[(self._asm.emit_ifn, left, right)]]
+        elif op == '>':
+            return [[(greater, left, right)]]
+        elif op == '<':
+            return [[(less, left, right)]]
+        elif op == '>=':
+            return [[(greater, left, right)], [(self._asm.emit_ife, left, right)]]
+        elif op == '<=':
+            return [[(less, left, right)], [(self._asm.emit_ife, left, right)]]
+        else:
+            assert False
+
+    def _condition_tests(self, expr, negate):
+        """
+        Get the skip instructions which test a condition (or its negation), in the
+        same form as `_compare_tests`, all the tests of an alternative are chained
+        so they are all skipped as soon as one of them fails
+
+        Returns None if the condition needs any code to calculate its operands
+        """
+        if isinstance(expr, ExprNumber):
+            return [[]] if (expr.value != 0) != negate else []
+
+        elif isinstance(expr, ExprCast):
+            return self._condition_tests(expr.expr, negate)
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            left = self._condition_tests(expr.left, negate)
+            right = self._condition_tests(expr.right, negate)
+            if left is None or right is None:
+                return None
+
+            if (expr.op == '&&') == negate:
+                # Any of them
+                return left + right
+            elif len(left) <= 1 and len(right) <= 1:
+                # Both of them, chain the tests together
+                return [l + r for l in left for r in right]
+            else:
+                return None
+
+        elif self._is_negation(expr):
+            return self._condition_tests(expr.left, not negate)
+
+        elif isinstance(expr, ExprComma):
+            return None
+
+        op, left, right, signed = self._as_comparison(expr)
+        if self._is_long(left) or self._is_long(right):
+            left = self._long_operand(left)
+            right = self._long_operand(right)
+            if left is None or right is None:
+                return None
+            return self._long_compare_tests(op, signed, left, right, negate)
+
+        left = self._condition_operand(left)
+        right = self._condition_operand(right)
+        if left is None or right is None:
+            return None
+        return self._compare_tests(op, signed, left, right, negate)
+
+    def _emit_tests(self, tests, emit):
+        """
+        Emit the tests, emit is called to emit the instruction that runs when
+        the tests of an alternative pass
+        """
+        for alternative in tests:
+            for inst, b, a in alternative:
+                inst(b, a)
+            emit()
+
+            # The rest will never be reached
+            if len(alternative) == 0:
+                break
+
+    def _translate_branch(self, expr, label, when):
+        """
+        Jump to the label if the truth of the condition is the same as `when`, otherwise
+        fall through, this never turns the condition into a value
+        """
+        if isinstance(expr, ExprComma):
+            for e in expr.exprs[:-1]:
+                self._translate_expr(e, None)
+            self._translate_branch(expr.exprs[-1], label, when)
+            return
+
+        elif isinstance(expr, ExprCast):
+            self._translate_branch(expr.expr, label, when)
+            return
+
+        elif isinstance(expr, ExprReturn) or isinstance(expr, ExprBreak) or isinstance(expr, ExprContinue):
+            # These never continue to the test, so there is nothing to test
+            self._translate_expr(expr, None)
+            return
+
+        # Try to test the whole condition with chained skips
+        tests = self._condition_tests(expr, not when)
+        if tests is not None:
+            self._emit_tests(tests, lambda: self._asm.emit_set(Reg.PC, label))
+
+        elif isinstance(expr, ExprBinary) and expr.op in ['&&', '||']:
+            if (expr.op == '&&') == when:
+                # Both of them need to match, so skip the second if the first does not
+                skip = self._asm.make_label()
+                self._translate_branch(expr.left, skip, not when)
+                self._translate_branch(expr.right, label, when)
+                self._asm.mark_label(skip)
+            else:
+                # Either of them is enough
+                self._translate_branch(expr.left, label, when)
+                self._translate_branch(expr.right, label, when)
+
+        elif self._is_negation(expr):
+            self._translate_branch(expr.left, label, not when)
+
+        else:
+            # Calculate the operands and test them
+            op, left, right, signed = self._as_comparison(expr)
+            is_long = self._is_long(left) or self._is_long(right)
+            scratch = []
+            operands = []
+            for e in [left, right]:
+                if is_long:
+                    operand = self._long_operand(e)
+                    if operand is None:
+                        operand = self._alloc_long()
+                        scratch += operand
+                        self._translate_long(e, operand)
+                else:
+                    operand = self._condition_operand(e)
+                    if operand is None:
+                        operand = self._alloc_scratch()
+                        scratch.append(operand)
+                        self._translate_expr(e, operand)
+                operands.append(operand)
+
+            if is_long:
+                tests = self._long_compare_tests(op, signed, operands[0], operands[1], not when)
+            else:
+                tests = self._compare_tests(op, signed, operands[0], operands[1], not when)
+            self._emit_tests(tests, lambda: self._asm.emit_set(Reg.PC, label))
+
+            for reg in scratch[::-1]:
+                self._free_scratch(reg)
+
+    def _translate_predicated(self, tests, body):
+        """
+        Try to run a body which translates to a single instruction (maybe
+        behind skips of its own) only if the tests pass, without branching,
+        if the body is too big nothing is emitted
+
+        Returns True if the body was emitted
+        """
+        pos = self._asm.get_pos()
+        epilogues = dict(self._epilogues)
+        stack = self._stack
+        regs = list(self._regs)
+        to_restore = list(self._to_restore)
+        save_on_call = list(self._save_on_call)
+
+        self._translate_expr(body, None)
+        insts = self._asm.take_instructions(pos)
+
+        if not all([inst.is_instruction for inst in insts]) or \
+                len(insts) > 0 and (insts[-1].is_skip or not all([inst.is_skip for inst in insts[:-1]])):
+            # Forget about anything done for the body, a stack slot it spilled to is not part of
+            # the frame anymore and must not be handed out as a scratch
+            self._epilogues = epilogues
+            self._stack = stack
+            self._regs = regs
+            self._to_restore = to_restore
+            self._save_on_call = save_on_call
+            return False
+
+        if len(insts) > 0:
+            for inst, b, a in tests:
+                inst(b, a)
+            for inst in insts:
+                self._asm.put_instruction(inst)
+        return True
+
+    def _translate_condition(self, expr, dest):
+        """
+        Turn a condition into a 0 or 1 value
+        """
+        tests = self._condition_tests(expr, False)
+        if tests is not None:
+            # The destination is set before the operands are tested, so it can't be one of them
+            def uses(op):
+                return self._operand_reg(op) == dest
+
+            if isinstance(dest, Reg) and not any([uses(b) or uses(a) for alt in tests for _, b, a in alt]):
+                reg = dest
+            else:
+                reg = self._alloc_scratch()
+
+            self._asm.emit_set(reg, 0)
+            self._emit_tests(tests, lambda: self._asm.emit_set(reg, 1))
+
+            if reg is not dest:
+                self._asm.emit_set(dest, reg)
+                self._free_scratch(reg)
+
+        else:
+            false = self._asm.make_label()
+            end = self._asm.make_label()
+            self._translate_branch(expr, false, False)
+            self._asm.emit_set(dest, 1)
+            self._asm.emit_set(Reg.PC, end)
+            self._asm.mark_label(false)
+            self._asm.emit_set(dest, 0)
+            self._asm.mark_label(end)
+
+    def _search_cost(self, op, values, misses):
+        """
+        The cycles it takes to get to every one of the sorted case values, and to the default
+        for the given share of the values which are not cases, by testing the values one after
+        the other or by splitting them in half first. Returns the cost and where to split,
+        which is None for testing them one after the other
+        """
+        jump = inst_cycles('SET', Reg.PC, 'label')
+
+        # A test that fails skips the jump after it
+        cost = 0
+        tested = 0
+        for value in values:
+            test = inst_cycles('IFE', op, value)
+            cost += tested + test + jump
+            tested += test + 1
+        cost += (tested + jump) * misses
+        best = cost, None
+
+        if len(values) > 2:
+            mid = len(values) // 2
+            test = inst_cycles('IFL', op, values[mid])
+            cost = self._search_cost(op, values[:mid], misses / 2)[0] + \
+                self._search_cost(op, values[mid:], misses / 2)[0]
+
+            # The lower half takes the jump, the upper half skips it
+            cost += (mid + misses / 2) * (test + jump) + (len(values) - mid + misses / 2) * (test + 1)
+            if cost < best[0]:
+                best = cost, mid
+
+        return best
+
+    def _translate_search(self, op, cases, misses, default, signed):
+        """
+        Jump to the label of the case the operand matches, or to the default, the cases are sorted
+        """
+        _, mid = self._search_cost(op, [value for value, _ in cases], misses)
+        if mid is None:
+            for value, label in cases:
+                self._asm.emit_ife(op, value)
+                self._asm.emit_set(Reg.PC, label)
+            self._asm.emit_set(Reg.PC, default)
+
+        else:
+            lower = self._asm.make_label()
+            less = self._asm.emit_ifu if signed else self._asm.emit_ifl
+            less(op, cases[mid][0])
+            self._asm.emit_set(Reg.PC, lower)
+            self._translate_search(op, cases[mid:], misses / 2, default, signed)
+            self._asm.mark_label(lower)
+            self._translate_search(op, cases[:mid], misses / 2, default, signed)
+
+    def _table_base(self, values):
+        """
+        The value the jump table starts from, or None if the cases are too sparse
+        for one, a table that starts at 0 doesn't need the value to be adjusted so
+        a few entries for the values below the first case are worth it
+        """
+        if len(values) == 0:
+            return None
+        limit = JUMP_TABLE_SPAN * len(values)
+        if 0 <= values[0] < JUMP_TABLE_SPAN and values[-1] < limit:
+            return 0
+        elif values[-1] - values[0] < limit:
+            return values[0]
+        return None
+
+    def _table_cost(self, op, values, misses, base, copy):
+        """
+        The cycles it takes to get to every one of the sorted case values, and to the
+        default for the given share of the values which are not cases, with a jump table
+        """
+        span = values[-1] - base + 1
+        prepare = 0
+        if copy:
+            prepare += inst_cycles('SET', Reg.A, op)
+        if base != 0:
+            prepare += inst_cycles('SUB', Reg.A, abs(base))
+        test = inst_cycles('IFG', Reg.A, span - 1)
+        dispatch = inst_cycles('SET', Reg.PC, Deref(Offset(Reg.A, 'table')))
+        return len(values) * (prepare + test + 1 + dispatch) + \
+            misses * (prepare + test + inst_cycles('SET', Reg.PC, 'label'))
+
+    def _translate_dispatch(self, expr, cases, default, signed):
+        """
+        Jump to the label of the case the value of the expression matches, or to the default,
+        with a jump table, a binary search or by testing the cases one after the other,
+        whichever takes the least cycles
+        """
+        op = self._condition_operand(expr)
+        if isinstance(op, int):
+            # We already know where to go
+            cases = dict(cases)
+            self._asm.emit_set(Reg.PC, cases.get(wrap(op, signed), default))
+            return
+
+        scratch = None
+        if op is None:
+            op = scratch = self._alloc_scratch()
+            self._translate_expr(expr, op)
+
+        cases = sorted(cases)
+        values = [value for value, _ in cases]
+        cost, _ = self._search_cost(op, values, 1)
+
+        # The table needs the value in a register, which we change unless the table starts at 0
+        base = self._table_base(values)
+        copy = not isinstance(op, Reg) or scratch is None and base != 0
+        if base is not None and self._table_cost(op, values, 1, base, copy) < cost:
+            reg = self._alloc_scratch() if copy else op
+            if isinstance(reg, Reg):
+                if copy:
+                    self._asm.emit_set(reg, op)
+                if base > 0:
+                    self._asm.emit_sub(reg, base)
+                elif base < 0:
+                    self._asm.emit_add(reg, -base)
+
+                # The values below the start wrap around to above the end
+                span = values[-1] - base + 1
+                self._asm.emit_ifg(reg, span - 1)
+                self._asm.emit_set(Reg.PC, default)
+
+                table = self._asm.make_label()
+                self._asm.emit_set(Reg.PC, Deref(Offset(reg, table)))
+                self._asm.mark_label(table)
+                labels = dict(cases)
+                for value in range(base, base + span):
+                    self._asm.emit_word(labels.get(value, default))
+
+                op = None
+
+            if copy:
+                self._free_scratch(reg)
+
+        if op is not None:
+            self._translate_search(op, cases, 1, default, signed)
+
+        if scratch is not None:
+            self._free_scratch(scratch)
+
+    def _statements(self, expr, stmts):
+        if isinstance(expr, ExprComma):
+            for e in expr.exprs:
+                self._statements(e, stmts)
+        elif not isinstance(expr, ExprNop):
+            stmts.append(expr)
+        return stmts
+
+    def _translate_switch(self, expr):
+        end_lbl = self._asm.make_label()
+        stmts = self._statements(expr.body, [])
+
+        # Every case starts at a label of its own
+        labels = {}
+        cases = []
+        default = end_lbl
+        for stmt in stmts:
+            if isinstance(stmt, ExprCase):
+                labels[id(stmt)] = self._asm.make_label()
+                if stmt.value is None:
+                    default = labels[id(stmt)]
+                else:
+                    cases.append((stmt.value, labels[id(stmt)]))
+
+        typ = expr.expr.resolve_type(self._ast)
+        if self._is_long_type(typ):
+            self._translate_long_dispatch(expr.expr, cases, default)
+        else:
+            self._translate_dispatch(expr.expr, cases, default, isinstance(typ, CInteger) and typ.signed)
+
+        # A break leaves the switch, a continue still goes to the loop around it
+        self._end_label.append(end_lbl)
+        for stmt in stmts:
+            if isinstance(stmt, ExprCase):
+                self._asm.mark_label(labels[id(stmt)])
+            else:
+                self._translate_expr(stmt, None)
+        self._end_label.pop()
+        self._asm.mark_label(end_lbl)
+
+    def _alloc_register(self, reg):
+        """
+        Allocate a specific scratch register, returns None if it is in use
+        """
+        if reg not in self._regs:
+            return None
+        self._regs.remove(reg)
+        self._regs.append(reg)
+        return self._alloc_scratch()
+
+    def _free_registers(self):
+        """
+        How many registers can still be allocated without spilling, not counting I and J
+        """
+        return len([reg for reg in self._regs if isinstance(reg, Reg) and reg not in [Reg.I, Reg.J]])
+
+    def _claim_block_registers(self, keep, needed):
+        """
+        Get I and J ready for STI/STD, the ones in keep already hold the pointer they are used for.
+        The ones in use are saved in scratch registers, returns the scratch register every one was
+        saved in and the ones which were free, or None (without emitting anything) if there are not
+        enough registers left for that and for the other scratch registers that are needed
+        """
+        in_use = [reg for reg in [Reg.I, Reg.J] if reg not in keep and reg not in self._regs]
+        if self._free_registers() < len(in_use) + needed:
+            return None
+
+        claimed = []
+        for reg in [Reg.I, Reg.J]:
+            if reg not in keep and reg not in in_use:
+                claimed.append(self._alloc_register(reg))
+
+        saved = {}
+        for reg in in_use:
+            saved[reg] = self._alloc_scratch()
+            self._asm.emit_set(saved[reg], reg)
+        return saved, claimed
+
+    def _release_block_registers(self, saved, claimed, moves):
+        """
+        Give I and J back, moves are the (destination, source) pairs to set on the way
+        out, which win over restoring a saved register
+        """
+        targets = [d for d, s in moves]
+        pending = [(d, s) for d, s in moves if d != s] + \
+                  [(reg, save) for reg, save in saved.items() if reg not in targets]
+
+        # Never overwrite a register before everything that reads it was set
+        while len(pending) != 0:
+            for i, (d, s) in enumerate(pending):
+                if not any([src == d for j, (dst, src) in enumerate(pending) if j != i]):
+                    self._asm.emit_set(d, s)
+                    del pending[i]
+                    break
+            else:
+                assert False
+
+        for reg in list(saved.values()) + claimed:
+            self._free_scratch(reg)
+
+    def _redirect(self, op, saved):
+        """
+        Read the saved copy of a register that STI/STD uses instead
+        """
+        if isinstance(op, Reg) and op in saved:
+            return saved[op]
+        elif isinstance(op, Offset) and op.a in saved:
+            return Offset(saved[op.a], op.offset)
+        return op
+
+    def _load_address(self, reg, op):
+        if op.a != reg:
+            self._asm.emit_set(reg, op.a)
+        if op.offset > 0:
+            self._asm.emit_add(reg, op.offset)
+        elif op.offset < 0:
+            self._asm.emit_sub(reg, -op.offset)
+
+    def _block_address(self, expr):
+        """
+        The address of a struct or array we copy from or to
+        """
+        if isinstance(expr, ExprIdent):
+            return ExprAddrof(expr, expr.pos)
+        elif isinstance(expr, ExprDeref):
+            return expr.expr
+        elif isinstance(expr, ExprCast):
+            return self._block_address(expr.expr)
+        else:
+            assert False, f'`{expr}` ({type(expr)})'
+
+    def _block_operand(self, expr, tofree):
+        """
+        Get an address as a register and an offset from it, calculates it into a scratch
+        register (which is added to tofree) if it is not in one already
+        """
+        if self._can_resolve_to_operand_without_deref(expr):
+            op = self._translate_expr(expr, None)
+            if isinstance(op, Offset) and isinstance(op.a, Reg):
+                return op
+            elif isinstance(op, Reg):
+                return Offset(op, 0)
+            elif isinstance(op, str):
+                # A global, its words are at the label
+                return Offset(op, 0)
+        reg = self._alloc_scratch()
+        tofree.append(reg)
+        self._translate_expr(expr, reg)
+        return Offset(reg, 0)
+
+    def _block_cost(self, dst, src, words):
+        """
+        The cycles it takes to copy the words one SET at a time, and with STI
+        """
+        sets = 0
+        for i in range(words):
+            sets += 1 + int(dst.offset + i != 0) + int(src.offset + i != 0)
+
+        def load(op):
+            return 1 + (0 if op.offset == 0 else 2 + int(abs(op.offset) > 30))
+
+        # Every register in use is saved and restored, a free one is pushed and popped
+        # by the function instead unless that is already done
+        sti = 2 * words + load(dst) + load(src)
+        for reg in [Reg.I, Reg.J]:
+            if reg not in self._regs or reg not in self._to_restore:
+                sti += 2
+        return sets, sti
+
+    def _translate_block_copy(self, expr, tofree):
+        """
+        Copy a struct or an array, returns where the destination is
+        """
+        if isinstance(expr.source, ExprCopy):
+            # For `a = b = c` c is copied to b and then b to a
+            src = self._translate_block_copy(expr.source, tofree)
+        else:
+            src = self._block_operand(self._block_address(expr.source), tofree)
+        dst = self._block_operand(self._block_address(expr.destination), tofree)
+        words = expr.destination.resolve_type(self._ast).sizeof()
+
+        sets, sti = self._block_cost(dst, src, words)
+        claim = self._claim_block_registers([], 1 if words > BLOCK_UNROLL else 0) if sti < sets else None
+        if claim is None:
+            for i in range(words):
+                self._asm.emit_set(Deref(Offset(dst.a, dst.offset + i)), Deref(Offset(src.a, src.offset + i)))
+            return dst
+
+        # J might be the frame pointer the destination is relative to, so it is loaded last
+        saved, claimed = claim
+        self._load_address(Reg.I, self._redirect(dst, saved))
+        self._load_address(Reg.J, self._redirect(src, saved))
+
+        if words <= BLOCK_UNROLL:
+            for i in range(words):
+                self._asm.emit_sti(Deref(Reg.I), Deref(Reg.J))
+        else:
+            # Go over the rest with a few words every iteration, until I gets to the end
+            for i in range(words % BLOCK_LOOP_STEP):
+                self._asm.emit_sti(Deref(Reg.I), Deref(Reg.J))
+            end = self._alloc_scratch()
+            self._asm.emit_set(end, Reg.I)
+            self._asm.emit_add(end, words - words % BLOCK_LOOP_STEP)
+            loop = self._asm.make_and_mark_label()
+            for i in range(BLOCK_LOOP_STEP):
+                self._asm.emit_sti(Deref(Reg.I), Deref(Reg.J))
+            self._asm.emit_ifn(Reg.I, end)
+            self._asm.emit_set(Reg.PC, loop)
+            self._free_scratch(end)
+
+        self._release_block_registers(saved, claimed, [])
+        return dst
+
+    def _ident_location(self, expr):
+        """
+        Where a variable or a parameter is kept, or None
+        """
+        if isinstance(expr, ExprIdent) and isinstance(expr.ident, VariableIdentifier):
+            return self._get_var(expr.ident.index)
+        elif isinstance(expr, ExprIdent) and isinstance(expr.ident, ParameterIdentifier):
+            return self._get_param(expr.ident.index)
+        return None
+
+    def _block_loop(self, expr):
+        """
+        Match a loop which copies or fills memory a word at a time, `*p = *q` or `*p = v` where
+        p (and q) are registers that move by 1 (or both by -1) every iteration, and the condition
+        compares p to something. Returns p, q (None for a fill), the value (None for a copy), the
+        step and the comparison, or None
+        """
+        body = expr.body
+        while isinstance(body, ExprComma) and len(body.exprs) == 1:
+            body = body.exprs[0]
+        if not isinstance(body, ExprCopy) or not isinstance(body.destination, ExprDeref) or \
+                body.destination.resolve_type(self._ast).sizeof() != 1:
+            return None
+
+        p = body.destination.expr
+        if isinstance(body.source, ExprDeref):
+            q, value = body.source.expr, None
+        else:
+            q, value = None, body.source
+
+        # The pointers have to be in registers
+        pointers = [e for e in [p, q] if e is not None]
+        if not all([isinstance(self._ident_location(e), Reg) for e in pointers]):
+            return None
+
+        # The step moves each of them and nothing else
+        steps = {}
+        for stmt in self._statements(expr.step, []):
+            if not isinstance(stmt, ExprCopy) or not isinstance(stmt.destination, ExprIdent) or \
+                    not isinstance(stmt.source, ExprBinary) or stmt.source.left != stmt.destination or \
+                    not isinstance(stmt.source.right, ExprNumber) or stmt.source.op not in ['+', '-'] or \
+                    stmt.destination.ident in steps:
+                return None
+            delta = evaluate(stmt.source.op, 0, stmt.source.right.value) & 0xFFFF
+            if delta not in [1, 0xFFFF]:
+                return None
+            steps[stmt.destination.ident] = '+' if delta == 1 else '-'
+        if sorted([id(ident) for ident in steps]) != sorted([id(e.ident) for e in pointers]) or \
+                len(set(steps.values())) != 1:
+            return None
+
+        cond, negate = expr.cond, False
+        if self._is_negation(cond) and isinstance(cond.left, ExprBinary) and cond.left.op in NEGATED:
+            cond, negate = cond.left, True
+        op, left, right, signed = self._as_comparison(cond)
+        if op not in NEGATED or left != p:
+            return None
+
+        return p, q, value, list(steps.values())[0], NEGATED[op] if negate else op, right, signed
+
+    def _loop_operand(self, expr, tofree):
+        """
+        The operand of a value which stays the same while a block loop runs, a value in the
+        stack frame is loaded into a scratch register first, J might not point to it
+        """
+        op = self._condition_operand(expr)
+        if isinstance(op, Deref) and isinstance(op.a, Offset) and op.a.a in [Reg.J, Reg.SP]:
+            reg = self._alloc_scratch()
+            tofree.append(reg)
+            self._asm.emit_set(reg, op)
+            return reg
+        return op
+
+    def _translate_block_loop(self, expr):
+        """
+        Translate a loop that copies or fills memory with STI/STD, returns False if the loop
+        is not one of those, nothing is emitted then
+        """
+        match = self._block_loop(expr)
+        if match is None:
+            return False
+        p, q, value, step, cond_op, right, signed = match
+
+        # The stores of the loop can only change the frame when something points into it,
+        # anything else in memory might be changed by them
+        invariant = []
+        for e in [right, value]:
+            if e is None:
+                continue
+            op = self._condition_operand(e)
+            if op is None or isinstance(op, Deref) and not (
+                    isinstance(op.a, Offset) and op.a.a in [Reg.J, Reg.SP] and not self._frame_escapes):
+                return False
+            if isinstance(op, Deref):
+                invariant.append(e)
+
+        # p goes to I and q to J
+        p_loc = self._ident_location(p)
+        q_loc = self._ident_location(q) if q is not None else None
+        if p_loc == Reg.J and q_loc == Reg.I:
+            return False
+        keep = [reg for reg, loc in [(Reg.I, p_loc), (Reg.J, q_loc)] if reg == loc]
+        claim = self._claim_block_registers(keep, len(invariant))
+        if claim is None:
+            return False
+        saved, claimed = claim
+
+        tofree = []
+        end = self._redirect(self._loop_operand(right, tofree), saved)
+        if value is not None:
+            value = self._redirect(self._loop_operand(value, tofree), saved)
+        if p_loc != Reg.I:
+            self._asm.emit_set(Reg.I, self._redirect(p_loc, saved))
+        if q is not None and q_loc != Reg.J:
+            self._asm.emit_set(Reg.J, self._redirect(q_loc, saved))
+
+        body_lbl = self._asm.make_label()
+        cond_lbl = self._asm.make_label()
+        if not expr.post_test:
+            self._asm.emit_set(Reg.PC, cond_lbl)
+        self._asm.mark_label(body_lbl)
+        emit = self._asm.emit_sti if step == '+' else self._asm.emit_std
+        emit(Deref(Reg.I), Deref(Reg.J) if q is not None else value)
+        self._asm.mark_label(cond_lbl)
+        self._emit_tests(self._compare_tests(cond_op, signed, Reg.I, end, False),
+                         lambda: self._asm.emit_set(Reg.PC, body_lbl))
+
+        for reg in tofree:
+            self._free_scratch(reg)
+
+        # The pointers end up where the loop left them
+        moves = [(p_loc, Reg.I)]
+        if q is not None:
+            moves.append((q_loc, Reg.J))
+        self._release_block_registers(saved, claimed, moves)
+        return True
+
+    def _is_long_type(self, typ):
+        """
+        Check if a type is a long, which takes two words with the low one first
+        """
+        return isinstance(typ, CInteger) and typ.bits == 32
+
+    def _is_long(self, expr):
+        return self._is_long_type(expr.resolve_type(self._ast))
+
+    def _long_words(self, addr):
+        """
+        The operands of the two words of a long at an address
+        """
+        if isinstance(addr, int):
+            return Deref(addr), Deref(addr + 1)
+        elif not isinstance(addr, Offset):
+            addr = Offset(addr, 0)
+        return Deref(addr), Deref(Offset(addr.a, addr.offset + 1))
+
+    def _long_operand(self, expr):
+        """
+        Get the operands of the two words of an expression as a long if they can be used without
+        running any code, anything smaller is extended to a long
+        """
+        if isinstance(expr, ExprNumber):
+            return expr.value & 0xFFFF, (expr.value >> 16) & 0xFFFF
+
+        elif isinstance(expr, ExprComma):
+            return self._long_operand(expr.exprs[0]) if len(expr.exprs) == 1 else None
+
+        elif not self._is_long(expr):
+            # A signed value needs code to extend its sign
+            typ = expr.resolve_type(self._ast)
+            if isinstance(typ, CInteger) and typ.signed:
+                return None
+            op = self._condition_operand(expr)
+            return None if op is None else (op, 0)
+
+        elif isinstance(expr, ExprCast):
+            return self._long_operand(expr.expr)
+
+        elif isinstance(expr, ExprIdent):
+            if isinstance(expr.ident, VariableIdentifier):
+                return self._long_words(self._get_var(expr.ident.index))
+            elif isinstance(expr.ident, ParameterIdentifier):
+                return self._long_words(self._get_param(expr.ident.index))
+            return self._long_words(expr.ident.name)
+
+        elif isinstance(expr, ExprDeref) and self._can_resolve_to_operand_without_deref(expr.expr):
+            return self._long_words(self._translate_expr(expr.expr, None))
+
+        return None
+
+    def _alloc_long(self):
+        return self._alloc_scratch(), self._alloc_scratch()
+
+    def _free_long(self, pair):
+        self._free_scratch(pair[1])
+        self._free_scratch(pair[0])
+
+    def _move_long(self, dest, src):
+        """
+        Move a long between two pairs of operands, which might overlap
+        """
+        lo, hi = dest
+        if str(lo) != str(src[1]):
+            self._asm.emit_set(lo, src[0])
+            self._asm.emit_set(hi, src[1])
+        elif str(hi) != str(src[0]):
+            self._asm.emit_set(hi, src[1])
+            self._asm.emit_set(lo, src[0])
+        else:
+            # The words are swapped
+            self._asm.emit_xor(lo, hi)
+            self._asm.emit_xor(hi, lo)
+            self._asm.emit_xor(lo, hi)
+
+    def _translate_long(self, expr, dest):
+        """
+        Calculate an expression as a long into a pair of operands
+        """
+        ops = self._long_operand(expr)
+        if ops is not None:
+            self._move_long(dest, ops)
+
+        elif not self._is_long(expr):
+            # Calculate it into the low word and extend it
+            self._translate_expr(expr, dest[0])
+            typ = expr.resolve_type(self._ast)
+            if isinstance(typ, CInteger) and typ.signed:
+                self._asm.emit_set(dest[1], dest[0])
+                self._asm.emit_asr(dest[1], 15)
+            else:
+                self._asm.emit_set(dest[1], 0)
+
+        elif isinstance(expr, ExprComma):
+            for e in expr.exprs[:-1]:
+                self._translate_expr(e, None)
+            self._translate_long(expr.exprs[-1], dest)
+
+        elif isinstance(expr, ExprCast):
+            self._translate_long(expr.expr, dest)
+
+        elif isinstance(expr, ExprBinary):
+            self._translate_long_binary(expr, dest)
+
+        elif isinstance(expr, ExprCopy):
+            tofree = []
+            self._move_long(dest, self._translate_long_copy(expr, tofree))
+            for reg in tofree[::-1]:
+                self._free_scratch(reg)
+
+        elif isinstance(expr, ExprCall):
+            self._translate_expr(expr, dest)
+
+        elif isinstance(expr, ExprDeref):
+            reg = self._alloc_scratch()
+            self._translate_expr(expr.expr, reg)
+            self._move_long(dest, self._long_words(reg))
+            self._free_scratch(reg)
+
+        else:
+            assert False, f'`{expr}` ({type(expr)})'
+
+    def _translate_long_copy(self, expr, tofree):
+        """
+        Copy a long, returns the operands of the destination, registers that are
+        needed for them are added to tofree
+        """
+        loc = self._long_operand(expr.destination)
+        if loc is None:
+            reg = self._alloc_scratch()
+            tofree.append(reg)
+            self._translate_expr(expr.destination.expr, reg)
+            loc = self._long_words(reg)
+
+        if any([self._may_read(e, expr.destination) for e in self._evaluated_after_write(expr.source, [])]):
+            # The destination is still read after it would have been written to
+            pair = self._alloc_long()
+            self._translate_long(expr.source, pair)
+            self._move_long(loc, pair)
+            self._free_long(pair)
+        else:
+            self._translate_long(expr.source, loc)
+        return loc
+
+    def _translate_long_call(self, name, args, dest, remainder=False):
+        """
+        Call a runtime helper with the words of the arguments on the stack, the first word
+        is pushed last. The result is the long the helper returns, or the one it leaves
+        on the stack in place of the first argument
+        """
+        self._leaf = False
+        self._runtime.add(name)
+
+        saved = [reg for reg in self._save_on_call if reg not in dest]
+        for reg in saved:
+            self._asm.emit_set(Push(), reg)
+
+        words = 0
+        for arg in args[::-1]:
+            if not self._is_long(arg):
+                op = self._condition_operand(arg)
+                if op is None:
+                    reg = self._alloc_scratch()
+                    self._translate_expr(arg, reg)
+                    self._asm.emit_set(Push(), reg)
+                    self._free_scratch(reg)
+                else:
+                    self._asm.emit_set(Push(), op)
+                words += 1
+                continue
+
+            ops = self._long_operand(arg)
+            pair = None
+            if ops is None:
+                pair = ops = self._alloc_long()
+                self._translate_long(arg, pair)
+            self._asm.emit_set(Push(), ops[1])
+            self._asm.emit_set(Push(), ops[0])
+            if pair is not None:
+                self._free_long(pair)
+            words += 2
+
+        self._asm.emit_jsr(name)
+        if remainder:
+            self._asm.emit_set(dest[0], Pop())
+            self._asm.emit_set(dest[1], Pop())
+            words -= 2
+        else:
+            self._move_long(dest, (Reg.A, Reg.B))
+        self._asm.emit_add(Reg.SP, words)
+
+        for reg in saved[::-1]:
+            self._asm.emit_set(reg, Pop())
+
+    def _translate_long_shift(self, op, n, dest, signed):
+        """
+        Shift the long in dest by a constant
+        """
+        lo, hi = dest
+        if n == 0:
+            pass
+        elif n >= 32:
+            if op == '>>' and signed:
+                self._asm.emit_asr(hi, 15)
+                self._asm.emit_set(lo, hi)
+            else:
+                self._asm.emit_set(lo, 0)
+                self._asm.emit_set(hi, 0)
+        elif op == '<<':
+            if n < 16:
+                # EX gets the bits shifted out of the low word
+                self._asm.emit_shl(hi, n)
+                self._asm.emit_shl(lo, n)
+                self._asm.emit_bor(hi, Reg.EX)
+            else:
+                self._asm.emit_set(hi, lo)
+                self._asm.emit_shl(hi, n - 16)
+                self._asm.emit_set(lo, 0)
+        else:
+            shift = self._asm.emit_asr if signed else self._asm.emit_shr
+            if n < 16:
+                # EX gets the bits shifted out of the high word
+                self._asm.emit_shr(lo, n)
+                shift(hi, n)
+                self._asm.emit_bor(lo, Reg.EX)
+            else:
+                self._asm.emit_set(lo, hi)
+                shift(lo, n - 16)
+                if signed:
+                    self._asm.emit_asr(hi, 15)
+                else:
+                    self._asm.emit_set(hi, 0)
+
+    def _translate_long_binary(self, expr, dest):
+        """
+        Calculate a binary operation on longs into a pair of operands
+        """
+        typ = expr.resolve_type(self._ast)
+        right = expr.right
+        if isinstance(right, ExprNumber) and expr.op in '/%' and not typ.signed and \
+                right.value > 0 and right.value & (right.value - 1) == 0:
+            # Powers of two are just a shift or a mask
+            if expr.op == '/':
+                expr = ExprBinary(expr.left, '>>', ExprNumber(right.value.bit_length() - 1, typ), expr.pos)
+            else:
+                expr = ExprBinary(expr.left, '&', ExprNumber(right.value - 1, typ), expr.pos)
+            right = expr.right
+
+        if expr.op in '/%':
+            name = '__divmodl' if typ.signed else '__udivmodl'
+            args = [ExprCast(expr.left, typ, expr.pos), ExprCast(right, typ, expr.pos)]
+            self._translate_long_call(name, args, dest, expr.op == '%')
+            return
+
+        elif expr.op in ['<<', '>>'] and not isinstance(right, ExprNumber):
+            if expr.op == '<<':
+                name = '__shll'
+            else:
+                name = '__sarl' if typ.signed else '__shrl'
+            self._translate_long_call(name, [ExprCast(expr.left, typ, expr.pos), right], dest)
+            return
+
+        lo, hi = dest
+        if expr.op == '&' and isinstance(right, ExprNumber) and right.value & 0xFFFF0000 == 0:
+            # Only the low word is left
+            self._translate_expr(expr.left, lo)
+            self._asm.emit_and(lo, right.value)
+            self._asm.emit_set(hi, 0)
+            return
+
+        self._translate_long(expr.left, dest)
+        if expr.op in ['<<', '>>']:
+            self._translate_long_shift(expr.op, right.value, dest, typ.signed)
+            return
+
+        pair = None
+        ops = self._long_operand(right)
+        if ops is None:
+            pair = ops = self._alloc_long()
+            self._translate_long(right, pair)
+        rlo, rhi = ops
+
+        if expr.op == '+':
+            if isinstance(rlo, int) and rlo == 0:
+                self._asm.emit_add(hi, rhi)
+            else:
+                # EX has the carry out of the low word
+                self._asm.emit_add(lo, rlo)
+                self._asm.emit_adx(hi, rhi)
+        elif expr.op == '-':
+            if isinstance(rlo, int) and rlo == 0:
+                self._asm.emit_sub(hi, rhi)
+            else:
+                self._asm.emit_sub(lo, rlo)
+                self._asm.emit_sbx(hi, rhi)
+        elif expr.op == '*':
+            # The high word of the product of the low words is left in EX, the
+            # products with the high words only matter for their low word
+            if isinstance(rhi, int) and rhi == 0:
+                self._asm.emit_mul(hi, rlo)
+            else:
+                reg = self._alloc_scratch()
+                self._asm.emit_mul(hi, rlo)
+                self._asm.emit_set(reg, lo)
+                self._asm.emit_mul(reg, rhi)
+                self._asm.emit_add(hi, reg)
+                self._free_scratch(reg)
+            self._asm.emit_mul(lo, rlo)
+            self._asm.emit_add(hi, Reg.EX)
+        elif expr.op in '&|^':
+            emit = {'&': self._asm.emit_and, '|': self._asm.emit_bor, '^': self._asm.emit_xor}[expr.op]
+            for b, a in [(lo, rlo), (hi, rhi)]:
+                if expr.op == '&' and isinstance(a, int) and a == 0:
+                    self._asm.emit_set(b, 0)
+                else:
+                    emit(b, a)
+        else:
+            assert False, f'`{expr}`'
+
+        if pair is not None:
+            self._free_long(pair)
+
+    def _translate_long_dispatch(self, expr, cases, default):
+        """
+        Jump to the case of a long value, the cases are tested one by one
+        """
+        ops = self._long_operand(expr)
+        pair = None
+        if ops is None:
+            pair = ops = self._alloc_long()
+            self._translate_long(expr, pair)
+
+        for value, label in cases:
+            tests = self._long_compare_tests('==', False, ops, self._long_operand(ExprNumber(value)), False)
+            self._emit_tests(tests, lambda: self._asm.emit_set(Reg.PC, label))
+        self._asm.emit_set(Reg.PC, default)
+
+        if pair is not None:
+            self._free_long(pair)
+
+    def _long_compare_tests(self, op, signed, left, right, negate):
+        """
+        The skip instructions that test a comparison between two longs, in the same form
+        as `_compare_tests`, the high words decide unless they are the same
+        """
+        if op == '&':
+            if negate:
+                tests = [[('ifc', left[0], right[0]), ('ifc', left[1], right[1])]]
+            else:
+                tests = [[('ifb', left[0], right[0])], [('ifb', left[1], right[1])]]
+            return self._resolve_tests(tests)
+
+        if negate:
+            op = NEGATED[op]
+
+        # Against a constant these are the same as a strict comparison against the constant
+        # next to it, there is no skip for them
+        if all([isinstance(a, int) for a in right]) and op in ['<=', '>=']:
+            value = right[0] | right[1] << 16
+            value = wrap(value, signed, 32)
+            lowest, highest = (-0x80000000, 0x7FFFFFFF) if signed else (0, 0xFFFFFFFF)
+            if op == '>=' and value == lowest or op == '<=' and value == highest:
+                return [[]]
+            op, value = ('>', value - 1) if op == '>=' else ('<', value + 1)
+            right = value & 0xFFFF, (value >> 16) & 0xFFFF
+
+        (llo, lhi), (rlo, rhi) = left, right
+        greater = 'ifa' if signed else 'ifg'
+        less = 'ifu' if signed else 'ifl'
+        if op == '==':
+            tests = [[('ife', lhi, rhi), ('ife', llo, rlo)]]
+        elif op == '!=':
+            tests = [[('ifn', lhi, rhi)], [('ifn', llo, rlo)]]
+        elif op in ['>', '>=']:
+            tests = [[(greater, lhi, rhi)], [('ife', lhi, rhi), ('ifg', llo, rlo)]]
+            if op == '>=':
+                tests.append([('ife', lhi, rhi), ('ife', llo, rlo)])
+        elif op in ['<', '<=']:
+            tests = [[(less, lhi, rhi)], [('ife', lhi, rhi), ('ifl', llo, rlo)]]
+            if op == '<=':
+                tests.append([('ife', lhi, rhi), ('ife', llo, rlo)])
+        else:
+            assert False
+        return self._resolve_tests(tests)
+
+    def _resolve_tests(self, tests):
+        """
+        Turn tests given by the names of the skip instructions into the instructions, tests
+        between two constants are decided right away and constants are moved to the a operand
+        """
+        resolved = []
+        for alternative in tests:
+            insts = []
+            for name, b, a in alternative:
+                if isinstance(b, int) and isinstance(a, int):
+                    if not SKIP_TEST[name](b & 0xFFFF, a & 0xFFFF):
+                        break
+                    continue
+                elif isinstance(b, int):
+                    b, a, name = a, b, SKIP_MIRRORED[name]
+                insts.append((getattr(self._asm, f'emit_{name}'), b, a))
+            else:
+                resolved.append(insts)
+        return resolved
+
     def get_instructions(self):
-        return self._asm.get_instructions()
+        return self.peephole.optimize(self._asm.get_instructions())
 
     def translate(self):
         for func in self._ast.func_list:
-            if func.prototype:
+            if not func.used:
+                # Nothing references it
+                continue
+            elif func.prototype:
                 # Declare asm an external symbol
-                self._asm.put_instruction(f'.extern {func.name}')
+                self._asm.emit_extern(func.name)
             else:
                 self._translate_function(func)
 
+        # The helpers the functions called
+        emit_runtime(self._asm, self._runtime)
+
         for var in self._ast.global_vars:
             # TODO: support constant value for global vars
-            if var.storage == StorageClass.EXTERN:
+            if not var.used:
+                # Nothing references it
+                continue
+            elif var.storage == StorageClass.EXTERN:
                 # Declare as an external symbol
-                self._asm.put_instruction(f'.extern {var.ident.name}')
+                self._asm.emit_extern(var.ident.name)
             else:
                 # Declare asm a global symbol if not a static variable
                 if var.storage != StorageClass.STATIC:
-                    self._asm.put_instruction(f'.global {var.ident.name}')
+                    self._asm.emit_global(var.ident.name)
                 self._asm.mark_label(f'{var.ident.name}')
 
                 if var.value is not None:
                     # Has a value!
-                    if isinstance(var.value, int):
+                    if isinstance(var.value, int) and var.typ.sizeof() == 2:
+                        # A long, the low word first
+                        self._asm.emit_word(var.value & 0xFFFF)
+                        self._asm.emit_word((var.value >> 16) & 0xFFFF)
+                    elif isinstance(var.value, int):
                         self._asm.emit_word(var.value)
+                    elif isinstance(var.value, list):
+                        for value in var.value:
+                            self._asm.emit_word(value)
                     else:
                         assert False, f'got {var.value}'
                 else:
@@ -186,50 +1774,87 @@ class Translator:
     def _translate_function(self, func: Function):
         # TODO: static functions
 
-        # Clear and set the current function
-        self.clear()
+        # Set the current function
         self._ast.func = func
 
         # label
-        self._asm.put_instruction('')
+        self._asm.emit_blank()
         if func.storage_decl != StorageClass.STATIC:
-            self._asm.put_instruction(f'.global {func.name}')
+            self._asm.emit_global(func.name)
         self._asm.mark_label(func.name)
+        if self._is_long_type(func.type.ret_type):
+            self.peephole.long_returns.add(func.name)
+
+        # Without a frame the offsets from SP depend on the size of the frame, which
+        # is only known once the function was translated, so translate it until the size
+        # is stable, a function which calls something needs the frame since the calls
+        # move SP
+        pos = self._asm.get_pos()
+        frame = 0 if self.omit_frame_pointer else None
+        while True:
+            self._translate_frame(func, frame)
+            if frame is None:
+                break
+            elif not self._leaf:
+                frame = None
+            elif frame == self._stack + len(self._to_restore):
+                break
+            else:
+                frame = self._stack + len(self._to_restore)
+            self._asm.take_instructions(pos)
 
-        # Function entry frame
-        self._asm.emit_set(Push(), Reg.J)
-        self._asm.emit_set(Reg.J, Reg.SP)
+    def _translate_frame(self, func: Function, frame):
+        """
+        Translate the function with its prologue and epilogues, the frame is the size
+        of the stack frame when it is addressed from SP, or None to use J for it
+        """
+        self.clear()
+        self._frame = frame
+
+        if frame is None:
+            # Function entry frame
+            self._asm.emit_set(Push(), Reg.J)
+            self._asm.emit_set(Reg.J, Reg.SP)
+            base = Reg.J
+            off = 2
+        else:
+            # J is not needed, so it can be used like any other register
+            self._regs.insert(0, Reg.J)
+            base = Reg.SP
+            off = frame + 1
 
         # setup function argument position
         if func.type.callconv == CallConv.STACKCALL:
             # For stack call all regs are passed on the stack
-            off = 2
             for param in func.type.param_types:
                 sz = param.sizeof()
-                self._params.append(Offset(Reg.J, off))
+                self._params.append(Offset(base, off))
                 off += sz
 
         elif func.type.callconv == CallConv.REGCALL:
             # For regcall the first free parameters are in A, B and C
             # The rest are passed on the stack
             regs = [Reg.C, Reg.B, Reg.A]
-            off = 2
             for param in func.type.param_types:
                 if len(regs) != 0:
                     r = regs.pop()
                     self._set_scratch(r)
+                    self._save_on_call.append(r)
                     self._params.append(r)
                 else:
                     sz = param.sizeof()
-                    self._params.append(Offset(Reg.J, off))
+                    self._params.append(Offset(base, off))
                     off += sz
         else:
             assert False
 
-        # Set up local vars
+        # Set up local vars, the ones the code doesn't use anymore get no place
         if len(func.vars) != 0:
-            for var in func.vars:
-                if var.storage == StorageClass.AUTO:
+            used = self._used_vars(func.code, set())
+            for i, var in enumerate(func.vars):
+                if i not in used:
+                    loc = None
+                elif var.storage == StorageClass.AUTO:
                     loc = self._alloca(var.typ.sizeof())
                 elif var.storage == StorageClass.REGISTER:
                     # Can only do this for register sized stuff
@@ -246,34 +1871,40 @@ class Translator:
                     assert False
                 self._vars.append(loc)
 
-        # Store place for locals
-        locals_pos = self._asm.get_pos()
-        self._asm.put_instruction(f';; Locals allocation here')
+        # The locals and the callee saved registers are only known once the
+        # function was translated, they are set up before the code from here
+        body_pos = self._asm.get_pos()
 
-        # space for saving local regs
-        # (X, Y, Z, I)
-        for i in range(4):
-            self._asm.put_instruction(';; For callee saved stuff')
+        # Calls to ourselves in a tail position start over from here
+        self._frame_escapes = self._addresses_frame(func.code)
+        self._body_label = self._asm.make_label()
+        self._asm.mark_label(self._body_label)
 
         # Translate function
         self._translate_expr(func.code, None)
 
-        # Push callee saved and allocate stack area
-        # also generate the end code that reverts all of that
-        self._asm.set_pos(locals_pos)
+        # The function endings, one for every place the returns go to (back to the
+        # caller, or to the function of a tail call), the returns jump to them and
+        # the last one goes first so the return before it falls into it
+        epilogues = sorted(self._epilogues.items(), key=lambda epilogue: epilogue[1] != self._last_epilogue)
+        for jump, label in epilogues:
+            self._asm.mark_label(label)
+            for reg in self._to_restore[::-1]:
+                self._asm.emit_set(reg, Pop())
+            if frame is None:
+                self._asm.emit_set(Reg.SP, Reg.J)
+                self._asm.emit_set(Reg.J, Pop())
+            elif self._stack > 0:
+                self._asm.emit_add(Reg.SP, self._stack)
+            self._asm.emit_set(Reg.PC, jump)
+
+        # Allocate the stack area and push callee saved before the code
+        code = self._asm.take_instructions(body_pos)
         if self._stack > 0:
             self._asm.emit_sub(Reg.SP, self._stack)
         for reg in self._to_restore:
             self._asm.emit_set(Push(), reg)
-
-        # Create all the function frame ends
-        for pos in self._return_pos:
-            self._asm.set_pos(pos)
-            for reg in self._to_restore[::-1]:
-                self._asm.emit_set(reg, Pop())
-            self._asm.emit_set(Reg.SP, Reg.J)
-            self._asm.emit_set(Reg.J, Pop())
-            self._asm.emit_set(Reg.PC, Pop())
+        self._asm.put_instructions(code)
 
     def _translate_expr(self, expr: Expr, dest):
         if isinstance(expr, ExprNumber):
@@ -290,37 +1921,63 @@ class Translator:
 
         elif isinstance(expr, ExprLoop):
             assert dest is None
+            if self._translate_block_loop(expr):
+                return
 
             end_lbl = self._asm.make_label()
+            cond_lbl = self._asm.make_label()
+            body_lbl = self._asm.make_label()
+            step_lbl = cond_lbl if isinstance(expr.step, ExprNop) else self._asm.make_label()
             self._end_label.append(end_lbl)
+            self._cond_label.append(step_lbl)
 
-            # The condition
-            cond_lbl = self._asm.make_and_mark_label()
-            self._cond_label.append(cond_lbl)
-            if self._can_resolve_to_operand(expr.cond):
-                cond_result = self._translate_expr(expr.cond, None)
-            else:
-                cond_result = self._alloc_scratch()
-                self._translate_expr(expr.cond, cond_result)
-            self._asm.emit_ife(cond_result, 0)
-            self._asm.emit_set(Reg.PC, end_lbl)
-
-            if not self._can_resolve_to_operand(expr.cond):
-                self._free_scratch(cond_result)
+            # The condition is tested at the bottom so every iteration
+            # only takes a single branch, enter the loop through it
+            if not expr.post_test and (not isinstance(expr.cond, ExprNumber) or expr.cond.value == 0):
+                self._asm.emit_set(Reg.PC, cond_lbl)
 
             # The body
+            self._asm.mark_label(body_lbl)
             self._translate_expr(expr.body, None)
-            self._asm.emit_set(Reg.PC, cond_lbl)
+
+            # Continue goes to the step
+            if step_lbl != cond_lbl:
+                self._asm.mark_label(step_lbl)
+                self._translate_expr(expr.step, None)
+
+            # The condition, go back to the body as long as it holds
+            self._asm.mark_label(cond_lbl)
+            self._translate_branch(expr.cond, body_lbl, True)
 
             # Mark the end
             self._asm.mark_label(end_lbl)
+            self._end_label.pop()
+            self._cond_label.pop()
+
+        elif isinstance(expr, ExprSwitch):
+            assert dest is None
+            self._translate_switch(expr)
 
         elif isinstance(expr, ExprBinary):
             print(f'{expr}')
 
             # Setup the type
             typ = expr.resolve_type(self._ast)
-            if isinstance(typ, CInteger):
+            if isinstance(typ, CInteger) and typ.bits == 32:
+                if isinstance(dest, tuple):
+                    self._translate_long_binary(expr, dest)
+                elif dest is None:
+                    # Only the side effects matter
+                    pair = self._alloc_long()
+                    self._translate_long_binary(expr, pair)
+                    self._free_long(pair)
+                else:
+                    # Only the low word is needed
+                    reg = self._alloc_scratch()
+                    self._translate_long_binary(expr, (dest, reg))
+                    self._free_scratch(reg)
+                return
+            elif isinstance(typ, CInteger):
                 assert typ.bits == 16, "Only 16bit math is natively supported"
             elif isinstance(typ, CPointer) or isinstance(typ, CArray):
                 typ = CInteger(16, False)
@@ -329,34 +1986,35 @@ class Translator:
 
             if dest is None:
 
-                # Sometimes we can find && because of `if`
-                if expr.op == '&&':
-                    end = self._asm.make_label()
+                # Sometimes we can find && and || because of `if`
+                if expr.op in ['&&', '||']:
+                    # A single chain of skips can guard a short second part by itself
+                    tests = self._condition_tests(expr.left, expr.op == '||')
+                    if tests is not None and len(tests) == 1 and self._translate_predicated(tests[0], expr.right):
+                        return
 
-                    # Run the first part, jump to end if the result is 0
-                    if self._can_resolve_to_operand(expr.left):
-                        reg = self._translate_expr(expr.left, None)
-                        self._asm.emit_ife(reg, 0)
-                        self._asm.emit_set(Reg.PC, end)
-                    else:
-                        reg = self._alloc_scratch()
-                        self._translate_expr(expr.left, reg)
-                        self._asm.emit_ife(reg, 0)
-                        self._asm.emit_set(Reg.PC, end)
-                        self._free_scratch(reg)
+                    end = self._asm.make_label()
 
+                    # Skip the second part if the first one decides the result
+                    self._translate_branch(expr.left, end, expr.op == '||')
                     self._translate_expr(expr.right, None)
                     self._asm.mark_label(end)
 
+                elif expr.op in NEGATED:
+                    # Only the side effects of the operands matter
+                    reg = self._alloc_scratch()
+                    self._translate_condition(expr, reg)
+                    self._free_scratch(reg)
+
                 else:
                     # This allows for doing maths on operands at compile time
                     left = self._translate_expr(expr.left, None)
                     right = self._translate_expr(expr.right, None)
 
                     if isinstance(left, Offset) and isinstance(right, int):
-                        return Offset(left.a, eval(f'{left.offset} {expr.op} {right}'))
-                    elif isinstance(right, Offset) and isinstance(left, int):
-                        return Offset(right.a, eval(f'{right.offset} {expr.op} {left}'))
+                        return Offset(left.a, evaluate(expr.op, left.offset, right))
+                    elif isinstance(right, Offset) and isinstance(left, int) and expr.op == '+':
+                        return Offset(right.a, evaluate(expr.op, left, right.offset))
                     elif isinstance(left, Reg) and isinstance(right, int):
                         return Offset(left, right if expr.op == '+' else -right)
                     elif isinstance(right, Reg) and isinstance(left, int):
@@ -379,7 +2037,10 @@ class Translator:
                         self._translate_expr(expr.right, reg)
 
                     # Emit the addition, with dest asm the destination
-                    if expr.op == '+':
+                    if expr.op in '/%' and isinstance(reg, int) and \
+                            self._translate_div_by_constant(dest, reg, typ.signed, expr.op == '%'):
+                        pass
+                    elif expr.op == '+':
                         self._asm.emit_add(dest, reg)
                     elif expr.op == '-':
                         self._asm.emit_sub(dest, reg)
@@ -404,9 +2065,24 @@ class Translator:
                     else:
                         assert False
 
-                elif expr.op in ['==']:
-                    # For these we should just allocate another register
-                    self._alloc_scratch()
+                elif expr.op in ['<<', '>>']:
+                    self._translate_expr(expr.left, dest)
+                    if self._can_resolve_to_operand(expr.right):
+                        reg = self._translate_expr(expr.right, None)
+                    else:
+                        reg = self._alloc_scratch()
+                        self._translate_expr(expr.right, reg)
+
+                    if expr.op == '<<':
+                        self._asm.emit_shl(dest, reg)
+                    elif typ.signed:
+                        self._asm.emit_asr(dest, reg)
+                    else:
+                        self._asm.emit_shr(dest, reg)
+
+                elif expr.op in NEGATED or expr.op in ['&&', '||']:
+                    self._translate_condition(expr, dest)
+                    return
 
                 else:
                     assert False
@@ -416,10 +2092,10 @@ class Translator:
                     self._free_scratch(reg)
 
         elif isinstance(expr, ExprComma):
-            last = None
-            for e in expr.exprs:
-                last = self._translate_expr(e, dest)
-            return last
+            # Only the last expression is the value of the comma
+            for e in expr.exprs[:-1]:
+                self._translate_expr(e, None)
+            return self._translate_expr(expr.exprs[-1], dest)
 
         elif isinstance(expr, ExprNop):
             pass
@@ -484,6 +2160,25 @@ class Translator:
             # For cast just use the expression
             return self._translate_expr(expr.expr, dest)
 
+        elif isinstance(expr, ExprCopy) and (isinstance(expr.resolve_type(self._ast), CStruct) or
+                                             isinstance(expr.resolve_type(self._ast), CArray)):
+            # The whole thing is copied, which is never used as a value
+            assert dest is None
+            tofree = []
+            self._translate_block_copy(expr, tofree)
+            for reg in tofree:
+                self._free_scratch(reg)
+
+        elif isinstance(expr, ExprCopy) and self._is_long(expr):
+            tofree = []
+            loc = self._translate_long_copy(expr, tofree)
+            if isinstance(dest, tuple):
+                self._move_long(dest, loc)
+            elif dest is not None:
+                self._asm.emit_set(dest, loc[0])
+            for reg in tofree[::-1]:
+                self._free_scratch(reg)
+
         elif isinstance(expr, ExprCopy):
             tofree = None
 
@@ -505,8 +2200,16 @@ class Translator:
             else:
                 assert False, f'`{expr.destination}` ({type(expr.destination)})'
 
-            if self._can_resolve_to_operand_without_deref(expr.source):
+            if self._can_resolve_to_operand_without_deref(expr.source) and \
+                    not isinstance(self._translate_expr(expr.source, None), Offset):
                 self._asm.emit_set(dest_op, self._translate_expr(expr.source, None))
+            elif any([self._may_read(e, expr.destination) for e in self._evaluated_after_write(expr.source, [])]):
+                # The destination is still read after it would have been written to
+                # so calculate it aside first
+                reg = self._alloc_scratch()
+                self._translate_expr(expr.source, reg)
+                self._asm.emit_set(dest_op, reg)
+                self._free_scratch(reg)
             else:
                 self._translate_expr(expr.source, dest_op)
 
@@ -519,14 +2222,20 @@ class Translator:
 
         elif isinstance(expr, ExprDeref):
             if dest is None:
-                assert self._can_resolve_to_operand(expr.expr)
+                assert self._can_resolve_to_operand_without_deref(expr.expr)
                 return Deref(self._translate_expr(expr.expr, None))
             else:
-                if self._can_resolve_to_operand(expr.expr):
+                if self._can_resolve_to_operand_without_deref(expr.expr):
                     self._asm.emit_set(dest, Deref(self._translate_expr(expr.expr, None)))
-                else:
+                elif isinstance(dest, Reg):
                     self._translate_expr(expr.expr, dest)
                     self._asm.emit_set(dest, Deref(dest))
+                else:
+                    # Can't deref a memory destination, calculate the address in a scratch
+                    reg = self._alloc_scratch()
+                    self._translate_expr(expr.expr, reg)
+                    self._asm.emit_set(dest, Deref(reg))
+                    self._free_scratch(reg)
 
         elif isinstance(expr, ExprAddrof):
             if isinstance(expr.expr, ExprIdent):
@@ -539,11 +2248,16 @@ class Translator:
                     # TODO: Support address of parameter in a reg call (probably by spilling it)
                     assert not isinstance(self._get_param(ident.index), Reg)
                     r = self._get_param(ident.index)
+                elif isinstance(ident, GlobalIdentifier) or isinstance(ident, FunctionIdentifier):
+                    # The address is just the label
+                    r = ident.name
                 else:
                     assert False
 
                 if dest is not None:
-                    if isinstance(r, Offset):
+                    if isinstance(r, str):
+                        self._asm.emit_set(dest, r)
+                    elif isinstance(r, Offset):
                         self._asm.emit_set(dest, r.a)
                         if r.offset == 0:
                             pass
@@ -559,65 +2273,156 @@ class Translator:
                 assert False, f'`{expr}` ({type(expr)})'
 
         elif isinstance(expr, ExprCall):
+            # Calls move SP, so the function needs a frame
+            self._leaf = False
+
+            # A destination in memory that a saved register points to is only there once the
+            # register is restored, so the value goes there after that
+            if isinstance(dest, Deref) and self._operand_reg(dest) in self._save_on_call:
+                reg = self._alloc_scratch()
+                self._translate_expr(expr, reg)
+                self._asm.emit_set(dest, reg)
+                self._free_scratch(reg)
+                return
+
             # TODO: Need the callconv to be part of the type
             callconv = expr.func.resolve_type(self._ast).callconv
 
-            # save the values of A, B and C
+            # save the values of A, B and C, no need to save the destination
+            # since it is going to get the return value anyways
             # TODO: need to save it if in arguments or variables properly
-            for reg in self._save_on_call:
+            dests = dest if isinstance(dest, tuple) else [dest]
+            saved = [reg for reg in self._save_on_call if reg not in dests]
+            for reg in saved:
                 self._asm.emit_set(Push(), reg)
 
+            # Arguments are passed as the type of the parameter
+            typ = expr.func.resolve_type(self._ast)
+            types = [typ.param_types[i] if i < len(typ.param_types) else arg.resolve_type(self._ast)
+                     for i, arg in enumerate(expr.args)]
+
             if callconv == CallConv.STACKCALL:
-                # place the arguments for a stackcall
-                # they are pushed in a reversed order
-                for arg in expr.args[::-1]:
-                    assert arg.resolve_type(self._ast).sizeof() == 1
-                    if self._can_resolve_to_operand(arg):
-                        self._asm.emit_set(Push(), self._translate_expr(arg, None))
-                    else:
-                        # We don't want to set the dest to Push since we might use it in
-                        # some other places along the way, making the stack corrupt
-                        self._translate_expr(arg, dest)
-                        self._asm.emit_set(Push(), dest)
+                reg_args = []
+                stack_args = list(zip(expr.args, types))
+            elif callconv == CallConv.REGCALL:
+                # The first three arguments are passed in A, B and C
+                reg_args = expr.args[:3]
+                stack_args = list(zip(expr.args[3:], types[3:]))
             else:
                 assert False
 
+            # place the arguments that are passed on the stack
+            # they are pushed in a reversed order
+            words = 0
+            for arg, arg_typ in stack_args[::-1]:
+                words += arg_typ.sizeof()
+                if arg_typ.sizeof() == 2:
+                    # A long, the low word goes last
+                    ops = self._long_operand(ExprCast(arg, arg_typ))
+                    if ops is None:
+                        pair = self._alloc_long()
+                        self._translate_long(ExprCast(arg, arg_typ), pair)
+                        self._asm.emit_set(Push(), pair[1])
+                        self._asm.emit_set(Push(), pair[0])
+                        self._free_long(pair)
+                    else:
+                        self._asm.emit_set(Push(), ops[1])
+                        self._asm.emit_set(Push(), ops[0])
+                    continue
+
+                assert arg_typ.sizeof() == 1
+                if self._can_resolve_to_operand(arg):
+                    self._asm.emit_set(Push(), self._translate_expr(arg, None))
+                else:
+                    # We don't want to set the dest to Push since we might use it in
+                    # some other places along the way, making the stack corrupt
+                    reg = self._alloc_scratch()
+                    self._translate_expr(arg, reg)
+                    self._asm.emit_set(Push(), reg)
+                    self._free_scratch(reg)
+
+            reserved = self._place_arguments(reg_args, [Reg.A, Reg.B, Reg.C][:len(reg_args)])
+
             # Translate the function into a call properly
             if self._can_resolve_to_operand(expr.func):
                 self._asm.emit_jsr(self._translate_expr(expr.func, None))
             else:
-                if callconv == CallConv.STACKCALL or callconv == CallConv.REGCALL and dest not in [Reg.A, Reg.B, Reg.C]:
-                    # If we can use the dest safely then use it to resolve our function
-                    self._translate_expr(expr.func, dest)
-                    self._asm.emit_jsr(dest)
+                reg = self._alloc_scratch()
+                self._translate_expr(expr.func, reg)
+                self._asm.emit_jsr(reg)
+                self._free_scratch(reg)
 
-            # return value is in A
-            self._asm.emit_set(dest, Reg.A)
+            for reg in reserved:
+                self._free_scratch(reg)
+
+            # return value is in A, and a long in A and B
+            if isinstance(dest, tuple):
+                if self._is_long_type(typ.ret_type):
+                    self._move_long(dest, (Reg.A, Reg.B))
+                else:
+                    self._asm.emit_set(dest[0], Reg.A)
+                    if isinstance(typ.ret_type, CInteger) and typ.ret_type.signed:
+                        self._asm.emit_set(dest[1], dest[0])
+                        self._asm.emit_asr(dest[1], 15)
+                    else:
+                        self._asm.emit_set(dest[1], 0)
+            elif dest is not None:
+                self._asm.emit_set(dest, Reg.A)
 
             # restore everything
-            if callconv == CallConv.STACKCALL:
-                self._asm.emit_add(Reg.SP, len(expr.args))
-            elif callconv == CallConv.REGCALL:
-                if len(expr.args) > 3:
-                    # only need to restore if more than 3 arguments
-                    self._asm.emit_add(Reg.SP, (len(expr.args) - 3) - 3)
+            if words != 0:
+                self._asm.emit_add(Reg.SP, words)
 
             # restore the values of A, B and C
             # TODO: need to save it if in arguments or variables properly
-            for reg in self._save_on_call[::-1]:
+            for reg in saved[::-1]:
                 self._asm.emit_set(reg, Pop())
 
         elif isinstance(expr, ExprReturn):
             assert dest is None, "Can not have a destination for ExprReturn"
+            jump = Pop()
+            targets = self._tail_call_targets(expr.expr)
+            if targets is not None:
+                # The function we call returns to our caller instead of us
+                jump = self._translate_tail_call(expr.expr, targets)
+                if jump is None:
+                    return
+
+            # A long is returned in A and B
+            elif self._is_long_type(self._ast.func.type.ret_type):
+                ops = self._long_operand(expr.expr)
+                if ops is not None and self._operand_reg(ops[1]) != Reg.A:
+                    # A is set first, the high word can't need it
+                    self._move_long((Reg.A, Reg.B), ops)
+                elif Reg.A in self._regs and Reg.B in self._regs:
+                    for reg in [Reg.A, Reg.B]:
+                        self._set_scratch(reg)
+                        self._save_on_call.append(reg)
+                    self._translate_long(expr.expr, (Reg.A, Reg.B))
+                    self._free_long((Reg.A, Reg.B))
+                else:
+                    pair = self._alloc_long()
+                    self._translate_long(expr.expr, pair)
+                    self._free_long(pair)
+                    self._move_long((Reg.A, Reg.B), pair)
+
             # The return value is always in A
-            if self._can_resolve_to_operand(expr.expr):
+            elif self._can_resolve_to_operand(expr.expr):
                 # Check if can be resolved to an operand, if so read it directly
                 # if already A then the set will be emitted by the assembler
                 self._asm.emit_set(Reg.A, self._translate_expr(expr.expr, None))
 
             elif Reg.A in self._regs:
-                # If A is free use it directly
+                # If A is free use it directly, it has to be saved
+                # around any call we make while calculating it
                 self._set_scratch(Reg.A)
+                self._save_on_call.append(Reg.A)
+                self._translate_expr(expr.expr, Reg.A)
+                self._free_scratch(Reg.A)
+
+            elif not any([self._reads_reg(e, Reg.A) for e in self._evaluated_after_write(expr.expr, [])]):
+                # Nothing needs what is in A once we return, as long as the
+                # value is not read after A was written to calculate it in place
                 self._translate_expr(expr.expr, Reg.A)
 
             else:
@@ -628,7 +2433,8 @@ class Translator:
                 self._free_scratch(reg)
                 self._asm.emit_set(Reg.A, reg)
 
-            # emit the function ending
-            self._return_pos.append(self._asm.get_pos())
-            for i in range(7):
-                self._asm.put_instruction(';; return stub')
+            # Go to the function ending
+            if jump not in self._epilogues:
+                self._epilogues[jump] = self._asm.make_label()
+            self._last_epilogue = self._epilogues[jump]
+            self._asm.emit_set(Reg.PC, self._last_epilogue)
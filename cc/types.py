@@ -1,5 +1,6 @@
 from typing import *
 from enum import Enum, auto
+import copy
 
 
 class StorageClass(Enum):
@@ -12,11 +13,22 @@ class StorageClass(Enum):
 class CType:
 
     def __init__(self):
-        pass
+        # Every access to a volatile object has to be done, in order
+        self.volatile = False
 
     def __ne__(self, other):
         return not (self == other)
 
+    def qualified(self, volatile):
+        """
+        The type with the qualifier added, types are shared between declarations so this is a copy
+        """
+        if not volatile or self.volatile:
+            return self
+        typ = copy.copy(self)
+        typ.volatile = volatile
+        return typ
+
     def is_complete(self):
         return NotImplemented
 
@@ -43,11 +55,15 @@ class CInteger(CType):
         if not self.signed:
             if self.bits == 16:
                 return 'unsigned int'
+            elif self.bits == 32:
+                return 'unsigned long'
             else:
                 assert False
         else:
             if self.bits == 16:
                 return 'int'
+            elif self.bits == 32:
+                return 'long'
             else:
                 assert False
 
@@ -169,7 +185,7 @@ class CStruct(CType):
                 if self.packed:
                     offset += self.items[item].sizeof()
                 else:
-                    offset += _align(offset, self.items[item].sizeof()) + self.items[item].sizeof()
+                    offset = _align(offset, self.items[item].sizeof()) + self.items[item].sizeof()
 
             return None
 
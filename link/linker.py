@@ -54,7 +54,8 @@ class Linker:
             if name not in self._symbols:
                 self.report_error(f'undefined symbol `{name}` referenced')
             else:
-                self._buffer[pos] = self._symbols[name]
+                # The word already has what is added to the symbol
+                self._buffer[pos] = (self._buffer[pos] + self._symbols[name]) & 0xFFFF
 
         if typ == BinaryType.RAW:
             if 'base' in args:
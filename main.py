@@ -3,6 +3,8 @@
 from cc.parser import Parser
 from cc.optimizer import Optimizer
 from cc.translator import Translator
+from cc.assembler import render
+from cc.encoder import Encoder
 
 from asm.assembler import Assembler
 
@@ -15,6 +17,9 @@ if __name__ == '__main__':
     asm_files = []
 
     stop_at_comp = False
+    omit_frame_pointer = False
+    optimize_size = False
+    verbose = False
 
     for file in sys.argv:
         if file.endswith('.c'):
@@ -23,6 +28,12 @@ if __name__ == '__main__':
             asm_files.append(file)
         elif file == '-S':
             stop_at_comp = True
+        elif file == '-fomit-frame-pointer':
+            omit_frame_pointer = True
+        elif file == '-Os':
+            optimize_size = True
+        elif file == '-v':
+            verbose = True
 
     objects = []
 
@@ -37,25 +48,31 @@ if __name__ == '__main__':
         print(p.func_list[1])
 
         if not p.got_errors:
-            opt = Optimizer(p)
+            opt = Optimizer(p, optimize_size=optimize_size)
             opt.optimize()
 
-            trans = Translator(p)
+            trans = Translator(p, omit_frame_pointer=omit_frame_pointer)
             trans.translate()
 
             insts = trans.get_instructions()
-            code = '\n'.join(insts)
+
+            if verbose:
+                # How many times every optimization was done
+                print(f'{cf}:')
+                print('\n'.join([f'{name}: {count}' for name, count in opt.hits.items()]))
+                print(trans.peephole)
 
             if stop_at_comp:
                 with open(cf + '.dasm', 'w') as f:
-                    f.write(code)
+                    f.write(render(insts))
             else:
-                asm = Assembler(code, cf)
-                asm.parse()
-                asm.fix_labels()
+                # Encoded directly, the text is only made for -S
+                enc = Encoder(insts, cf)
+                enc.encode()
+                enc.fix_labels()
 
-                if not asm.got_errors:
-                    objects.append(asm.get_object())
+                if not enc.got_errors:
+                    objects.append(enc.get_object())
                 else:
                     got_errors = True
         else:
@@ -0,0 +1,335 @@
+"""
+A small DCPU16 emulator to run the code the compiler generated
+
+Every source is compiled, encoded and linked like main.py does it, then its
+functions are called from the outside the way the ABI says they are called.
+"""
+import contextlib
+import io
+
+from asm.encoding import *
+from cc.assembler import render
+from cc.encoder import Encoder
+from cc.optimizer import Optimizer
+from cc.parser import Parser
+from cc.translator import Translator
+from link.linker import Linker, BinaryType
+
+# The registers a function has to give back as it got them
+PRESERVED = ['X', 'Y', 'Z', 'I', 'J']
+
+# How many instructions a call can run before it is considered stuck
+MAX_STEPS = 1000000
+
+
+def signed(val):
+    return val - 0x10000 if val & 0x8000 else val
+
+
+# When the instruction after an IF instruction is run
+CONDITIONS = {
+    INST_TABLE['IFB']: lambda b, a: b & a != 0,
+    INST_TABLE['IFC']: lambda b, a: b & a == 0,
+    INST_TABLE['IFE']: lambda b, a: b == a,
+    INST_TABLE['IFN']: lambda b, a: b != a,
+    INST_TABLE['IFG']: lambda b, a: b > a,
+    INST_TABLE['IFA']: lambda b, a: signed(b) > signed(a),
+    INST_TABLE['IFL']: lambda b, a: b < a,
+    INST_TABLE['IFU']: lambda b, a: signed(b) < signed(a),
+}
+
+
+class CompileError(Exception):
+    pass
+
+
+class Program:
+
+    def __init__(self, code, optimize_size=False, omit_frame_pointer=False):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            parser = Parser(code, filename='test.c')
+            parser.parse()
+            if parser.got_errors:
+                raise CompileError(out.getvalue())
+
+            Optimizer(parser, optimize_size=optimize_size).optimize()
+
+            trans = Translator(parser, omit_frame_pointer=omit_frame_pointer)
+            trans.translate()
+            self.insts = trans.get_instructions()
+
+            enc = Encoder(self.insts, 'test.c')
+            enc.encode()
+            enc.fix_labels()
+            if enc.got_errors:
+                raise CompileError(out.getvalue())
+
+            linker = Linker()
+            linker.append_object(enc.get_object())
+            linker.link(BinaryType.RAW, {})
+            if linker.got_errors:
+                raise CompileError(out.getvalue())
+
+        # Only one object is linked, the symbols are where the object has them
+        self.symbols = enc.get_object()[3]
+        self.words = linker.get_words()
+
+        self.mem = [0] * 0x10000
+        self.mem[:len(self.words)] = self.words
+        self.regs = [0] * 8
+        self.sp = 0
+        self.pc = 0
+        self.ex = 0
+
+        # Returning to this address ends the call
+        self.halt = len(self.words)
+
+    def asm(self):
+        return render(self.insts)
+
+    ####################################################################################################################
+    # Memory
+    ####################################################################################################################
+
+    def read(self, name, count=1):
+        addr = self.symbols[name]
+        return self.mem[addr:addr + count]
+
+    def write(self, name, values):
+        addr = self.symbols[name]
+        for i, val in enumerate(values):
+            self.mem[addr + i] = val & 0xFFFF
+
+    ####################################################################################################################
+    # Calling
+    ####################################################################################################################
+
+    def call(self, name, *args, regcall=False):
+        """
+        Call a function with 16bit arguments, returns the value of A
+        """
+        stack_args = list(args)
+        # Make sure the arguments do not happen to be in the right registers
+        self.regs = [0x1111 * (i + 1) for i in range(8)]
+        if regcall:
+            for i, val in enumerate(stack_args[:3]):
+                self.regs[i] = val & 0xFFFF
+            stack_args = stack_args[3:]
+
+        self.sp = 0
+        for val in reversed(stack_args):
+            self._push(val)
+        sp = self.sp
+        self._push(self.halt)
+
+        saved = [self.regs[REGISTER_TABLE[reg]] for reg in PRESERVED]
+        self.pc = self.symbols[name]
+
+        steps = 0
+        while self.pc != self.halt:
+            self.step()
+            steps += 1
+            if steps > MAX_STEPS:
+                raise AssertionError(f'`{name}` did not return')
+
+        assert self.sp == sp, f'`{name}` left SP at {self.sp:04x} instead of {sp:04x}'
+        for reg, val in zip(PRESERVED, saved):
+            assert self.regs[REGISTER_TABLE[reg]] == val, f'`{name}` changed {reg}'
+
+        return self.regs[0]
+
+    def call_long(self, name, *args, regcall=False):
+        """
+        Call a function which returns a long, returns the value of A and B together
+        """
+        self.call(name, *args, regcall=regcall)
+        return self.regs[0] | self.regs[1] << 16
+
+    def _push(self, val):
+        self.sp = (self.sp - 1) & 0xFFFF
+        self.mem[self.sp] = val & 0xFFFF
+
+    ####################################################################################################################
+    # Running
+    ####################################################################################################################
+
+    def _next(self):
+        word = self.mem[self.pc]
+        self.pc = (self.pc + 1) & 0xFFFF
+        return word
+
+    def _extra(self, val):
+        """
+        Read the word after the instruction an operand needs, if it needs one
+        """
+        if DEREF_OFFSET <= val < PUSH_POP or val in (PICK, DEREF_NEXT, NEXT):
+            return self._next()
+        return None
+
+    def _operand(self, val, extra, a):
+        """
+        Returns the address of the operand in memory, or the register, or
+        the number of a literal as ('lit', value)
+        """
+        if val < 0x08:
+            return 'reg', val
+        elif val < 0x10:
+            return 'mem', self.regs[val - DEREF]
+        elif val < 0x18:
+            return 'mem', (self.regs[val - DEREF_OFFSET] + extra) & 0xFFFF
+        elif val == PUSH_POP:
+            if a:
+                addr = self.sp
+                self.sp = (self.sp + 1) & 0xFFFF
+            else:
+                self.sp = (self.sp - 1) & 0xFFFF
+                addr = self.sp
+            return 'mem', addr
+        elif val == PEEK:
+            return 'mem', self.sp
+        elif val == PICK:
+            return 'mem', (self.sp + extra) & 0xFFFF
+        elif val == SP:
+            return 'sp', None
+        elif val == PC:
+            return 'pc', None
+        elif val == EX:
+            return 'ex', None
+        elif val == DEREF_NEXT:
+            return 'mem', extra
+        elif val == NEXT:
+            return 'lit', extra
+        else:
+            return 'lit', (val - LITERAL - 1) & 0xFFFF
+
+    def _get(self, operand):
+        kind, val = operand
+        if kind == 'reg':
+            return self.regs[val]
+        elif kind == 'mem':
+            return self.mem[val]
+        elif kind == 'lit':
+            return val
+        else:
+            return getattr(self, kind)
+
+    def _set(self, operand, val):
+        kind, where = operand
+        val &= 0xFFFF
+        if kind == 'reg':
+            self.regs[where] = val
+        elif kind == 'mem':
+            self.mem[where] = val
+        elif kind != 'lit':
+            setattr(self, kind, val)
+
+    def _skip(self):
+        """
+        Skip the next instruction, and the one after it while they are IF instructions
+        """
+        while True:
+            word = self._next()
+            op, b, a = word & 0x1F, (word >> 5) & 0x1F, word >> 10
+            if op != 0:
+                self._extra(b)
+            self._extra(a)
+            if op not in CONDITIONS:
+                break
+
+    def step(self):
+        word = self._next()
+        op, b, a = word & 0x1F, (word >> 5) & 0x1F, word >> 10
+
+        if op == 0:
+            a = self._operand(a, self._extra(a), True)
+            if b == SPECIAL_INST_TABLE['JSR']:
+                val = self._get(a)
+                self._push(self.pc)
+                self.pc = val
+                return
+            raise AssertionError(f'unexpected special instruction {b:02x} at {self.pc - 1:04x}')
+
+        # The assembler puts the word of b before the one of a, but a is
+        # handled first (for `SET PUSH, POP`)
+        b_extra = self._extra(b)
+        a = self._operand(a, self._extra(a), True)
+        av = self._get(a)
+        b = self._operand(b, b_extra, False)
+        bv = self._get(b)
+
+        if op == INST_TABLE['SET']:
+            self._set(b, av)
+        elif op == INST_TABLE['ADD']:
+            self._set(b, bv + av)
+            self.ex = 1 if bv + av > 0xFFFF else 0
+        elif op == INST_TABLE['SUB']:
+            self._set(b, bv - av)
+            self.ex = 0xFFFF if bv - av < 0 else 0
+        elif op == INST_TABLE['MUL']:
+            self._set(b, bv * av)
+            self.ex = (bv * av >> 16) & 0xFFFF
+        elif op == INST_TABLE['MLI']:
+            self._set(b, signed(bv) * signed(av))
+            self.ex = (signed(bv) * signed(av) >> 16) & 0xFFFF
+        elif op == INST_TABLE['DIV']:
+            if av == 0:
+                self._set(b, 0)
+                self.ex = 0
+            else:
+                self._set(b, bv // av)
+                self.ex = ((bv << 16) // av) & 0xFFFF
+        elif op == INST_TABLE['DVI']:
+            if av == 0:
+                self._set(b, 0)
+                self.ex = 0
+            else:
+                quot = abs(signed(bv)) // abs(signed(av))
+                if (signed(bv) < 0) != (signed(av) < 0):
+                    quot = -quot
+                self._set(b, quot)
+                self.ex = 0
+        elif op == INST_TABLE['MOD']:
+            self._set(b, 0 if av == 0 else bv % av)
+        elif op == INST_TABLE['MDI']:
+            if av == 0:
+                self._set(b, 0)
+            else:
+                rem = abs(signed(bv)) % abs(signed(av))
+                self._set(b, -rem if signed(bv) < 0 else rem)
+        elif op == INST_TABLE['AND']:
+            self._set(b, bv & av)
+        elif op == INST_TABLE['BOR']:
+            self._set(b, bv | av)
+        elif op == INST_TABLE['XOR']:
+            self._set(b, bv ^ av)
+        elif op == INST_TABLE['SHR']:
+            self._set(b, bv >> av)
+            self.ex = ((bv << 16) >> av) & 0xFFFF
+        elif op == INST_TABLE['ASR']:
+            self._set(b, signed(bv) >> av)
+            self.ex = ((bv << 16) >> av) & 0xFFFF
+        elif op == INST_TABLE['SHL']:
+            self._set(b, bv << av)
+            self.ex = ((bv << av) >> 16) & 0xFFFF
+        elif op in CONDITIONS:
+            if not CONDITIONS[op](bv, av):
+                self._skip()
+        elif op == INST_TABLE['ADX']:
+            res = bv + av + self.ex
+            self._set(b, res)
+            self.ex = 1 if res > 0xFFFF else 0
+        elif op == INST_TABLE['SBX']:
+            res = bv - av + signed(self.ex)
+            self._set(b, res)
+            self.ex = 0xFFFF if res < 0 else (1 if res > 0xFFFF else 0)
+        elif op == INST_TABLE['STI']:
+            self._set(b, av)
+            self.regs[6] = (self.regs[6] + 1) & 0xFFFF
+            self.regs[7] = (self.regs[7] + 1) & 0xFFFF
+        elif op == INST_TABLE['STD']:
+            self._set(b, av)
+            self.regs[6] = (self.regs[6] - 1) & 0xFFFF
+            self.regs[7] = (self.regs[7] - 1) & 0xFFFF
+        else:
+            raise AssertionError(f'unexpected instruction {op:02x} at {self.pc - 1:04x}')
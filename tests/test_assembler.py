@@ -0,0 +1,34 @@
+import contextlib
+import io
+import unittest
+
+from asm.assembler import Assembler
+
+
+def assemble(code):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        asm = Assembler(code, 'test.s')
+        asm.parse()
+        asm.fix_labels()
+    return asm, out.getvalue()
+
+
+class LabelAdditionTest(unittest.TestCase):
+
+    def test_register_plus_label(self):
+        asm, out = assemble('SET A, [B + table]\nSET [table + 2], 1\nSET PC, table + 1\ntable:\n.dw 0\n')
+        self.assertFalse(asm.got_errors, out)
+        # The label is at 6, after three instructions of two words each
+        words = asm.get_object()[0]
+        self.assertEqual([words[1], words[3], words[5]], [6, 8, 7])
+
+    def test_label_plus_label(self):
+        for code in ['SET A, [foo + bar]\n', 'SET A, foo + bar\n']:
+            asm, out = assemble(code + 'foo:\nbar:\n')
+            self.assertTrue(asm.got_errors, code)
+            self.assertIn('can not add the label `bar` to the label `foo`', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import random
+import unittest
+
+from tests.dcpu import Program
+
+
+def words(rand, count):
+    return [rand.randrange(0x10000) for _ in range(count)]
+
+
+class BlockCopyTest(unittest.TestCase):
+
+    def test_struct(self):
+        # Small copies are unrolled, bigger ones are a loop with a remainder
+        prog = Program('''
+            struct small { int x; int y; int z; };
+            struct big { int v[38]; };
+            struct small a, b;
+            struct big c, d;
+            void small() { a = b; }
+            void big() { c = d; }
+            int local(int k) { struct big e; e = d; e.v[0] = 1; c = e; return e.v[k]; }
+        ''')
+        self.assertIn('STI', prog.asm())
+
+        rand = random.Random(1)
+        b, d = words(rand, 3), words(rand, 38)
+        prog.write('b', b)
+        prog.write('d', d)
+
+        prog.call('small')
+        self.assertEqual(prog.read('a', 3), b)
+        prog.call('big')
+        self.assertEqual(prog.read('c', 38), d)
+
+        prog.write('c', [0] * 38)
+        self.assertEqual(prog.call('local', 37), d[37])
+        self.assertEqual(prog.read('c', 38), [1] + d[1:])
+
+    def test_registers_in_use(self):
+        # With the frame pointer J is saved around the copy, the register variables here leave
+        # nothing to save I and J in and the copy is done without them
+        prog = Program('''
+            struct big { int v[40]; };
+            struct big c, d;
+            int f(int a, int b) {
+                register int p = a + 1; register int q = b + 2; register int r = a ^ b;
+                register int s = a - b; register int t = a + b; register int u = a & b; register int v = a | b;
+                c = d;
+                return p + q + r + s + t + u + v;
+            }
+        ''', omit_frame_pointer=True)
+        d = words(random.Random(2), 40)
+        prog.write('d', d)
+        a, b = 0x1234, 0x4321
+        self.assertEqual(prog.call('f', a, b), (a + 1 + b + 2 + (a ^ b) + a - b + a + b + (a & b) + (a | b)) & 0xFFFF)
+        self.assertEqual(prog.read('c', 40), d)
+
+    def test_array_initializer(self):
+        prog = Program('''
+            int init(int k) { int a[12] = {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12}; a[0] = a[0] + k; return a[k]; }
+        ''')
+        for k in range(1, 12):
+            self.assertEqual(prog.call('init', k), k + 1)
+            # A second call starts over from the initializer
+            self.assertEqual(prog.call('init', 0), 1)
+
+
+class CopyLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prog = Program('''
+            int src[32]; int dst[32];
+            void copy(int n) { int i; for (i = 0; i < n; i++) dst[i] = src[i]; }
+            void fill(int n, int v) { int i; for (i = 0; i < n; i++) dst[i] = v; }
+            void back(int n) { int i; for (i = n - 1; i >= 0; i--) dst[i] = src[i]; }
+        ''')
+        self.rand = random.Random(3)
+
+    def test_lowered(self):
+        asm = self.prog.asm()
+        self.assertIn('STI [I], [J]', asm)
+        self.assertIn('STD [I], [J]', asm)
+
+    def _check(self, name, want, *args):
+        self.prog.write('dst', [0xAAAA] * 32)
+        self.prog.call(name, *args)
+        self.assertEqual(self.prog.read('dst', 32), want + [0xAAAA] * (32 - len(want)), f'{name}{args}')
+
+    def test_copy(self):
+        src = words(self.rand, 32)
+        self.prog.write('src', src)
+        for n in [0, 1, 2, 5, 31, 32]:
+            self._check('copy', src[:n], n)
+            self._check('back', src[:n], n)
+
+    def test_fill(self):
+        for n in [0, 1, 7, 32]:
+            self._check('fill', [0x5555] * n, n, 0x5555)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import itertools
+import unittest
+
+from tests.dcpu import Program, signed
+
+# Positive, so the loop which keeps the callee from being inlined does nothing
+ARGS = [(1, 2, 3), (9, 0, 5), (0x7FFF, 4, 0x1234)]
+
+CALLEE = 'int __regcall g(int a, int b, int c) { while (a < 0) { a = a + b; } return a * 100 + b * 10 + c; }\n'
+
+
+def digits(a, b, c):
+    return (a * 100 + b * 10 + c) & 0xFFFF
+
+
+class RegcallArgumentsTest(unittest.TestCase):
+    """
+    Arguments which are already in A, B and C are moved to where the callee wants
+    them all at once, no argument is overwritten before it is read
+    """
+
+    def _check_permuted(self, params):
+        # Every order of the parameters, with some of them passed twice, a register
+        # which is not a parameter is free while the arguments are moved
+        orders = list(itertools.product(params, repeat=3))
+        decl = ', '.join([f'int {name}' for name in params])
+        code = CALLEE
+        for i, order in enumerate(orders):
+            args = ', '.join(order)
+            code += f'int __regcall call{i}({decl}) {{ return g({args}) + 1; }}\n'
+            code += f'int __regcall tail{i}({decl}) {{ return g({args}); }}\n'
+        prog = Program(code)
+
+        for i, order in enumerate(orders):
+            for args in ARGS:
+                args = args[:len(params)]
+                env = dict(zip(params, args))
+                want = digits(*[env[name] for name in order])
+                msg = f'g({", ".join(order)}) with {args}'
+                self.assertEqual(prog.call(f'call{i}', *args, regcall=True), (want + 1) & 0xFFFF, msg)
+                self.assertEqual(prog.call(f'tail{i}', *args, regcall=True), want, msg)
+
+    def test_permuted(self):
+        self._check_permuted('abc')
+
+    def test_permuted_free_register(self):
+        self._check_permuted('ab')
+
+    def test_calculated(self):
+        # Arguments that are calculated in place of the ones they read
+        prog = Program(CALLEE + '''
+            int __regcall f(int a, int b, int c) { return g(b + 1, a * 2, a - c); }
+            int __regcall t(int a, int b, int c) { return g(c ^ b, c, b | a); }
+        ''')
+        for a, b, c in ARGS:
+            self.assertEqual(prog.call('f', a, b, c, regcall=True), digits((b + 1) & 0xFFFF, (a * 2) & 0xFFFF,
+                                                                           (a - c) & 0xFFFF))
+            self.assertEqual(prog.call('t', a, b, c, regcall=True), digits(c ^ b, c, b | a))
+
+    def test_static(self):
+        # Static functions get their arguments in registers without asking for it
+        prog = Program('''
+            static int g(int a, int b, int c) { while (a < 0) { a = a + b; } return a * 100 + b * 10 + c; }
+            static int swap(int a, int b, int c) { return g(b, a, a) + 1; }
+            static int rotate(int a, int b, int c) { return g(c, a, b); }
+            int f(int a, int b, int c) { return swap(a, b, c) + rotate(a, b, c); }
+        ''')
+        for a, b, c in ARGS:
+            self.assertEqual(prog.call('f', a, b, c), (digits(b, a, a) + digits(c, a, b) + 1) & 0xFFFF)
+
+
+class TailCallTest(unittest.TestCase):
+
+    def test_permuted_stack_arguments(self):
+        prog = Program('''
+            int s(int a, int b, int c) { if (a < 0) return s(0 - a, c, b); return a * 100 + b * 10 + c; }
+            int r(int a, int b, int c) { if (a > 0) return r(a - 1, c, a); return b * 10 + c; }
+        ''')
+        for a, b, c in [(0xFFFF, 2, 3), (0xFFF0, 0, 5), (4, 5, 6)]:
+            x, y, z = ((0 - a) & 0xFFFF, c, b) if signed(a) < 0 else (a, b, c)
+            self.assertEqual(prog.call('s', a, b, c), (x * 100 + y * 10 + z) & 0xFFFF)
+
+        for a in range(5):
+            b, c = 7, 8
+            n = a
+            while n > 0:
+                n, b, c = n - 1, c, n
+            self.assertEqual(prog.call('r', a, 7, 8), b * 10 + c)
+
+
+if __name__ == '__main__':
+    unittest.main()
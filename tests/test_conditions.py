@@ -0,0 +1,142 @@
+import operator
+import unittest
+
+from tests.dcpu import Program, signed
+
+COMPARISONS = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+VALUES = [0, 1, 2, 0x7FFF, 0x8000, 0x8001, 0xFFFE, 0xFFFF]
+
+
+class ComparisonTest(unittest.TestCase):
+
+    def _check(self, typ, convert):
+        code = ''
+        for i, op in enumerate(COMPARISONS):
+            code += f'int value{i}({typ} a, {typ} b) {{ return a {op} b; }}\n'
+            code += f'int branch{i}({typ} a, {typ} b) {{ if (a {op} b) return 5; return 7; }}\n'
+            code += f'int skip{i}({typ} a, {typ} b) {{ int x = 3; if (a {op} b) x = 9; return x; }}\n'
+        prog = Program(code)
+
+        for i, (op, func) in enumerate(COMPARISONS.items()):
+            for a in VALUES:
+                for b in VALUES:
+                    result = func(convert(a), convert(b))
+                    msg = f'{convert(a)} {op} {convert(b)}'
+                    self.assertEqual(prog.call(f'value{i}', a, b), int(result), msg)
+                    self.assertEqual(prog.call(f'branch{i}', a, b), 5 if result else 7, msg)
+                    self.assertEqual(prog.call(f'skip{i}', a, b), 9 if result else 3, msg)
+
+    def test_signed(self):
+        self._check('int', signed)
+
+    def test_unsigned(self):
+        self._check('unsigned', lambda val: val)
+
+    def test_result_is_signed_int(self):
+        # The result of a comparison is an int, comparing it with a negative number is signed
+        prog = Program('''
+            int rel(int a, int b) { return (a < b) > (0 - 100); }
+            int eq(int a, int b) { return (a == b) > (0 - 1); }
+            int not(int a) { return !a > (0 - 1); }
+            int and(int a, int b) { return (a && b) > (0 - 1); }
+            int or(int a, int b) { return (a || b) > (0 - 1); }
+            int neg(int a, int b) { return ((a < b) - 1) < 0; }
+        ''')
+        for a, b in [(1, 2), (2, 1), (0, 0)]:
+            self.assertEqual(prog.call('rel', a, b), 1)
+            self.assertEqual(prog.call('eq', a, b), 1)
+            self.assertEqual(prog.call('not', a), 1)
+            self.assertEqual(prog.call('and', a, b), 1)
+            self.assertEqual(prog.call('or', a, b), 1)
+            self.assertEqual(prog.call('neg', a, b), int(a >= b))
+
+
+class LogicalTest(unittest.TestCase):
+
+    def test_short_circuit(self):
+        prog = Program('''
+            int count;
+            int touch(int val) { count = count + 1; return val; }
+            int and(int a, int b) { return touch(a) && touch(b); }
+            int or(int a, int b) { return touch(a) || touch(b); }
+            int nested(int a, int b, int c) { if ((a < b && b < c) || c == 0) return 1; return 2; }
+        ''')
+        for a in [0, 3]:
+            for b in [0, 4]:
+                prog.write('count', [0])
+                self.assertEqual(prog.call('and', a, b), int(bool(a and b)))
+                self.assertEqual(prog.read('count'), [2 if a else 1])
+
+                prog.write('count', [0])
+                self.assertEqual(prog.call('or', a, b), int(bool(a or b)))
+                self.assertEqual(prog.read('count'), [1 if a else 2])
+
+        for a, b, c in [(1, 2, 3), (3, 2, 1), (1, 2, 0), (2, 2, 2)]:
+            self.assertEqual(prog.call('nested', a, b, c), 1 if (a < b < c) or c == 0 else 2)
+
+
+class PredicatedTest(unittest.TestCase):
+
+    def test_chained_skips(self):
+        # A short body behind && is run behind one skip for every condition, without a branch
+        prog = Program('''
+            int count;
+            int both(int a, int b) { int x = 3; if (a < b && b < 10) x = 9; return x; }
+            int three(int a, int b, int c) { int x = 3; if (a == 1 && b != 2 && c > a) x = c; return x; }
+            void bump(int a, int b) { if (a <= b && a != 0) count = count + 1; }
+        ''')
+        asm = prog.asm()
+        self.assertNotIn('SET PC, _', asm[asm.index('both:'):asm.index('three:')])
+
+        for a in VALUES:
+            for b in [0, 2, 9, 10, 0xFFFF]:
+                want = 9 if signed(a) < signed(b) and signed(b) < 10 else 3
+                self.assertEqual(prog.call('both', a, b), want, f'both({a}, {b})')
+
+                for c in [0, 1, 5]:
+                    want = c if a == 1 and b != 2 and c > signed(a) else 3
+                    self.assertEqual(prog.call('three', a, b, c), want, f'three({a}, {b}, {c})')
+
+                prog.write('count', [7])
+                prog.call('bump', a, b)
+                self.assertEqual(prog.read('count'), [8 if signed(a) <= signed(b) and a != 0 else 7])
+
+    def test_register_pressure(self):
+        # A body which is too big to predicate is translated again as a branch, what the first
+        # try spilled to the stack is forgotten
+        code = '''
+            int g[8];
+            int h(int x) { return x + 3; }
+            int f(int a, int b, int u) {
+                register int p = a + 1; register int q = b + 2; register int r = a ^ u;
+                register int s = a - u; register int t = a + b; register int v = u | b;
+                int i;
+                for (i = 0; i < 3; i++) {
+                    if (b) { g[h(0) & 7] = (!b) < (10 % ((u & 15) + 1)); }
+                    p = p + q * r - s;
+                }
+                return p + q + r + s + t + v;
+            }
+        '''
+        for optimize_size in [False, True]:
+            for omit_frame_pointer in [False, True]:
+                prog = Program(code, optimize_size, omit_frame_pointer)
+                for a, b, u in [(1, 2, 3), (5, 0, 7), (0xFFFF, 1, 9)]:
+                    p, q, r, s, t, v = a + 1, b + 2, a ^ u, a - u, a + b, u | b
+                    for i in range(3):
+                        p = p + q * r - s
+                    prog.write('g', [0] * 8)
+                    self.assertEqual(prog.call('f', a, b, u), (p + q + r + s + t + v) & 0xFFFF)
+                    self.assertEqual(prog.read('g', 8)[3], int(b != 0 and 10 % ((u & 15) + 1) > 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
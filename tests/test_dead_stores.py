@@ -0,0 +1,72 @@
+import unittest
+
+from tests.dcpu import Program
+
+
+def function_asm(prog, name):
+    """
+    The instructions of a single function
+    """
+    asm = prog.asm()
+    return asm[asm.index(f'{name}:'):].split('\n\n')[0]
+
+
+class DeadStoreTest(unittest.TestCase):
+
+    def test_removed(self):
+        prog = Program('''
+            int g[8];
+            void put(int c) { c = c + c; g[0] = 1; }
+            int over(int a) { int x = a; x = 3; x = x + a; return x; }
+        ''')
+        self.assertNotIn('[J + 2]', function_asm(prog, 'put'))
+        self.assertEqual(function_asm(prog, 'over').count('SET [J - 1]'), 1)
+
+        prog.call('put', 5)
+        self.assertEqual(prog.read('g'), [1])
+        for a in [0, 1, 0xFFFF]:
+            self.assertEqual(prog.call('over', a), (a + 3) & 0xFFFF)
+
+    def test_globals_kept(self):
+        # Another function can read a global, only the last store is known to be dead
+        prog = Program('''
+            int g[8];
+            int read() { return g[1]; }
+            int f(int a) { g[1] = a; g[2] = read(); g[1] = a + 1; return g[1]; }
+        ''')
+        for a in [0, 7, 0xFFFF]:
+            self.assertEqual(prog.call('f', a), (a + 1) & 0xFFFF)
+            self.assertEqual(prog.read('g', 3)[1:], [(a + 1) & 0xFFFF, a])
+
+
+class CopyPropagationTest(unittest.TestCase):
+
+    def test_propagated(self):
+        prog = Program('''
+            int copy(int a) { int x = 7; int y = x; return y + a; }
+            int chain(int a, int b) { int x = a; int y = x; x = b; return y - x; }
+        ''')
+        for a, b in [(0, 0), (1, 5), (0xFFFF, 3)]:
+            self.assertEqual(prog.call('copy', a), (a + 7) & 0xFFFF)
+            self.assertEqual(prog.call('chain', a, b), (a - b) & 0xFFFF)
+
+    def test_folded_logical_with_pure_side(self):
+        # A propagated number decides the result of || and the other side, which has no side
+        # effects, is dropped instead of being kept in front of the result
+        prog = Program('''
+            int g[8];
+            int store(int a, int b) { int c = 0; g[0] = ((0 | a) || ((c ^ 16) - 1000)); return 0; }
+            int value(int a, int b) { int x = 1; x = ((2 & g[6]) || x) + 0; return x; }
+            int and(int a) { int x = 0; g[1] = ((a ^ 3) && x); return g[1]; }
+        ''')
+        for a in [0, 1, 0xFFFF]:
+            g = [9] * 8
+            prog.write('g', g)
+            self.assertEqual(prog.call('store', a, 0), 0)
+            self.assertEqual(prog.read('g'), [1])
+            self.assertEqual(prog.call('value', a, 0), 1)
+            self.assertEqual(prog.call('and', a), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from tests.dcpu import Program, signed
+
+# Every dividend close to the edges of the ranges and a spread of the rest
+DIVIDENDS = sorted(set(list(range(0, 40)) + list(range(0x7FE0, 0x8020)) + list(range(0xFFD8, 0x10000)) +
+                       list(range(0, 0x10000, 251))))
+
+UNSIGNED_DIVISORS = [1 << i for i in range(16)] + [3, 7, 10, 100, 0x7FFF, 0xFFFF]
+SIGNED_DIVISORS = [1, -1, 2, -2, 8, 3, -7, 10, 0x4000, -0x8000]
+
+
+def c_constant(d):
+    # There is no unary minus
+    return str(d) if d >= 0 else f'(0 - {-d})'
+
+
+def c_div(n, d):
+    # C rounds towards zero
+    q = abs(n) // abs(d)
+    return -q if (n < 0) != (d < 0) else q
+
+
+def c_mod(n, d):
+    return n - c_div(n, d) * d
+
+
+class DivisionByConstantTest(unittest.TestCase):
+
+    def _functions(self, typ, divisors):
+        code = ''
+        for i, d in enumerate(divisors):
+            code += f'{typ} div{i}({typ} n) {{ return n / {c_constant(d)}; }}\n'
+            code += f'{typ} mod{i}({typ} n) {{ return n % {c_constant(d)}; }}\n'
+        return Program(code)
+
+    def test_unsigned(self):
+        prog = self._functions('unsigned', UNSIGNED_DIVISORS)
+        for i, d in enumerate(UNSIGNED_DIVISORS):
+            for n in DIVIDENDS:
+                self.assertEqual(prog.call(f'div{i}', n), n // d, f'{n} / {d}')
+                self.assertEqual(prog.call(f'mod{i}', n), n % d, f'{n} % {d}')
+
+    def test_signed(self):
+        prog = self._functions('int', SIGNED_DIVISORS)
+        for i, d in enumerate(SIGNED_DIVISORS):
+            for n in DIVIDENDS:
+                n = signed(n)
+                self.assertEqual(signed(prog.call(f'div{i}', n)), signed(c_div(n, d) & 0xFFFF), f'{n} / {d}')
+                self.assertEqual(signed(prog.call(f'mod{i}', n)), c_mod(n, d), f'{n} % {d}')
+
+    def test_lowered(self):
+        # Powers of two are a shift or a mask, the rest stay divisions
+        asm = Program('unsigned f(unsigned n) { return n / 16 + n % 8; }').asm()
+        self.assertNotIn('DIV', asm)
+        self.assertNotIn('MOD', asm)
+        self.assertIn('SHR', asm)
+        self.assertIn('AND', asm)
+
+        asm = Program('unsigned f(unsigned n) { return n / 10; }').asm()
+        self.assertIn('DIV', asm)
+
+        asm = Program('int f(int n) { return n / (0 - 1); }').asm()
+        self.assertNotIn('DVI', asm)
+
+
+if __name__ == '__main__':
+    unittest.main()
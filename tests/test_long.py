@@ -0,0 +1,87 @@
+import random
+import unittest
+
+from tests.dcpu import Program
+
+VALUES = [0, 1, 2, 0xFFFF, 0x10000, 0x12345678, 0x7FFFFFFF, 0x80000000, 0x80000001, 0xFFFFFFFE, 0xFFFFFFFF]
+
+
+def signed32(val):
+    return val - 0x100000000 if val & 0x80000000 else val
+
+
+def c_div(n, d):
+    # C rounds towards zero
+    q = abs(n) // abs(d)
+    return -q if (n < 0) != (d < 0) else q
+
+
+class LongTest(unittest.TestCase):
+
+    def _values(self, seed):
+        rand = random.Random(seed)
+        return VALUES + [rand.randrange(1 << 32) for _ in range(20)] + [rand.randrange(1 << 16) for _ in range(5)]
+
+    def _run(self, typ, convert):
+        prog = Program(f'''
+            {typ} x; {typ} y;
+            {typ} add() {{ return x + y; }}
+            {typ} sub() {{ return x - y; }}
+            {typ} mul() {{ return x * y; }}
+            {typ} div() {{ return x / y; }}
+            {typ} mod() {{ return x % y; }}
+            {typ} shl(int n) {{ return x << n; }}
+            {typ} shr(int n) {{ return x >> n; }}
+            {typ} shl5() {{ return x << 5; }}
+            {typ} shr20() {{ return x >> 20; }}
+            int lt() {{ return x < y; }}
+            int eq() {{ return x == y; }}
+        ''')
+
+        values = self._values(1)
+        for a in values:
+            for b in values[::3]:
+                prog.write('x', [a & 0xFFFF, a >> 16])
+                prog.write('y', [b & 0xFFFF, b >> 16])
+                x, y = convert(a), convert(b)
+                msg = f'{x}, {y}'
+                self.assertEqual(prog.call_long('add'), (a + b) & 0xFFFFFFFF, msg)
+                self.assertEqual(prog.call_long('sub'), (a - b) & 0xFFFFFFFF, msg)
+                self.assertEqual(prog.call_long('mul'), (a * b) & 0xFFFFFFFF, msg)
+                if b != 0:
+                    self.assertEqual(prog.call_long('div'), c_div(x, y) & 0xFFFFFFFF, msg)
+                    self.assertEqual(prog.call_long('mod'), (x - c_div(x, y) * y) & 0xFFFFFFFF, msg)
+                self.assertEqual(prog.call('lt'), int(x < y), msg)
+                self.assertEqual(prog.call('eq'), int(x == y), msg)
+
+            self.assertEqual(prog.call_long('shl5'), (a << 5) & 0xFFFFFFFF)
+            self.assertEqual(prog.call_long('shr20'), (x >> 20) & 0xFFFFFFFF)
+            for n in [0, 1, 15, 16, 17, 31]:
+                self.assertEqual(prog.call_long('shl', n), (a << n) & 0xFFFFFFFF, f'{x} << {n}')
+                self.assertEqual(prog.call_long('shr', n), (x >> n) & 0xFFFFFFFF, f'{x} >> {n}')
+
+    def test_signed(self):
+        self._run('long', signed32)
+
+    def test_unsigned(self):
+        self._run('unsigned long', lambda val: val)
+
+    def test_int_operands(self):
+        # An int is sign extended and an unsigned is zero extended
+        prog = Program('''
+            long widen(int a, unsigned b) { long x = a; long y = b; return x + y; }
+            unsigned long ticks;
+            void tick(unsigned n) { ticks = ticks + n; }
+        ''')
+        for a, b in [(0, 0), (0xFFFF, 0xFFFF), (0x8000, 1), (5, 0x8000)]:
+            want = (a - 0x10000 if a & 0x8000 else a) + b
+            self.assertEqual(prog.call_long('widen', a, b), want & 0xFFFFFFFF)
+
+        prog.write('ticks', [0xFFF0, 0])
+        for i in range(3):
+            prog.call('tick', 0x10)
+        self.assertEqual(prog.read('ticks', 2), [0x0020, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import random
+import unittest
+
+from tests.dcpu import Program, signed
+
+# Seven register variables take every register but J, so the scratch registers are spilled
+PRESSURE = '''
+    register int p = a + 1; register int q = b + 2; register int r = c + 3; register int s = a ^ b;
+    register int t = b ^ c; register int u = a - c; register int v = a + b;
+'''
+
+
+def pressure_values(a, b, c):
+    return [(a + 1) & 0xFFFF, (b + 2) & 0xFFFF, (c + 3) & 0xFFFF, a ^ b, b ^ c, (a - c) & 0xFFFF, (a + b) & 0xFFFF]
+
+
+class RegisterPlusConstantTest(unittest.TestCase):
+
+    def test_not_an_operand(self):
+        # x + 3 is a register plus a constant, which is only an operand under a dereference
+        prog = Program('''
+            int f(int a, int b) {
+                int x = a;
+                while (b) { x = x - (int)(0 >= x + 3); b = b - 1; }
+                return x;
+            }
+        ''')
+        for a in [0, 1, 0xFFFD, 0xFFFC, 0xFFF0, 0x7FFF]:
+            for b in [0, 1, 5]:
+                x = signed(a)
+                for i in range(b):
+                    x = signed((x - int(0 >= signed((x + 3) & 0xFFFF))) & 0xFFFF)
+                self.assertEqual(signed(prog.call('f', a, b)), x, f'f({a}, {b})')
+
+    def test_pointer_in_register(self):
+        prog = Program('''
+            int g[8];
+            int f(int n) {
+                register int *p = &g[0];
+                int s = 0;
+                while (n) { s = s + p[2] - p[1]; p = p + 1; n = n - 1; }
+                return s;
+            }
+        ''')
+        self.assertIn('+ 2]', prog.asm())
+
+        squares = [1, 4, 9, 16, 25, 36, 49, 64]
+        prog.write('g', squares)
+        for n in range(7):
+            self.assertEqual(prog.call('f', n), squares[n + 1] - squares[1])
+
+
+class SpilledAddressTest(unittest.TestCase):
+    """
+    An address calculated into a scratch register which was spilled to the stack is
+    dereferenced through a register borrowed for the instruction
+    """
+
+    def test_load(self):
+        prog = Program('''
+            int g[8];
+            int f(int a, int b, int n) {
+                int c = 0; int y; int i0;
+                c += 1; y = a;
+                i0 = 0;
+                while (i0 < n) {
+                    g[1] = ((g[3] < c) != (g[3] || b)) > y;
+                    i0 = i0 + 1;
+                }
+                return g[1];
+            }
+        ''')
+        for a, b, g3 in [(0, 0, 0), (0xFFFF, 1, 5), (0xFFFF, 0, 0xFFFF), (3, 1, 0)]:
+            prog.write('g', [0, 7, 0, g3])
+            want = int((int(signed(g3) < 1) != int(g3 != 0 or b != 0)) > signed(a))
+            self.assertEqual(prog.call('f', a, b, 2), want)
+
+    def test_store(self):
+        prog = Program(f'''
+            int g[8];
+            int f(int a, int b, int c) {{
+                {PRESSURE}
+                g[(g[p & 7] < q) + (g[r & 7] < s)] = (t < u) + (g[(p ^ q) & 7] || g[(r ^ v) & 7]);
+                return p + q + r + s + t + u + v;
+            }}
+        ''')
+        self.assertIn('XOR', prog.asm())
+
+        rand = random.Random(1)
+        for i in range(100):
+            a, b, c = [rand.randrange(0x10000) for _ in range(3)]
+            p, q, r, s, t, u, v = pressure_values(a, b, c)
+            g = [rand.randrange(0x10000) for _ in range(8)]
+            want = list(g)
+            want[int(signed(g[p & 7]) < signed(q)) + int(signed(g[r & 7]) < signed(s))] = \
+                int(signed(t) < signed(u)) + int(g[(p ^ q) & 7] != 0 or g[(r ^ v) & 7] != 0)
+
+            prog.write('g', g)
+            self.assertEqual(prog.call('f', a, b, c), sum([p, q, r, s, t, u, v]) & 0xFFFF)
+            self.assertEqual(prog.read('g', 8), want)
+
+    def test_struct_and_long_copy(self):
+        prog = Program(f'''
+            struct point {{ int x; int y; int z; }};
+            struct point points[4];
+            long longs[4];
+            int copy(int a, int b, int c) {{
+                {PRESSURE}
+                points[p & 3] = points[q & 3];
+                return p + q + r + s + t + u + v;
+            }}
+            int add(int a, int b, int c) {{
+                {PRESSURE}
+                longs[p & 3] = longs[q & 3] + longs[r & 3];
+                return p + q + r + s + t + u + v;
+            }}
+        ''')
+
+        rand = random.Random(2)
+        for i in range(100):
+            a, b, c = [rand.randrange(0x10000) for _ in range(3)]
+            p, q, r, s, t, u, v = pressure_values(a, b, c)
+
+            points = [rand.randrange(0x10000) for _ in range(12)]
+            want = list(points)
+            want[(p & 3) * 3:(p & 3) * 3 + 3] = points[(q & 3) * 3:(q & 3) * 3 + 3]
+            prog.write('points', points)
+            self.assertEqual(prog.call('copy', a, b, c), sum([p, q, r, s, t, u, v]) & 0xFFFF)
+            self.assertEqual(prog.read('points', 12), want)
+
+            longs = [rand.randrange(0x10000) for _ in range(8)]
+            value = ((longs[(q & 3) * 2] | longs[(q & 3) * 2 + 1] << 16) +
+                     (longs[(r & 3) * 2] | longs[(r & 3) * 2 + 1] << 16)) & 0xFFFFFFFF
+            want = list(longs)
+            want[(p & 3) * 2:(p & 3) * 2 + 2] = [value & 0xFFFF, value >> 16]
+            prog.write('longs', longs)
+            self.assertEqual(prog.call('add', a, b, c), sum([p, q, r, s, t, u, v]) & 0xFFFF)
+            self.assertEqual(prog.read('longs', 8), want)
+
+
+if __name__ == '__main__':
+    unittest.main()